@@ -13,8 +13,9 @@ import os
 import numpy as np
 import numpy.random as npr
 
-from kaleido import opr
-from kaleido.graph import CompGraph
+from kaleido import opr, optim
+from kaleido.data import MinibatchLoader
+from kaleido.graph import CompGraph, save_params, load_params
 
 
 def load_data(fname):
@@ -55,10 +56,8 @@ def fc(name, src, cout, cin, wstd=0.01, nonlin=True):
     return opr.tanh(y) if nonlin else y
 
 
-def cross_entropy(pred, label):
-    y = -opr.log(pred)
-    y_index = opr.index_onehot(y, label, axis=2)
-    return y_index.sum()
+def cross_entropy(logits, label):
+    return opr.softmax_cross_entropy(logits, label, axis=1).sum()
 
 
 def softmax(src, axis):
@@ -81,7 +80,7 @@ def make_net():
     _ = fc('fc1', _, cout=64, cin=800)
     _ = fc('softmax', _, cout=10, cin=64, nonlin=False)
     pred = softmax(_, 1)
-    loss = cross_entropy(pred, label)
+    loss = cross_entropy(_, label)
     return pred, loss
 
 
@@ -89,65 +88,58 @@ def make_func(pred, loss, is_train, lr=0.1):
     cg = CompGraph()
 
     if is_train:
-        lr = opr.parameter(lr)
-
-        optimizable = []
-        for o in cg.find_all_oprs([loss]):
-            if isinstance(o, opr.Parameter):
-                optimizable.append(o.outputs[0])
-        updates = []
+        optimizer = optim.SGD(lr)
+        updates = optimizer.minimize(loss)
         outputs = []
-        for o in optimizable:
-            updates.append(opr.update(o, o - lr * opr.grad(loss, o)))
 
         func = cg.compile([loss] + outputs + updates)
-        return func, lr.owner_opr
+        return func, optimizer
     else:
-        func = cg.compile([pred])
+        # the parameters are frozen at compile time
+        func = cg.compile([pred], mode='inference')
         return func
 
 
 def main():
     pred, loss = make_net()
     print('net constructed')
-    func_train = make_func(pred, loss, True)
-    func_test = make_func(pred, loss, False)
+    func_train, optimizer = make_func(pred, loss, True)
     print('func constructed')
 
-    data = make_data('train')
-    testdata = make_data('test')
-    nr_minibatch = len(data['img']) // 128
-    nr_test_minibatch = len(testdata['img']) // 128
+    data = make_data('train', shuffle=False)
+    testdata = make_data('test', shuffle=False)
+    train_loader = MinibatchLoader(data, 128, shuffle=True, dtypes={'img': 'float32', 'label': 'int32'})
+    test_loader = MinibatchLoader(testdata, 128, shuffle=False, dtypes={'img': 'float32', 'label': 'int32'})
+    nr_minibatch = len(train_loader)
     print('data constructed')
 
     def do_train():
         quick_loss = 0
-        for minibatch in range(nr_minibatch):
+        for minibatch, batch_data in enumerate(train_loader):
             print('minibatch', minibatch)
-            batch_data = dict()
-            for k, v in data.items():
-                batch_data[k] = np.ascontiguousarray(data[k][minibatch*128:minibatch*128+128], dtype='float32')
             quick_loss += func_train(**batch_data)[0]
         return quick_loss
 
     def do_test():
         nr_total, nr_correct = 0, 0
-        for minibatch in range(nr_test_minibatch):
+        func_test = make_func(pred, loss, False)
+        for minibatch, batch_data in enumerate(test_loader):
             print('minibatch', minibatch)
-            batch_data = dict()
-            for k, v in testdata.items():
-                batch_data[k] = np.ascontiguousarray(testdata[k][minibatch*128:minibatch*128+128], dtype='float32')
-            pred = func_test(img=batch_data['img'])[0].argmax(axis=1)
-            nr_correct += (pred == batch_data['label']).sum()
-            nr_total += len(pred)
+            label_pred = func_test(img=batch_data['img'])[0].argmax(axis=1)
+            nr_correct += (label_pred == batch_data['label']).sum()
+            nr_total += len(label_pred)
         return nr_total, nr_correct
 
-    # env.network.set_param_values_dict(io.load('epoch2.neuartist.pkl'))
+    checkpoint = 'checkpoint.kld'
+    if os.path.exists(checkpoint):
+        load_params(checkpoint, [loss])
+        print('checkpoint loaded')
 
     print('begin training')
     for epoch in range(100):
         if epoch != 0:
             quick_loss = do_train()
+            save_params(checkpoint, [loss])
         else:
             quick_loss = 0
         nr_total, nr_correct = do_test()
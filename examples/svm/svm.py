@@ -7,7 +7,7 @@
 # This file is part of Kaleido
 # (c) 2016 vccy.xyz
 
-from kaleido import opr
+from kaleido import opr, optim
 from kaleido.graph import CompGraph
 import numpy as np
 
@@ -70,21 +70,14 @@ def make_func(pred, loss, is_train, lr=1):
     cg = CompGraph()
 
     if is_train:
-        lr = opr.parameter(lr)
-
-        optimizable = []
-        for o in cg.find_all_oprs([loss]):
-            if isinstance(o, opr.Parameter):
-                optimizable.append(o.outputs[0])
-        updates = []
+        optimizer = optim.SGD(lr)
+        updates = optimizer.minimize(loss)
         outputs = []
-        for o in optimizable:
-            updates.append(opr.update(o, o - lr * opr.grad(loss, o)))
 
         func = cg.compile([loss] + updates + outputs)
-        return func, lr.owner_opr
+        return func, optimizer
     else:
-        func = cg.compile([pred])
+        func = cg.compile([pred], mode='inference')
         return func, cg.find_opr([loss], 'W'), cg.find_opr([loss], 'b')
 
 
@@ -94,10 +87,10 @@ def main():
     xs, ys = make_data()
     lr = 0.1
 
-    train_func, lr = make_func(pred, loss, True, lr=lr)
+    train_func, optimizer = make_func(pred, loss, True, lr=lr)
     for i in range(200):
         if i > 0 and i % 5 == 0:
-            lr.set_value(lr.get_value() * 0.9)
+            optimizer.lr = optimizer.lr * 0.9
         res = train_func(x=xs, label=ys)
         print('iter {}, loss={}'.format(i, res[0]))
 
@@ -0,0 +1,11 @@
+# -*- coding:utf8 -*-
+# File   : __init__.py
+# Author : Jiayuan Mao
+# Email  : maojiayuan@gmail.com
+# Date   : 10/22/26 19:15
+#
+# This file is part of Kaleido
+# (c) 2016 vccy.xyz
+
+from .timer import measure
+from .runner import get_cases, run_benchmarks, save_results, load_results, compare_results
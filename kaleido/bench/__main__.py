@@ -0,0 +1,81 @@
+# -*- coding:utf8 -*-
+# File   : __main__.py
+# Author : Jiayuan Mao
+# Email  : maojiayuan@gmail.com
+# Date   : 10/22/26 21:10
+#
+# This file is part of Kaleido
+# (c) 2016 vccy.xyz
+
+"""
+Benchmarks of Kaleido.
+
+    python -m kaleido.bench run -o results.json [--suite ops|e2e] [--filter 'op/conv2d/*'] [--quick]
+    python -m kaleido.bench compare baseline.json results.json [--threshold 0.1]
+
+`compare` exits with status 1 if a case got slower than the threshold.
+"""
+
+import argparse
+import sys
+
+from .runner import get_cases, run_benchmarks, save_results, load_results, compare_results
+
+
+def _run(args):
+    if args.threads is not None:
+        from ..threads import set_nr_threads
+        set_nr_threads(args.threads)
+
+    suites = ('ops', 'e2e') if args.suite == 'all' else (args.suite, )
+    cases = get_cases(suites, quick=args.quick, pattern=args.filter)
+    if args.list:
+        for c in cases:
+            print(c.name)
+        return 0
+
+    results = run_benchmarks(cases, nr_runs=args.runs, nr_warmup=args.warmup, log=print)
+    if args.output is not None:
+        save_results(args.output, results)
+    nr_errors = sum('error' in r for r in results['results'].values())
+    return 1 if nr_errors != 0 else 0
+
+
+def _compare(args):
+    rows, regressions = compare_results(load_results(args.baseline), load_results(args.current),
+                                        threshold=args.threshold, key=args.key)
+    for name, b, c, ratio in rows:
+        flag = 'SLOWER' if name in regressions else ''
+        print('{:<60s} {:10.3f} ms -> {:10.3f} ms  x{:.2f} {}'.format(name, b * 1e3, c * 1e3, ratio, flag))
+    print('{} cases compared, {} slower by more than {:.0%}'.format(len(rows), len(regressions), args.threshold))
+    return 1 if len(regressions) != 0 else 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m kaleido.bench', description='Benchmarks of Kaleido.')
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    p = sub.add_parser('run', help='run the benchmarks')
+    p.add_argument('-o', '--output', help='JSON file of the results')
+    p.add_argument('--suite', choices=('all', 'ops', 'e2e'), default='all')
+    p.add_argument('--filter', help='glob over the case names, e.g. "op/conv2d/*"')
+    p.add_argument('--quick', action='store_true', help='only the first shape of each operator')
+    p.add_argument('--runs', type=int, default=20, help='timed runs per case')
+    p.add_argument('--warmup', type=int, default=2, help='untimed runs per case')
+    p.add_argument('--threads', type=int, help='kernel and BLAS threads')
+    p.add_argument('--list', action='store_true', help='only list the cases')
+    p.set_defaults(func=_run)
+
+    p = sub.add_parser('compare', help='compare results with a baseline')
+    p.add_argument('baseline')
+    p.add_argument('current')
+    p.add_argument('--threshold', type=float, default=0.1, help='relative slowdown flagged, e.g. 0.1 for 10%%')
+    p.add_argument('--key', choices=('median', 'p95', 'mean', 'min'), default='median')
+    p.set_defaults(func=_compare)
+
+    args = parser.parse_args(argv)
+    return args.func(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
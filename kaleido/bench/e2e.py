@@ -0,0 +1,97 @@
+# -*- coding:utf8 -*-
+# File   : e2e.py
+# Author : Jiayuan Mao
+# Email  : maojiayuan@gmail.com
+# Date   : 10/22/26 20:30
+#
+# This file is part of Kaleido
+# (c) 2016 vccy.xyz
+
+import numpy as np
+
+from .. import opr, optim
+from ..graph import CompGraph
+from .ops import BenchCase
+
+__all__ = ['get_e2e_cases']
+
+
+def _make_mnist_net(rng):
+    """The conv net of examples/mnist."""
+    def conv(name, src, cout, cin, k):
+        W = opr.parameter(rng.normal(scale=0.01, size=(cout, cin, k, k)).astype('float32'), name=name + ':W')
+        b = opr.parameter(np.zeros((1, cout, 1, 1), dtype='float32'), name=name + ':b')
+        return opr.tanh(opr.conv2d(src, W, name=name) + b)
+
+    def fc(name, src, cout, cin, nonlin=True):
+        W = opr.parameter(rng.normal(scale=0.01, size=(cin, cout)).astype('float32'), name=name + ':W')
+        b = opr.parameter(np.zeros((1, cout), dtype='float32'), name=name + ':b')
+        y = opr.matmul(src, W) + b
+        return opr.tanh(y) if nonlin else y
+
+    img = opr.placeholder('img')
+    label = opr.placeholder('label')
+    _ = conv('conv1', img, cout=16, cin=1, k=5)
+    _ = opr.pooling2d(_, 2)
+    _ = conv('conv2', _, cout=32, cin=16, k=3)
+    _ = opr.pooling2d(_, 2)
+    _ = opr.flatten2(_)
+    _ = fc('fc1', _, cout=64, cin=800)
+    _ = fc('softmax', _, cout=10, cin=64, nonlin=False)
+    exp = opr.exp(_)
+    pred = exp / opr.reduce_sum(exp, axis=1, keepdims=True)
+    loss = opr.index_onehot(-opr.log(pred), label, axis=1).sum()
+    return pred, loss
+
+
+def _make_svm_net(rng):
+    """The linear SVM of examples/svm."""
+    W = opr.parameter(rng.normal(size=[2, 1]), name='W')
+    b = opr.parameter(0., name='b')
+    x = opr.placeholder(name='x')
+    label = opr.placeholder(name='label')
+    y = opr.matmul(x, W) + b
+    pred = y >= 0
+    hinge = opr.max(1 - label * y, 0)
+    hinge = hinge.sum() / hinge.shapeidx(0)
+    loss = opr.mul(W, W).sum() / 2 + hinge * 100
+    return pred, loss
+
+
+def _mnist_case(batch_size, train):
+    def make():
+        rng = np.random.RandomState(0)
+        pred, loss = _make_mnist_net(rng)
+        feeds = {'img': rng.uniform(size=(batch_size, 1, 28, 28)).astype('float32')}
+        if train:
+            feeds['label'] = rng.randint(0, 10, size=batch_size).astype('int32')
+            func = CompGraph().compile([loss] + optim.SGD(0.01).minimize(loss))
+        else:
+            func = CompGraph().compile([pred], mode='inference')
+        return lambda: func(**feeds)
+    return make
+
+
+def _svm_case(nr_samples, train):
+    def make():
+        rng = np.random.RandomState(0)
+        pred, loss = _make_svm_net(rng)
+        x = rng.normal(size=(nr_samples, 2))
+        feeds = {'x': x}
+        if train:
+            feeds['label'] = np.where(x.sum(axis=1, keepdims=True) > 0, 1., -1.)
+            func = CompGraph().compile([loss] + optim.SGD(0.01).minimize(loss))
+        else:
+            func = CompGraph().compile([pred], mode='inference')
+        return lambda: func(**feeds)
+    return make
+
+
+def get_e2e_cases(quick=False):
+    """Training and inference steps of the MNIST conv net and the SVM example on synthetic data."""
+    for bs in ((64, ) if quick else (1, 64, 256)):
+        yield BenchCase('e2e/mnist/train/bs{}'.format(bs), _mnist_case(bs, True))
+        yield BenchCase('e2e/mnist/infer/bs{}'.format(bs), _mnist_case(bs, False))
+    for n in ((1000, ) if quick else (1000, 100000)):
+        yield BenchCase('e2e/svm/train/n{}'.format(n), _svm_case(n, True))
+        yield BenchCase('e2e/svm/infer/n{}'.format(n), _svm_case(n, False))
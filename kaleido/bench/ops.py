@@ -0,0 +1,152 @@
+# -*- coding:utf8 -*-
+# File   : ops.py
+# Author : Jiayuan Mao
+# Email  : maojiayuan@gmail.com
+# Date   : 10/22/26 19:40
+#
+# This file is part of Kaleido
+# (c) 2016 vccy.xyz
+
+import collections
+
+import numpy as np
+
+from .. import opr
+from ..graph import CompGraph
+
+__all__ = ['BenchCase', 'get_op_cases']
+
+# a benchmark: `make()` builds the graph and returns the callable to time
+BenchCase = collections.namedtuple('BenchCase', ['name', 'make'])
+
+FLOAT_DTYPES = ('float32', 'float64')
+
+
+def _shape_str(shape):
+    return 'x'.join(map(str, shape))
+
+
+def _randn(rng, shape, dtype):
+    return rng.normal(size=shape).astype(dtype)
+
+
+def _positive(rng, shape, dtype):
+    return rng.uniform(0.5, 2., size=shape).astype(dtype)
+
+
+class _OpSpec(object):
+    """An operator on a grid of inputs. `build(*vars)` returns the output var; `inputs(rng, dtype, *args)`
+    the input values for one point of the grid, `grid` the points as (label, args) pairs; the grads w.r.t. the
+    inputs of `wrt` are taken in the backward benchmark."""
+
+    def __init__(self, name, build, inputs, grid, wrt=(0, ), dtypes=FLOAT_DTYPES):
+        self.name = name
+        self.build = build
+        self.inputs = inputs
+        self.grid = grid
+        self.wrt = wrt
+        self.dtypes = dtypes
+
+    def make_func(self, values, backward):
+        xs = [opr.placeholder('x{}'.format(i)) for i in range(len(values))]
+        y = self.build(*xs)
+        outputs = [y]
+        if backward:
+            loss = opr.sum(y)
+            outputs += [opr.grad(loss, xs[i]) for i in self.wrt]
+        func = CompGraph().compile(outputs)
+        feeds = {'x{}'.format(i): v for i, v in enumerate(values)}
+        return lambda: func(**feeds)
+
+    def get_cases(self, quick):
+        grid = self.grid[:1] if quick else self.grid
+        for dtype in self.dtypes:
+            for label, args in grid:
+                for backward in ((False, True) if len(self.wrt) != 0 else (False, )):
+                    name = 'op/{}/{}/{}/{}'.format(self.name, dtype, label, 'backward' if backward else 'forward')
+                    yield BenchCase(name, self._maker(args, dtype, backward))
+
+    def _maker(self, args, dtype, backward):
+        def make():
+            rng = np.random.RandomState(0)
+            return self.make_func(self.inputs(rng, dtype, *args), backward)
+        return make
+
+
+def _elemwise_grid(nr_inputs):
+    grid = [(_shape_str(s), (s, ) * nr_inputs) for s in [(64, 64), (512, 512)]]
+    if nr_inputs == 2:
+        grid.append(('512x512_bcast_512', ((512, 512), (512, ))))
+    return grid
+
+
+def _unary(name, fn, positive=False):
+    gen = _positive if positive else _randn
+    return _OpSpec(name, fn, lambda rng, dtype, s: [gen(rng, s, dtype)], _elemwise_grid(1))
+
+
+def _binary(name, fn, positive=False, backward=True):
+    gen = _positive if positive else _randn
+    return _OpSpec(name, fn, lambda rng, dtype, a, b: [gen(rng, a, dtype), gen(rng, b, dtype)],
+                   _elemwise_grid(2), wrt=(0, 1) if backward else ())
+
+
+def _get_specs():
+    specs = [
+        _binary('add', opr.add),
+        _binary('sub', opr.sub),
+        _binary('mul', opr.mul),
+        _binary('div', opr.div, positive=True),
+        _binary('pow', opr.pow, positive=True),
+        _binary('max', opr.max),
+        _binary('min', opr.min),
+        _binary('ge', opr.ge, backward=False),
+        _binary('gt', opr.gt, backward=False),
+        _binary('eq', opr.eq, backward=False),
+        _unary('neg', opr.neg),
+        _unary('exp', opr.exp),
+        _unary('log', opr.log, positive=True),
+        _unary('tanh', opr.tanh),
+        _unary('sum', opr.sum),
+        _OpSpec('matmul', opr.matmul,
+                lambda rng, dtype, a, b: [_randn(rng, a, dtype), _randn(rng, b, dtype)],
+                [('64x64_64x64', ((64, 64), (64, 64))), ('256x512_512x256', ((256, 512), (512, 256)))],
+                wrt=(0, 1)),
+        _OpSpec('shapeof', opr.shapeof, lambda rng, dtype, s: [_randn(rng, s, dtype)],
+                _elemwise_grid(1)[:1], wrt=()),
+        _OpSpec('shapeidx', lambda x: opr.shapeidx(x, 0), lambda rng, dtype, s: [_randn(rng, s, dtype)],
+                _elemwise_grid(1)[:1], wrt=()),
+        _OpSpec('update', lambda x: opr.update(opr.parameter(np.zeros((512, 512))), x),
+                lambda rng, dtype, s: [_randn(rng, s, dtype)], [('512x512', ((512, 512), ))], wrt=()),
+        _OpSpec('flatten2', opr.flatten2, lambda rng, dtype, s: [_randn(rng, s, dtype)],
+                [('64x16x12x12', ((64, 16, 12, 12), ))]),
+        _OpSpec('index_onehot', lambda x, i: opr.index_onehot(x, i, axis=1),
+                lambda rng, dtype, s: [_randn(rng, s, dtype), rng.randint(0, s[1], size=s[0]).astype('int32')],
+                [('256x10', ((256, 10), )), ('4096x1000', ((4096, 1000), ))]),
+        _OpSpec('softmax_cross_entropy', lambda x, i: opr.softmax_cross_entropy(x, i, axis=1),
+                lambda rng, dtype, s: [_randn(rng, s, dtype), rng.randint(0, s[1], size=s[0]).astype('int32')],
+                [('256x10', ((256, 10), )), ('4096x1000', ((4096, 1000), ))]),
+        _OpSpec('conv2d', lambda x, k: opr.conv2d(x, k, padding=1),
+                lambda rng, dtype, x, k: [_randn(rng, x, dtype), _randn(rng, k, dtype)],
+                [('64x1x28x28_16x1x5x5', ((64, 1, 28, 28), (16, 1, 5, 5))),
+                 ('64x16x12x12_32x16x3x3', ((64, 16, 12, 12), (32, 16, 3, 3)))],
+                wrt=(0, 1), dtypes=('float32', )),
+    ]
+    for method in ('MAX', 'AVG'):
+        specs.append(_OpSpec(
+            'pooling2d_{}'.format(method.lower()), lambda x, method=method: opr.pooling2d(x, 2, method=method),
+            lambda rng, dtype, s: [_randn(rng, s, dtype)],
+            [('64x16x24x24_k2', ((64, 16, 24, 24), ))], dtypes=('float32', )))
+    for name, fn in (('reduce_sum', opr.reduce_sum), ('reduce_max', opr.reduce_max),
+                     ('reduce_min', opr.reduce_min)):
+        specs.append(_OpSpec(
+            name, lambda x, fn=fn: fn(x, axis=1, keepdims=False), lambda rng, dtype, s: [_randn(rng, s, dtype)],
+            [('512x512_axis1', ((512, 512), ))]))
+    return specs
+
+
+def get_op_cases(quick=False):
+    """The microbenchmarks of the operators of `kaleido.opr`, forward and backward, over a grid of shapes
+    and dtypes (only the first point of each grid if `quick`)."""
+    for spec in _get_specs():
+        yield from spec.get_cases(quick)
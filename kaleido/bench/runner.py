@@ -0,0 +1,97 @@
+# -*- coding:utf8 -*-
+# File   : runner.py
+# Author : Jiayuan Mao
+# Email  : maojiayuan@gmail.com
+# Date   : 10/22/26 20:50
+#
+# This file is part of Kaleido
+# (c) 2016 vccy.xyz
+
+import fnmatch
+import json
+import os
+import platform
+import sys
+import time
+import traceback
+
+import numpy as np
+
+from .timer import measure
+from .ops import get_op_cases
+from .e2e import get_e2e_cases
+
+__all__ = ['get_cases', 'run_benchmarks', 'save_results', 'load_results', 'compare_results']
+
+
+def get_cases(suites=('ops', 'e2e'), quick=False, pattern=None):
+    cases = []
+    if 'ops' in suites:
+        cases.extend(get_op_cases(quick))
+    if 'e2e' in suites:
+        cases.extend(get_e2e_cases(quick))
+    if pattern is not None:
+        cases = [c for c in cases if fnmatch.fnmatch(c.name, pattern)]
+    return cases
+
+
+def _get_meta():
+    from ..threads import get_nr_threads
+    return {
+        'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'python': sys.version.split()[0],
+        'numpy': np.__version__,
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'nr_threads': get_nr_threads(),
+    }
+
+
+def run_benchmarks(cases, nr_runs=20, nr_warmup=2, log=None):
+    """Run the benchmark cases and return the results: metadata and, by case name, the timings of `measure`
+    or the error the case raised."""
+    results = {}
+    for case in cases:
+        try:
+            fn = case.make()
+            res = measure(fn, nr_runs=nr_runs, nr_warmup=nr_warmup)
+        except Exception:
+            res = {'error': traceback.format_exc(limit=3)}
+        results[case.name] = res
+        if log is not None:
+            log(_format_result(case.name, res))
+    return {'meta': _get_meta(), 'results': results}
+
+
+def _format_result(name, res):
+    if 'error' in res:
+        return '{:<60s} ERROR {}'.format(name, res['error'].strip().splitlines()[-1])
+    return '{:<60s} median {:10.3f} ms  p95 {:10.3f} ms  peak {:10.1f} KiB'.format(
+        name, res['median'] * 1e3, res['p95'] * 1e3, res['peak_bytes'] / 1024)
+
+
+def save_results(path, results):
+    with open(path, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+
+
+def load_results(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def compare_results(baseline, current, threshold=0.1, key='median'):
+    """Compare the timings `key` of the cases in both results. Returns (rows, regressions): one row
+    (name, baseline, current, ratio) per common case, and the names of the cases slower than the baseline
+    by more than `threshold` (relative)."""
+    base, cur = baseline['results'], current['results']
+    rows, regressions = [], []
+    for name in sorted(set(base) & set(cur)):
+        if 'error' in base[name] or 'error' in cur[name]:
+            continue
+        b, c = base[name][key], cur[name][key]
+        ratio = c / b if b > 0 else float('inf')
+        rows.append((name, b, c, ratio))
+        if ratio > 1 + threshold:
+            regressions.append(name)
+    return rows, regressions
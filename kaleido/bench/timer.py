@@ -0,0 +1,52 @@
+# -*- coding:utf8 -*-
+# File   : timer.py
+# Author : Jiayuan Mao
+# Email  : maojiayuan@gmail.com
+# Date   : 10/22/26 19:20
+#
+# This file is part of Kaleido
+# (c) 2016 vccy.xyz
+
+import time
+import tracemalloc
+
+import numpy as np
+
+__all__ = ['measure']
+
+
+def measure(fn, nr_runs=20, nr_warmup=2):
+    """Time `nr_runs` calls of `fn` after `nr_warmup` untimed ones, and measure the peak of the memory
+    allocated during one more call (NumPy buffers included, through tracemalloc).
+
+    Returns a dict of seconds (median, p95, mean, min), the number of runs and the peak bytes.
+    """
+    for _ in range(nr_warmup):
+        fn()
+
+    times = []
+    for _ in range(nr_runs):
+        t = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - t)
+
+    # a separate call: tracing slows the allocations down
+    was_tracing = tracemalloc.is_tracing()
+    if not was_tracing:
+        tracemalloc.start()
+    tracemalloc.reset_peak()
+    base = tracemalloc.get_traced_memory()[0]
+    fn()
+    peak = tracemalloc.get_traced_memory()[1] - base
+    if not was_tracing:
+        tracemalloc.stop()
+
+    times = np.array(times)
+    return {
+        'median': float(np.median(times)),
+        'p95': float(np.percentile(times, 95)),
+        'mean': float(times.mean()),
+        'min': float(times.min()),
+        'nr_runs': nr_runs,
+        'peak_bytes': int(max(peak, 0)),
+    }
@@ -0,0 +1,10 @@
+# -*- coding:utf8 -*-
+# File   : __init__.py
+# Author : Jiayuan Mao
+# Email  : maojiayuan@gmail.com
+# Date   : 10/20/26 15:10
+#
+# This file is part of Kaleido
+# (c) 2016 vccy.xyz
+
+from .loader import MinibatchLoader
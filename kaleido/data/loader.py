@@ -0,0 +1,143 @@
+# -*- coding:utf8 -*-
+# File   : loader.py
+# Author : Jiayuan Mao
+# Email  : maojiayuan@gmail.com
+# Date   : 10/20/26 15:10
+#
+# This file is part of Kaleido
+# (c) 2016 vccy.xyz
+
+import threading
+
+import numpy as np
+
+
+class _Epoch(object):
+    """Shared state of the prefetch threads of one pass over the data."""
+
+    def __init__(self, batches, nr_buffers):
+        self.batches = batches
+        self.cond = threading.Condition()
+        self.free = list(range(nr_buffers))
+        self.next_batch = 0
+        self.ready = {}
+        self.error = None
+        self.stopped = False
+
+
+class MinibatchLoader(object):
+    """Iterates over minibatches of a dict of arrays, as feed dicts for the keyword interface of `Function`.
+
+    The sources are cast to `dtypes` (a dtype, or a dict from name to dtype) and made contiguous once, at
+    construction. Each pass shuffles the samples (with `shuffle`) and `nr_workers` background threads
+    gather the batches into a ring of preallocated destination arrays, at most `nr_prefetch` batches ahead
+    of the consumer. The arrays of a batch are recycled when the next batch is requested, so copy anything
+    that must outlive the step.
+    """
+
+    def __init__(self, data, batch_size, shuffle=True, drop_last=True, dtypes=None,
+                 nr_workers=1, nr_prefetch=2, seed=None):
+        assert len(data) != 0 and batch_size > 0 and nr_workers > 0 and nr_prefetch > 0
+
+        self._sources = {}
+        for name, value in data.items():
+            dtype = dtypes.get(name) if isinstance(dtypes, dict) else dtypes
+            self._sources[name] = np.ascontiguousarray(value, dtype=dtype)
+        lengths = {len(v) for v in self._sources.values()}
+        assert len(lengths) == 1, 'inputs have different numbers of samples'
+
+        self._nr_samples = lengths.pop()
+        self._batch_size = batch_size
+        self._shuffle = shuffle
+        self._drop_last = drop_last
+        self._nr_workers = nr_workers
+        self._nr_prefetch = nr_prefetch
+        self._rng = np.random.RandomState(seed)
+        # the batch held by the consumer plus the prefetched ones
+        self._buffers = [{name: np.empty((batch_size, ) + v.shape[1:], dtype=v.dtype)
+                          for name, v in self._sources.items()} for _ in range(nr_prefetch + 1)]
+
+    @property
+    def batch_size(self):
+        return self._batch_size
+
+    @property
+    def nr_samples(self):
+        return self._nr_samples
+
+    def __len__(self):
+        if self._drop_last:
+            return self._nr_samples // self._batch_size
+        return (self._nr_samples + self._batch_size - 1) // self._batch_size
+
+    def _get_batches(self):
+        bs = self._batch_size
+        if not self._shuffle:
+            return [slice(i * bs, min((i + 1) * bs, self._nr_samples)) for i in range(len(self))]
+        perm = self._rng.permutation(self._nr_samples)
+        # sorted indices within a batch gather with better locality
+        return [np.sort(perm[i * bs:(i + 1) * bs]) for i in range(len(self))]
+
+    def _fill(self, batch, slot):
+        buf = self._buffers[slot]
+        for name, src in self._sources.items():
+            if isinstance(batch, slice):
+                n = batch.stop - batch.start
+                np.copyto(buf[name][:n], src[batch])
+            else:
+                n = len(batch)
+                np.take(src, batch, axis=0, out=buf[name][:n])
+        return {name: b[:n] if n != self._batch_size else b for name, b in buf.items()}
+
+    def _worker(self, epoch):
+        while True:
+            with epoch.cond:
+                while not epoch.stopped and len(epoch.free) == 0:
+                    epoch.cond.wait()
+                if epoch.stopped or epoch.next_batch == len(epoch.batches):
+                    return
+                # slots are taken in batch order, so the batch the consumer waits for always has one
+                idx, slot = epoch.next_batch, epoch.free.pop()
+                epoch.next_batch += 1
+
+            try:
+                feeds = self._fill(epoch.batches[idx], slot)
+            except BaseException as e:
+                with epoch.cond:
+                    epoch.error = e
+                    epoch.cond.notify_all()
+                return
+
+            with epoch.cond:
+                epoch.ready[idx] = (slot, feeds)
+                epoch.cond.notify_all()
+
+    def __iter__(self):
+        batches = self._get_batches()
+        epoch = _Epoch(batches, len(self._buffers))
+        # a free slot more than the prefetch depth stays for the batch held by the consumer
+        epoch.free = epoch.free[:self._nr_prefetch]
+        threads = [threading.Thread(target=self._worker, args=(epoch, ), daemon=True)
+                   for _ in range(self._nr_workers)]
+        for t in threads:
+            t.start()
+
+        held = len(self._buffers) - 1
+        try:
+            for idx in range(len(batches)):
+                with epoch.cond:
+                    # hand the slot of the previous batch back to the workers
+                    epoch.free.append(held)
+                    epoch.cond.notify_all()
+                    while idx not in epoch.ready and epoch.error is None:
+                        epoch.cond.wait()
+                    if epoch.error is not None:
+                        raise epoch.error
+                    held, feeds = epoch.ready.pop(idx)
+                yield feeds
+        finally:
+            with epoch.cond:
+                epoch.stopped = True
+                epoch.cond.notify_all()
+            for t in threads:
+                t.join()
@@ -8,3 +8,12 @@
 # (c) 2016 vccy.xyz
 
 from .fprop import Function, CompGraph
+from .hook import FunctionHook
+from .profile import Profiler
+from .memory import MemoryTracker
+from .env import Env
+from .frame import Frame
+from .sparse import SparseGrad
+from .arena import BufferArena
+from .serialize import save_graph, load_graph, save_params, load_params
+from .policy import DTypePolicy
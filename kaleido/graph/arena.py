@@ -0,0 +1,67 @@
+# -*- coding:utf8 -*-
+# File   : arena.py
+# Author : Jiayuan Mao
+# Email  : maojiayuan@gmail.com
+# Date   : 10/19/26 10:20
+#
+# This file is part of Kaleido
+# (c) 2016 vccy.xyz
+
+import math
+import sys
+import threading
+
+import numpy as np
+
+
+def _scan_refcount(buffers):
+    for buf in buffers:
+        return sys.getrefcount(buf)
+
+
+# refcount seen by BufferArena.alloc for a buffer that nobody but the arena refers to
+_FREE_REFCOUNT = _scan_refcount([np.empty(1)])
+
+
+class BufferArena(object):
+    """Shape/dtype keyed pool of output buffers, kept across calls.
+
+    A buffer is handed out again once nothing but the arena refers to it: values released by the memory
+    planner, or dropped by the caller, become reusable, while a buffer still held anywhere (a var, a
+    returned output, or a view of it, since views keep their base alive) is never recycled.
+    Arrays smaller than `min_nbytes` are not pooled.
+    """
+
+    def __init__(self, min_nbytes=4096, max_buffers_per_key=8):
+        self._min_nbytes = min_nbytes
+        self._max_buffers_per_key = max_buffers_per_key
+        self._buffers = {}
+        self._lock = threading.Lock()
+        self.nr_allocs = 0
+        self.nr_reuses = 0
+
+    @property
+    def nbytes(self):
+        return sum(buf.nbytes for bufs in self._buffers.values() for buf in bufs)
+
+    def alloc(self, shape, dtype):
+        dtype = np.dtype(dtype)
+        if math.prod(shape) * dtype.itemsize < self._min_nbytes:
+            return np.empty(shape, dtype=dtype)
+
+        key = (tuple(shape), dtype)
+        with self._lock:
+            bufs = self._buffers.setdefault(key, [])
+            for buf in bufs:
+                if sys.getrefcount(buf) == _FREE_REFCOUNT:
+                    self.nr_reuses += 1
+                    return buf
+
+            self.nr_allocs += 1
+            buf = np.empty(shape, dtype=dtype)
+            if len(bufs) < self._max_buffers_per_key:
+                bufs.append(buf)
+            return buf
+
+    def clear(self):
+        self._buffers.clear()
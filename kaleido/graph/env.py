@@ -0,0 +1,53 @@
+# -*- coding:utf8 -*-
+# File   : env.py
+# Author : Jiayuan Mao
+# Email  : maojiayuan@gmail.com
+# Date   : 10/19/26 10:20
+#
+# This file is part of Kaleido
+# (c) 2016 vccy.xyz
+
+from .arena import BufferArena
+
+
+class Env(object):
+    """The `env` handed to every opr's fprop and bprop by the executor."""
+
+    def __init__(self, arena=None, dtype_policy=None, training=True):
+        self._arena = arena if arena is not None else BufferArena()
+        self._dtype_policy = dtype_policy
+        self._training = training
+        self._compute_dtype_oprs = frozenset()
+
+    @property
+    def arena(self):
+        return self._arena
+
+    @property
+    def dtype_policy(self):
+        return self._dtype_policy
+
+    @dtype_policy.setter
+    def dtype_policy(self, policy):
+        self._dtype_policy = policy
+
+    @property
+    def compute_dtype_oprs(self):
+        """The elementwise oprs whose outputs stay in the compute dtype under a storage dtype (e.g. losses)."""
+        return self._compute_dtype_oprs
+
+    @compute_dtype_oprs.setter
+    def compute_dtype_oprs(self, oprs):
+        self._compute_dtype_oprs = frozenset(oprs)
+
+    @property
+    def training(self):
+        """False when no bprop will follow the fprop, so oprs need not keep state for it."""
+        return self._training
+
+    @training.setter
+    def training(self, training):
+        self._training = training
+
+    def alloc(self, shape, dtype):
+        return self._arena.alloc(shape, dtype)
@@ -0,0 +1,158 @@
+# -*- coding:utf8 -*-
+# File   : executor.py
+# Author : Jiayuan Mao
+# Email  : maojiayuan@gmail.com
+# Date   : 10/19/26 18:40
+#
+# This file is part of Kaleido
+# (c) 2016 vccy.xyz
+
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from .node import VarNode
+
+
+def _step_access(step):
+    """Return the resources a step reads and writes. Resources are ('v', var) for a value, ('g', var) for a
+    grad and ('o', opr) for the per-call state an opr keeps between fprop and bprop."""
+    from ..opr.grad import Gradient
+
+    opr = step.opr
+    reads, writes = [], []
+
+    if step.phase == 'label_wrts':
+        loss = step.grads[0]
+        reads.append(('v', loss))
+        writes.extend(('g', v) for v in step.fn.args[0].zero_vars)
+    elif len(step.grads) != 0:  # bprop
+        reads.extend(('v', v) for v in opr.inputs)
+        reads.extend(('v', v) for v in opr.outputs)
+        reads.extend(('g', v) for v in opr.outputs)
+        reads.append(('o', opr))
+        # grads are accumulated, so a bprop both reads and writes them
+        reads.extend(('g', v) for v in step.grads)
+        writes.extend(('g', v) for v in step.grads)
+    else:
+        reads.extend(('v', v) for v in opr.inputs)
+        if isinstance(opr, Gradient):
+            reads.append(('g', opr.inputs[1]))
+        writes.extend(('v', v) for v in opr.outputs)
+        # oprs updating an input in place also write its value
+        writes.extend(('v', opr.inputs[i]) for i in getattr(opr, '__inplace_inputs__', ()))
+        writes.append(('o', opr))
+
+    for f in step.frees:
+        if f.__func__ is VarNode.clear_value:
+            writes.append(('v', f.__self__))
+        elif f.__func__ is VarNode.clear_grad:
+            writes.append(('g', f.__self__))
+        else:
+            writes.append(('o', f.__self__))
+    return reads, writes
+
+
+def build_step_dependencies(steps):
+    """Dependency edges between the steps of a plan, from read-after-write, write-after-read and
+    write-after-write hazards in the sequential order. Two steps touching the same resource keep their
+    sequential order, so grad accumulation and releases happen in the same order on every run."""
+    last_writer = {}
+    readers = {}
+    preds = [set() for _ in steps]
+
+    for idx, step in enumerate(steps):
+        reads, writes = _step_access(step)
+        for r in reads:
+            if r in last_writer:
+                preds[idx].add(last_writer[r])
+        for w in writes:
+            if w in last_writer:
+                preds[idx].add(last_writer[w])
+            for j in readers.get(w, ()):
+                preds[idx].add(j)
+        for r in reads:
+            readers.setdefault(r, []).append(idx)
+        for w in writes:
+            last_writer[w] = idx
+            readers[w] = []
+        preds[idx].discard(idx)
+
+    succs = [[] for _ in steps]
+    for idx, ps in enumerate(preds):
+        for j in ps:
+            succs[j].append(idx)
+    return [len(ps) for ps in preds], succs
+
+
+class ParallelExecutor(object):
+    """Runs the steps of a plan on a thread pool as soon as the steps they depend on are done.
+
+    NumPy releases the GIL inside most kernels, so independent branches of a graph (or the per-parameter
+    update oprs) overlap. The results do not depend on the scheduling order.
+    """
+
+    def __init__(self, plan, nr_threads):
+        assert nr_threads >= 1
+        self._steps = plan.steps
+        self._nr_threads = nr_threads
+        self._nr_deps, self._succs = build_step_dependencies(self._steps)
+        self._roots = [idx for idx, n in enumerate(self._nr_deps) if n == 0]
+        self._pool = None
+        # calls from several threads share the pool
+        self._lock = threading.Lock()
+
+    @property
+    def nr_threads(self):
+        return self._nr_threads
+
+    def _get_pool(self):
+        with self._lock:
+            if self._pool is None:
+                self._pool = ThreadPoolExecutor(max_workers=self._nr_threads, thread_name_prefix='kaleido')
+            return self._pool
+
+    def run(self, env, frame):
+        """Run the steps of one call, whose state is `frame`."""
+        steps, succs = self._steps, self._succs
+        nr_deps = list(self._nr_deps)
+        pool = self._get_pool()
+        done = queue.SimpleQueue()
+
+        def work(idx):
+            try:
+                _, _, fn, _, _, frees = steps[idx]
+                with frame:
+                    fn(env)
+                    for f in frees:
+                        f()
+                done.put((idx, None))
+            except BaseException as e:
+                done.put((idx, e))
+
+        for idx in self._roots:
+            pool.submit(work, idx)
+        nr_pending = len(self._roots)
+
+        error = None
+        while nr_pending != 0:
+            idx, e = done.get()
+            nr_pending -= 1
+            if e is not None:
+                error = error or e
+                continue
+            if error is not None:
+                continue
+            for j in succs[idx]:
+                nr_deps[j] -= 1
+                if nr_deps[j] == 0:
+                    pool.submit(work, j)
+                    nr_pending += 1
+
+        if error is not None:
+            raise error
+
+    def shutdown(self):
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
@@ -9,43 +9,154 @@
 
 from collections import deque
 
+import numpy as np
+
+from .env import Env
+from .frame import Frame
+from .node import as_numpy_array
+from .executor import ParallelExecutor
+from .fusion import find_elemwise_groups, rewrite_oprs, rewrite_backward_schedule
+from .plan import ExecutionPlan, BackwardSchedule
+from .policy import as_dtype_policy, apply_cast
+
 
 class Function(object):
+    """A compiled graph. Every call runs in its own `Frame`, so a function may be called from several threads
+    at once (hooks excepted), and functions sharing vars do not interfere."""
+
     def __init__(self, outputs, comp_graph):
         self._outputs = outputs
         self._cg = comp_graph
+        self._plan = comp_graph.plan
+        self._hooks = []
+        self._executor = None
+        # outputs stored in the storage dtype of the dtype policy are returned in its compute dtype
+        policy = comp_graph.dtype_policy
+        self._storage_dtype = None if policy is None else policy.storage_dtype
+        if comp_graph.nr_threads > 1:
+            self._executor = ParallelExecutor(self._plan, comp_graph.nr_threads)
 
-    def __call__(self, *args, **kwargs):
-        cg = self._cg
+    @property
+    def plan(self):
+        return self._plan
 
-        from ..opr.netsrc import PlaceHolder
+    @property
+    def mode(self):
+        return self._cg.mode
 
-        for opr in cg.all_oprs:
-            for o in opr.outputs:
-                o.clear_state()
-            if isinstance(opr, PlaceHolder):
-                assert opr.name in kwargs, 'missing input value for {}'.format(opr.name)
-                opr.set_value(kwargs[opr.name])
+    @property
+    def hooks(self):
+        return tuple(self._hooks)
 
-        for opr in cg.oprs_pre_grad:
-            opr.fprop(cg.env)
-        for loss, grad_oprs in cg.grad_wrts.items():
-            rel_oprs = cg.label_wrts(loss)
+    def add_hook(self, hook):
+        self._hooks.append(hook)
+        return hook
 
-            loss.set_or_accumulate_grad(1)
-            for opr in reversed(rel_oprs):
-                opr.bprop(cg.env)
-            for gopr in grad_oprs:
-                gopr.fprop(cg.env)
-        for opr in cg.oprs_post_grad:
-            opr.fprop(cg.env)
+    def remove_hook(self, hook):
+        self._hooks.remove(hook)
 
-        return [o.get_value() for o in self._outputs]
+    def __call__(self, *args, **kwargs):
+        if len(self._hooks) != 0:
+            return self._call_hooked(kwargs)
+
+        with self.new_frame() as frame:
+            self.feed(kwargs)
+            if self._executor is not None:
+                self._executor.run(self._cg.env, frame)
+            else:
+                self.run_steps()
+            return self.get_outputs()
+
+    def new_frame(self):
+        """An empty frame for one call, but for the frozen values of inference mode."""
+        return Frame(dict(self._plan.constants))
+
+    # The parts of a call, for the callers running its phases apart (e.g. `DataParallelTrainer`). They work
+    # in the current frame, so a call is made inside `with func.new_frame():`, and skip the hooks.
+
+    def feed(self, feeds):
+        """Set the values of the placeholders from the dict `feeds`, by name."""
+        for name, opr in self._plan.placeholders:
+            assert name in feeds, 'missing input value for {}'.format(name)
+            opr.set_value(feeds[name])
+
+    def run_steps(self, begin=0, end=None):
+        """Run `plan.steps[begin:end]` in order."""
+        env = self._cg.env
+        for _, _, fn, _, _, frees in self._plan.steps[begin:end]:
+            fn(env)
+            for f in frees:
+                f()
+
+    def run_grad_phases(self):
+        """Run the forward and backward phases, up to the values of the `grad` oprs."""
+        self.run_steps(0, self._plan.post_grad_begin)
+
+    def run_post_grad(self):
+        """Run what depends on the grads (e.g. the updates)."""
+        self.run_steps(self._plan.post_grad_begin)
+
+    def get_outputs(self, idxes=None):
+        """The values of the outputs, or of the outputs at `idxes` if given."""
+        varnodes, outputs = self._plan.varnodes, self._plan.outputs
+        if idxes is not None:
+            outputs = [outputs[i] for i in idxes]
+        return [self._as_output(varnodes[i].get_value()) for i in outputs]
+
+    def _as_output(self, value):
+        if self._storage_dtype is not None and value.dtype == self._storage_dtype:
+            return value.astype(self._cg.dtype_policy.dtype)
+        return value
+
+    def _call_hooked(self, kwargs):
+        # hooks always see the steps one at a time, in the sequential order
+        hooks = self._hooks
+        for h in hooks:
+            h.on_call_begin(self)
+
+        with self.new_frame():
+            outputs = self._run_hooked(kwargs)
+
+        for h in hooks:
+            h.on_call_end(self)
+        return outputs
+
+    def _run_hooked(self, kwargs):
+        plan = self._plan
+        env = self._cg.env
+        hooks = self._hooks
+
+        for name, opr in plan.placeholders:
+            assert name in kwargs, 'missing input value for {}'.format(name)
+            for h in hooks:
+                h.on_opr_begin('feed', opr)
+            opr.set_value(kwargs[name])
+            nbytes = getattr(kwargs[name], 'nbytes', 0)
+            for h in hooks:
+                h.on_opr_end('feed', opr, nbytes)
+
+        for phase, opr, fn, values, grads, frees in plan.steps:
+            for h in hooks:
+                h.on_opr_begin(phase, opr)
+            fn(env)
+            nbytes = sum(v.get_value(allow_sparse=True).nbytes for v in values) + \
+                sum(v.get_grad(allow_sparse=True).nbytes for v in grads)
+            for f in frees:
+                f()
+            for h in hooks:
+                h.on_opr_end(phase, opr, nbytes)
+
+        return self.get_outputs()
 
 
 class CompGraph(object):
-    def __init__(self, env=None):
-        self._env = None
+    def __init__(self, env=None, dtype_policy=None):
+        self._dtype_policy = as_dtype_policy(dtype_policy)
+        if env is None:
+            env = Env(dtype_policy=self._dtype_policy)
+        elif self._dtype_policy is not None:
+            env.dtype_policy = self._dtype_policy
+        self._env = env
 
         self._outputs = None
         self._all_oprs = None
@@ -54,6 +165,14 @@ class CompGraph(object):
         self._grad_oprs = []
         self._grad_wrts = {}
         self._out_edges = None
+        self._backward_schedules = None
+        self._fused_oprs = []
+        self._folded_oprs = {}
+        self._substitutes = {}
+        self._casts = {}
+        self._plan = None
+        self._nr_threads = 1
+        self._mode = 'train'
 
         self._compiled = False
 
@@ -61,6 +180,10 @@ class CompGraph(object):
     def env(self):
         return self._env
 
+    @property
+    def dtype_policy(self):
+        return self._dtype_policy
+
     @property
     def outputs(self):
         return self._outputs
@@ -85,18 +208,93 @@ class CompGraph(object):
     def oprs_post_grad(self):
         return self._oprs_post_grad
 
+    @property
+    def out_edges(self):
+        return self._out_edges
+
+    @property
+    def fused_oprs(self):
+        return self._fused_oprs
+
+    @property
+    def folded_oprs(self):
+        return self._folded_oprs
+
+    @property
+    def substitutes(self):
+        """The oprs replaced by the pattern rewrite, mapped to the oprs computing their outputs instead."""
+        return self._substitutes
+
+    @property
+    def casts(self):
+        """The casts of the dtype policy, as (dtype, kinds) pairs by var, see `apply_cast`."""
+        return self._casts
+
+    def get_owner_opr(self, var):
+        """The opr computing `var` in the compiled graph."""
+        opr = var.owner_opr
+        return self._substitutes.get(opr, opr)
+
+    @property
+    def backward_schedules(self):
+        return self._backward_schedules
+
+    @property
+    def plan(self):
+        return self._plan
+
+    @property
+    def nr_threads(self):
+        return self._nr_threads
+
+    @property
+    def mode(self):
+        return self._mode
+
     @property
     def compiled(self):
         return self._compiled
 
-    def compile(self, outputs):
+    def compile(self, outputs, release_intermediates=True, fuse_elemwise=False, nr_threads=1, mode='train',
+                rewrite_patterns=True):
+        """Compile the graph computing `outputs` into a `Function`.
+
+        With `rewrite_patterns`, known compositions of oprs are replaced by fused oprs: the cross entropy of
+        a softmax written with exp, reduce_sum, div, log and index_onehot becomes `softmax_cross_entropy`.
+
+        With `fuse_elemwise`, chains of elementwise oprs run as `FusedElemwise` oprs, chunk by chunk. It is
+        off by default: the chunked evaluation calls the NumPy kernels once per chunk, and on large arrays it
+        is not faster than the unfused oprs.
+
+        With `mode='inference'` the graph may not take grads nor update parameters: the values of the
+        parameters are frozen at compile time, every opr computable from parameters and constants alone
+        is evaluated once, and a call only runs the oprs depending on the fed inputs. Compile again to
+        pick up new parameter values.
+        """
         assert not self.compiled, 'can not compile a comp_graph twice'
+        assert mode in ('train', 'inference'), 'unknown compile mode {}'.format(mode)
 
+        self._mode = mode
+        self._env.training = mode == 'train'
         self._outputs = outputs
         self._all_oprs, self._out_edges = TopoSorter(outputs).sort()
+        if mode == 'inference':
+            self._check_inference_oprs()
         self._check_grad_dependency()
         self._find_grad_oprs()
+        if rewrite_patterns:
+            self._rewrite_patterns()
         self._split_oprs()
+        if self._dtype_policy is not None:
+            self._apply_dtype_policy()
+        self._infer_static()
+        self._fold_constants()
+        self._build_backward_schedules()
+        if fuse_elemwise:
+            self._fuse_elemwise()
+        self._plan = ExecutionPlan.build(self, release_intermediates=release_intermediates)
+        self._nr_threads = nr_threads
+        self._compiled = True
 
         return Function(outputs, self)
 
@@ -111,6 +309,15 @@ class CompGraph(object):
         all_oprs, _ = TopoSorter(outputs).sort()
         return all_oprs
 
+    def _check_inference_oprs(self):
+        from ..opr.grad import Gradient
+        from ..opr.arith import Update
+        from ..opr.optim import ApplyUpdate
+
+        for opr in self._all_oprs:
+            assert not isinstance(opr, (Gradient, Update, ApplyUpdate)), \
+                'opr {} is not allowed in inference mode'.format(opr)
+
     def _check_grad_dependency(self):
         from ..opr.grad import Gradient
 
@@ -135,73 +342,231 @@ class CompGraph(object):
                 self._grad_wrts[o.inputs[0]].append(o)
                 self._grad_oprs.append(o)
 
+    def _sort(self, targets, initial_visited=None):
+        return TopoSorter(targets, initial_visited, substitutes=self._substitutes).sort()
+
+    def _rewrite_patterns(self):
+        from ..opr.loss import FusedSoftmaxCrossEntropy
+        from .fusion import find_softmax_cross_entropy
+
+        wrts = {opr.inputs[1] for opr in self._grad_oprs}
+        for opr, logits, labels, axis in find_softmax_cross_entropy(self._all_oprs, wrts):
+            self._substitutes[opr] = FusedSoftmaxCrossEntropy(opr.outputs[0], logits, labels, axis)
+        if len(self._substitutes) != 0:
+            self._all_oprs, self._out_edges = self._sort(self._outputs)
+
     def _split_oprs(self):
-        self._oprs_pre_grad, _ = TopoSorter(list(self._grad_wrts)).sort()
+        self._oprs_pre_grad, _ = self._sort(list(self._grad_wrts))
         for loss in self._grad_wrts:
-            wrts = [opr.inputs[1].owner_opr for opr in self._grad_wrts[loss]]
-            all_deps, _ = TopoSorter([loss]).sort()
+            wrts = [self.get_owner_opr(opr.inputs[1]) for opr in self._grad_wrts[loss]]
+            all_deps, _ = self._sort([loss])
             all_deps = {opr for opr in all_deps}
             for wrt in wrts:
                 assert wrt in all_deps, 'loss {} does not depend on w.r.t. value {}'.format(loss, wrt)
-        self._oprs_post_grad, _ = TopoSorter(self._outputs, self._oprs_pre_grad + self._grad_oprs).sort()
+        self._oprs_post_grad, _ = self._sort(self._outputs, self._oprs_pre_grad + self._grad_oprs)
 
-    def label_wrts(self, loss):
-        assert len(loss.get_value().shape) == 1 and loss.get_value().shape[0] == 1, \
-            'only support compute grad of a scalar, got {}'.format(loss.get_value().shape)
+    def _apply_dtype_policy(self):
+        from ..opr.arith import ElemwiseOprNodeBase
+        from ..opr.netsrc import Parameter, Immutable, PlaceHolder
 
+        dtype = self._dtype_policy.dtype
+        for opr in self._all_oprs:
+            if not isinstance(opr, (Parameter, Immutable, PlaceHolder)):
+                continue
+            if isinstance(opr, PlaceHolder) and opr.dtype is not None:
+                continue
+            consumers = self._out_edges.get(opr.outputs[0], [])
+            # integral values only read by elementwise oprs are plain numbers, the other ones may be indices
+            if isinstance(opr, Parameter) or all(isinstance(c, ElemwiseOprNodeBase) for c in consumers):
+                kinds = 'biuf'
+            else:
+                kinds = 'f'
+            self._casts[opr.outputs[0]] = (dtype, kinds)
+            if isinstance(opr, Parameter) and self._mode == 'train' and not opr.pinned:
+                # converted once rather than cast at every call, so the updates also run in `dtype`
+                value = as_numpy_array(opr.get_value())
+                converted = apply_cast(value, self._casts[opr.outputs[0]])
+                if converted is not value:
+                    opr.set_value(converted)
+
+        self._env.compute_dtype_oprs = [self.get_owner_opr(loss) for loss in self._grad_wrts
+                                        if isinstance(self.get_owner_opr(loss), ElemwiseOprNodeBase)]
+
+    def _cast_value(self, var, value):
+        cast = self._casts.get(var)
+        return value if cast is None else apply_cast(value, cast)
+
+    def _infer_static(self):
         for opr in self._all_oprs:
+            opr.infer_static()
             for o in opr.outputs:
-                o.clear_grad()
+                cast = self._casts.get(o)
+                if cast is not None and o.static_dtype is not None and o.static_dtype.kind in cast[1]:
+                    o.set_static_info(o.static_shape, cast[0])
+
+    def _fold_constants(self):
+        from ..opr.netsrc import FoldedConstant
+
+        if self._mode == 'inference':
+            values = self._eval_frozen()
+        else:
+            values = {}
+            for opr in self._all_oprs:
+                if len(opr.inputs) == 0 or len(opr.outputs) != 1 or opr.outputs[0] in self._grad_wrts:
+                    continue
+                value = opr.get_static_value()
+                if value is not None:
+                    values[opr] = value
+        for opr, value in values.items():
+            self._folded_oprs[opr] = FoldedConstant(opr.outputs[0], value)
+        if len(self._folded_oprs) == 0:
+            return
 
-        wrts = [opr.inputs[1] for opr in self._grad_wrts[loss]]
-        all_oprs, out_edges = TopoSorter([loss], list({wrt.owner_opr for wrt in wrts})).sort()
+        # oprs only read by folded ones are no longer needed
+        live = self._find_ancestors(self._outputs)
+        if self._mode == 'inference':
+            self._folded_oprs = {opr: f for opr, f in self._folded_oprs.items() if opr in live}
 
+        def rewrite(oprs):
+            return [self._folded_oprs.get(opr, opr) for opr in oprs if opr in live]
+
+        self._all_oprs = rewrite(self._all_oprs)
+        self._oprs_pre_grad = rewrite(self._oprs_pre_grad)
+        self._oprs_post_grad = rewrite(self._oprs_post_grad)
+        for consumers in self._out_edges.values():
+            consumers[:] = [opr for opr in consumers if opr in live and opr not in self._folded_oprs]
+
+    def _eval_frozen(self):
+        """The output values of the oprs computable at compile time when parameters are frozen: the sources
+        other than placeholders (the values of parameters being copied) and the oprs reading only such
+        values, run once here."""
+        from ..opr.netsrc import PlaceHolder
+
+        env = Env(dtype_policy=self._dtype_policy, training=False)
+        values = {}
+        known = {}
+        for opr in self._all_oprs:
+            if isinstance(opr, PlaceHolder) or len(opr.outputs) != 1:
+                continue
+            value = opr.get_static_value()
+            if len(opr.inputs) == 0:
+                if value is None:
+                    value = np.array(as_numpy_array(opr.get_value()))
+                value = self._cast_value(opr.outputs[0], value)
+            elif value is None and all(i in known for i in opr.inputs):
+                with Frame({i: known[i] for i in opr.inputs}):
+                    opr.fprop(env)
+                    value = opr.outputs[0].get_value()
+            if value is not None:
+                values[opr] = known[opr.outputs[0]] = value
+        return values
+
+    def _find_ancestors(self, outputs):
+        """The oprs the outputs depend on, not looking through folded oprs."""
         visited = set()
+        stack = [self.get_owner_opr(o) for o in outputs]
+        while len(stack) != 0:
+            opr = stack.pop()
+            if opr in visited:
+                continue
+            visited.add(opr)
+            if opr not in self._folded_oprs:
+                stack.extend(self.get_owner_opr(i) for i in opr.inputs)
+        return visited
+
+    def _fuse_elemwise(self):
+        from ..opr.fused import FusedElemwise
+
+        keep = set(self._outputs) | set(self._grad_wrts)
+        phase_of = {opr: 'pre_grad' for opr in self._oprs_pre_grad}
+        phase_of.update({opr: 'post_grad' for opr in self._oprs_post_grad})
+
+        fused_of = {}
+        for group in find_elemwise_groups(self._all_oprs, self._out_edges, keep, phase_of):
+            fused = FusedElemwise(group)
+            self._fused_oprs.append(fused)
+            for opr in group:
+                fused_of[opr] = fused
+        if len(fused_of) == 0:
+            return
+
+        self._all_oprs = rewrite_oprs(self._all_oprs, fused_of)
+        self._oprs_pre_grad = rewrite_oprs(self._oprs_pre_grad, fused_of)
+        self._oprs_post_grad = rewrite_oprs(self._oprs_post_grad, fused_of)
+        for loss, sched in self._backward_schedules.items():
+            self._backward_schedules[loss] = rewrite_backward_schedule(sched, fused_of)
+
+    def _build_backward_schedules(self):
+        self._backward_schedules = {}
+        for loss, grad_oprs in self._grad_wrts.items():
+            self._backward_schedules[loss] = self._make_backward_schedule(loss, grad_oprs)
+
+    def _make_backward_schedule(self, loss, grad_oprs):
+        wrts = [opr.inputs[1] for opr in grad_oprs]
+        all_oprs, out_edges = self._sort([loss], list({self.get_owner_opr(wrt) for wrt in wrts}))
+
+        need_grad = set()
         queue = deque()
         for v in wrts:
-            v.need_grad = True
-            visited.add(v)
+            need_grad.add(v)
             queue.append(v)
 
         while len(queue) != 0:
             v = queue.popleft()
             if v in out_edges:
                 for opr in out_edges[v]:
-                    assert opr in all_oprs
+                    if opr in self._folded_oprs:
+                        continue
                     for o in opr.outputs:
-                        o.need_grad = True
-                        if o not in visited:
-                            visited.add(o)
+                        if o not in need_grad:
+                            need_grad.add(o)
                             queue.append(o)
 
-        for o in loss.owner_opr.outputs:
+        for o in self.get_owner_opr(loss).outputs:
             if o != loss:
-                o.need_grad = False
+                need_grad.discard(o)
 
-        return all_oprs
+        oprs = []
+        contributing = self._find_ancestors([loss])
+        for opr in reversed(all_oprs):
+            if opr in self._folded_oprs or opr not in contributing:
+                continue
+            idxes = tuple(idx for idx, i in enumerate(opr.inputs) if i in need_grad)
+            if len(idxes) > 0:
+                oprs.append((opr, idxes))
+
+        zero_vars = [loss] + [v for v in need_grad if v is not loss]
+        return BackwardSchedule(loss=loss, oprs=tuple(oprs), grad_oprs=tuple(grad_oprs), zero_vars=tuple(zero_vars))
 
 
 class TopoSorter(object):
-    def __init__(self, targets, initial_visited=None):
+    def __init__(self, targets, initial_visited=None, substitutes=None):
         self._targets = targets
         self._initial_visited = initial_visited or []
+        # oprs replaced by other ones producing the same outputs
+        self._substitutes = substitutes or {}
         self._visited = set()
         self._all_related_oprs = list()
         self._sorted = None
         self._out_edges = None
 
+    def _get_owner_opr(self, var):
+        opr = var.owner_opr
+        return self._substitutes.get(opr, opr)
+
     def _gen_all_related_oprs(self, dest_var):
-        if dest_var.owner_opr in self._visited:
+        owner = self._get_owner_opr(dest_var)
+        if owner in self._visited:
             return
 
         queue = deque()
-        self._visited.add(dest_var.owner_opr)
-        queue.append(dest_var.owner_opr)
+        self._visited.add(owner)
+        queue.append(owner)
         while len(queue) != 0:
             wrt = queue.popleft()
             self._all_related_oprs.append(wrt)
             for i in wrt.inputs:
-                opr = i.owner_opr
+                opr = self._get_owner_opr(i)
                 if opr not in self._visited:
                     self._visited.add(opr)
                     queue.append(opr)
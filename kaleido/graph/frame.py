@@ -0,0 +1,55 @@
+# -*- coding:utf8 -*-
+# File   : frame.py
+# Author : Jiayuan Mao
+# Email  : maojiayuan@gmail.com
+# Date   : 10/23/26 16:40
+#
+# This file is part of Kaleido
+# (c) 2016 vccy.xyz
+
+import threading
+
+__all__ = ['Frame', 'get_current_frame']
+
+_local = threading.local()
+
+
+class Frame(object):
+    """The execution state of one call of a compiled function: the values and grads of the vars, and what
+    the oprs keep between their fprop and their bprop.
+
+    `VarNode` and `OprNodeBase` read and write their state in the frame active in the calling thread, which
+    `Function` creates for every call and activates (with `with frame:`) in each thread running steps of
+    that call. The calls made outside of any frame share a default one.
+    """
+
+    __slots__ = ('values', 'grads', 'owned_grads', 'opr_states')
+
+    def __init__(self, values=None):
+        self.values = {} if values is None else values
+        self.grads = {}
+        # vars whose grad is a private copy, accumulated in place
+        self.owned_grads = set()
+        self.opr_states = {}
+
+    def __enter__(self):
+        stack = getattr(_local, 'stack', None)
+        if stack is None:
+            stack = _local.stack = []
+        stack.append(getattr(_local, 'frame', None))
+        _local.frame = self
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        prev = _local.stack.pop()
+        if prev is None:
+            del _local.frame
+        else:
+            _local.frame = prev
+
+
+_default_frame = Frame()
+
+
+def get_current_frame():
+    return getattr(_local, 'frame', _default_frame)
@@ -0,0 +1,125 @@
+# -*- coding:utf8 -*-
+# File   : fusion.py
+# Author : Jiayuan Mao
+# Email  : maojiayuan@gmail.com
+# Date   : 10/19/26 14:15
+#
+# This file is part of Kaleido
+# (c) 2016 vccy.xyz
+
+from collections import deque
+
+
+def _is_fusible(opr):
+    from ..opr.arith import ElemwiseOprNodeBase
+    return isinstance(opr, ElemwiseOprNodeBase) and type(opr).__fusible__
+
+
+def find_elemwise_groups(oprs, out_edges, keep, phase_of):
+    """Group fusible oprs into single-output groups, returned as lists of oprs in topological order.
+
+    A group grows from its root towards the inputs; a producer joins the group when all the consumers of
+    its output are already in the group, its output is not in `keep` (requested outputs, losses), and it
+    runs in the same phase as the root. Every var produced inside a group is therefore only read inside
+    the group, so the group can run as a whole at the position of its root.
+    """
+    order = {opr: idx for idx, opr in enumerate(oprs)}
+    assigned = set()
+    groups = []
+
+    for root in reversed(oprs):
+        if root in assigned or not _is_fusible(root):
+            continue
+
+        group = {root}
+        queue = deque([root])
+        while len(queue) != 0:
+            opr = queue.popleft()
+            for i in opr.inputs:
+                producer = i.owner_opr
+                if producer in group or producer in assigned or producer not in order:
+                    continue
+                if not _is_fusible(producer) or phase_of.get(producer) != phase_of.get(root):
+                    continue
+                if len(producer.outputs) != 1 or i in keep:
+                    continue
+                if not all(consumer in group for consumer in out_edges.get(i, [])):
+                    continue
+                group.add(producer)
+                queue.append(producer)
+
+        if len(group) > 1:
+            assigned.update(group)
+            groups.append(sorted(group, key=order.get))
+
+    return groups
+
+
+def _get_producer(var, cls):
+    opr = var.owner_opr
+    return opr if type(opr) is cls else None
+
+
+def find_softmax_cross_entropy(oprs, keep):
+    """Find the cross entropies written as `index_onehot(-log(exp(x) / reduce_sum(exp(x), axis, keepdims=True)),
+    label, axis)`, returned as (index_onehot opr, x, label, axis) tuples. The vars in between must not be in
+    `keep` (vars grads are taken w.r.t.); they may have other consumers, which keep reading them."""
+    from ..opr.arith import Neg, Log, Div, Exp
+    from ..opr.index import IndexOnehot
+    from ..opr.reduce import ReduceSum
+
+    res = []
+    for opr in oprs:
+        if type(opr) is not IndexOnehot:
+            continue
+        neg = _get_producer(opr.inputs[0], Neg)
+        log = None if neg is None else _get_producer(neg.inputs[0], Log)
+        div = None if log is None else _get_producer(log.inputs[0], Div)
+        if div is None:
+            continue
+        num = _get_producer(div.inputs[0], Exp)
+        den = _get_producer(div.inputs[1], ReduceSum)
+        if num is None or den is None or not den.keepdims or den.axis != opr.axis:
+            continue
+        exp = _get_producer(den.inputs[0], Exp)
+        if exp is None or exp.inputs[0] is not num.inputs[0]:
+            continue
+        if any(o.outputs[0] in keep for o in (neg, log, div, num, den, exp)):
+            continue
+        res.append((opr, num.inputs[0], opr.inputs[1], opr.axis))
+    return res
+
+
+def rewrite_oprs(oprs, fused_of):
+    res = []
+    for opr in oprs:
+        fused = fused_of.get(opr)
+        if fused is None:
+            res.append(opr)
+        elif fused.root is opr:
+            res.append(fused)
+    return res
+
+
+def rewrite_backward_schedule(sched, fused_of):
+    """Merge the bprop entries of the members of each fused opr into one entry, at the position of its root
+    (the first member to run backward). The fused opr computes the grads of its inputs that any member
+    was asked for."""
+    fused_idxes = {}
+    for opr, idxes in sched.oprs:
+        fused = fused_of.get(opr)
+        if fused is not None:
+            s = fused_idxes.setdefault(fused, set())
+            for idx in idxes:
+                is_input, k = fused.member_input_ref(opr, idx)
+                if is_input:
+                    s.add(k)
+
+    oprs = []
+    for opr, idxes in sched.oprs:
+        fused = fused_of.get(opr)
+        if fused is None:
+            oprs.append((opr, idxes))
+        elif fused.root is opr and len(fused_idxes[fused]) != 0:
+            oprs.append((fused, tuple(sorted(fused_idxes[fused]))))
+    return sched._replace(oprs=tuple(oprs))
@@ -0,0 +1,29 @@
+# -*- coding:utf8 -*-
+# File   : hook.py
+# Author : Jiayuan Mao
+# Email  : maojiayuan@gmail.com
+# Date   : 10/18/26 21:10
+#
+# This file is part of Kaleido
+# (c) 2016 vccy.xyz
+
+
+class FunctionHook(object):
+    """Instrumentation attached by `Function.add_hook`. A function without hooks runs the plain loop and
+    pays nothing for this.
+
+    `phase` is 'feed' for placeholder inputs, or the phase of the plan step ('forward', 'label_wrts',
+    'backward', 'post_grad'). `nbytes` is the size of the values or grads written by the step.
+    """
+
+    def on_call_begin(self, func):
+        pass
+
+    def on_call_end(self, func):
+        pass
+
+    def on_opr_begin(self, phase, opr):
+        pass
+
+    def on_opr_end(self, phase, opr, nbytes):
+        pass
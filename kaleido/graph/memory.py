@@ -0,0 +1,103 @@
+# -*- coding:utf8 -*-
+# File   : memory.py
+# Author : Jiayuan Mao
+# Email  : maojiayuan@gmail.com
+# Date   : 10/18/26 22:30
+#
+# This file is part of Kaleido
+# (c) 2016 vccy.xyz
+
+from collections import namedtuple
+
+from .hook import FunctionHook
+
+
+def _step_uses(step):
+    """Return the vars whose value and whose grad the step may touch. A bprop step may read the values of
+    all inputs and outputs of its opr and the grads of its outputs."""
+    from ..opr.grad import Gradient
+
+    opr = step.opr
+    if step.phase == 'label_wrts':
+        return step.grads, step.grads
+
+    values = tuple(opr.inputs) + tuple(opr.outputs)
+    if len(step.grads) != 0:  # bprop steps are the only ones writing grads
+        return values, tuple(opr.outputs) + step.grads
+    if isinstance(opr, Gradient):
+        return values, (opr.inputs[1], )
+    return values, ()
+
+
+def plan_liveness(steps, keep):
+    """Compute, for every step, the release callbacks to run right after it: the values and grads whose last
+    use is that step (except the vars in `keep`), and the oprs whose per-call state is no longer needed."""
+    last_value, last_grad, last_opr = {}, {}, {}
+    for idx, step in enumerate(steps):
+        values, grads = _step_uses(step)
+        for v in values:
+            last_value[v] = idx
+        for v in grads:
+            last_grad[v] = idx
+        last_opr[step.opr] = idx
+
+    frees = [[] for _ in steps]
+    for v, idx in last_value.items():
+        if v not in keep:
+            frees[idx].append(v.clear_value)
+    for v, idx in last_grad.items():
+        frees[idx].append(v.clear_grad)
+    for opr, idx in last_opr.items():
+        frees[idx].append(opr.clear_state)
+    return [tuple(f) for f in frees]
+
+
+MemoryReport = namedtuple('MemoryReport', ['peak_bytes', 'unplanned_peak_bytes', 'saved_bytes'])
+
+
+def _array_key(arr):
+    base = arr
+    while getattr(base, 'base', None) is not None:
+        base = base.base
+    return id(base), getattr(base, 'nbytes', arr.nbytes)
+
+
+class MemoryTracker(FunctionHook):
+    """Measures the live bytes held by the vars of a function after every step. `unplanned_peak_bytes` is
+    what the call would hold if nothing were released before the end of the call (the behaviour without
+    the liveness planner); views share the bytes of their base array."""
+
+    def __init__(self):
+        self._func = None
+        self._peak = 0
+        self._total = 0
+        self._live = None
+        self.reports = []
+
+    @property
+    def last_report(self):
+        return self.reports[-1] if len(self.reports) else None
+
+    def on_call_begin(self, func):
+        self._func = func
+        self._peak = 0
+        self._total = 0
+        self._live = {}
+
+    def on_opr_end(self, phase, opr, nbytes):
+        live = {}
+        for v in self._func.plan.varnodes:
+            if v.is_value_set:
+                k, n = _array_key(v.get_value(allow_sparse=True))
+                live[k] = n
+            if v.is_grad_set:
+                k, n = _array_key(v.get_grad(allow_sparse=True))
+                live[k] = n
+        # ids are recycled once an array is freed, so count an array as new when it was not live before
+        self._total += sum(n for k, n in live.items() if k not in self._live)
+        self._live = live
+        self._peak = max(self._peak, sum(live.values()))
+
+    def on_call_end(self, func):
+        self._live = None
+        self.reports.append(MemoryReport(self._peak, self._total, self._total - self._peak))
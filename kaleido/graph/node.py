@@ -9,11 +9,14 @@
 
 import numpy as np
 
+from .frame import get_current_frame
+from .sparse import SparseGrad
+
 
 def as_numpy_array(var):
     if type(var) in (float, int):
         return np.array((var, ))
-    var = np.array(var)
+    var = np.asarray(var)
     if len(var.shape) == 0:
         return np.array((var, ))
     return var
@@ -105,9 +108,8 @@ class VarNode(VarNodeOprMixin):
         self.__name_reset = False
         self.__owner_opr = owner_opr
         self.__owner_opr_idx = owner_opr_idx
-        self.__value = None
-        self.__grad = None
-        self.__need_grad = False
+        self.__static_shape = None
+        self.__static_dtype = None
 
     @property
     def name(self):
@@ -127,56 +129,92 @@ class VarNode(VarNodeOprMixin):
         return self.__owner_opr_idx
 
     @property
-    def need_grad(self):
-        return self.__need_grad
+    def static_shape(self):
+        """Shape inferred at compile time, None dims being unknown; None if nothing is known."""
+        return self.__static_shape
+
+    @property
+    def static_dtype(self):
+        return self.__static_dtype
 
-    @need_grad.setter
-    def need_grad(self, x):
-        self.__need_grad = bool(x)
+    def set_static_info(self, shape, dtype):
+        self.__static_shape = None if shape is None else tuple(shape)
+        self.__static_dtype = None if dtype is None else np.dtype(dtype)
 
-    def get_value(self):
-        assert self.__value is not None, 'invalid value {}'.format(str(self))
-        return self.__value
+    # the value and the grad live in the current frame, see `Frame`
+
+    def get_value(self, allow_sparse=False):
+        values = get_current_frame().values
+        value = values.get(self)
+        assert value is not None, 'invalid value {}'.format(str(self))
+        if type(value) is SparseGrad and not allow_sparse:
+            value = values[self] = value.to_dense()
+        return value
 
     def set_value(self, value):
-        self.__value = as_numpy_array(value)
+        get_current_frame().values[self] = value if type(value) is SparseGrad else as_numpy_array(value)
 
     @property
     def is_value_set(self):
-        return self.__value is not None
+        return self in get_current_frame().values
 
-    def get_grad(self):
-        assert self.__grad is not None, 'invalid grad {}'.format(str(self))
-        return self.__grad
+    def get_grad(self, allow_sparse=False):
+        frame = get_current_frame()
+        grad = frame.grads.get(self)
+        assert grad is not None, 'invalid grad {}'.format(str(self))
+        if type(grad) is SparseGrad and not allow_sparse:
+            grad = frame.grads[self] = grad.to_dense()
+            frame.owned_grads.add(self)
+        return grad
 
     def set_or_accumulate_grad(self, grad):
+        frame = get_current_frame()
+        cur = frame.grads.get(self)
         if type(grad) in (float, int) and grad == 0:
-            if self.__grad is None:
-                self.__grad = np.zeros_like(self.get_value())
+            if cur is None:
+                frame.grads[self] = np.zeros_like(self.get_value())
+                frame.owned_grads.discard(self)
             return
 
-        grad = as_numpy_array(grad)
+        if type(grad) is not SparseGrad:
+            grad = as_numpy_array(grad)
         assert grad.shape == self.get_value().shape, \
             'invalid grad shape gshape={}, vshape={}'.format(grad.shape, self.get_value().shape)
-        if self.__grad is None:
-            self.__grad = grad
+        if cur is None:
+            # the first grad may be shared with other vars (e.g. Add passes its grad through), so it is
+            # only accumulated in place once the var owns a copy
+            frame.grads[self] = grad
+            frame.owned_grads.discard(self)
+            return
+
+        # sparse grads are summed into a dense one
+        owned = self in frame.owned_grads
+        if type(cur) is SparseGrad:
+            cur, owned = cur.to_dense(), True
+        if type(grad) is SparseGrad:
+            cur = grad.add_to(cur if owned else cur.copy())
+        elif owned:
+            cur += grad
         else:
-            self.__grad += grad
+            cur = cur + grad
+        frame.grads[self] = cur
+        frame.owned_grads.add(self)
 
     @property
     def is_grad_set(self):
-        return self.__grad is not None
+        return self in get_current_frame().grads
 
     def clear_state(self):
         self.clear_value()
         self.clear_grad()
 
     def clear_value(self):
-        self.__value = None
+        get_current_frame().values.pop(self, None)
 
     def clear_grad(self):
-        self.__grad = None
-        self.__need_grad = False
+        frame = get_current_frame()
+        frame.grads.pop(self, None)
+        frame.owned_grads.discard(self)
 
     def __str__(self):
         if not self.__name_reset:
@@ -221,6 +259,10 @@ class OprNodeBase(object):
         self.__name_reset = True
         self.__name = name
 
+    @property
+    def has_custom_name(self):
+        return self.__name_reset
+
     @property
     def inputs(self):
         assert self.__inputs_set
@@ -244,18 +286,52 @@ class OprNodeBase(object):
         self.__outputs = outputs
 
     def fprop(self, env):
-        print('fproping', str(self))
         for i in self.__inputs:
             assert i.is_value_set, 'Got invalid input at opr={}, input={}'.format(str(self), str(i))
         self._do_fprop(env)
         for o in self.__outputs:
-            o.get_value()  # try to get value
+            o.get_value(allow_sparse=True)  # try to get value
+
+    def bprop(self, env, idxes):
+        for idx in idxes:
+            self.__inputs[idx].set_or_accumulate_grad(self._do_bprop(env, idx))
 
-    def bprop(self, env):
-        print('bproping', str(self))
-        for idx, i in enumerate(self.__inputs):
-            if i.need_grad:
-                self.inputs[idx].set_or_accumulate_grad(self._do_bprop(env, idx))
+    def _set_call_state(self, key, value):
+        """Keep `value` for the bprop of the same call, in the current frame."""
+        get_current_frame().opr_states.setdefault(self, {})[key] = value
+
+    def _get_call_state(self, key, default=None):
+        state = get_current_frame().opr_states.get(self)
+        return default if state is None else state.get(key, default)
+
+    def clear_state(self):
+        # drop whatever the opr keeps between its fprop and bprop
+        get_current_frame().opr_states.pop(self, None)
+
+    def infer_static(self):
+        """Set the static shapes and dtypes of the outputs from the ones of the inputs."""
+        shapes = [i.static_shape for i in self.__inputs]
+        dtypes = [i.static_dtype for i in self.__inputs]
+        try:
+            oshapes, odtypes = self._do_infer(shapes, dtypes)
+        except AssertionError as e:
+            raise AssertionError('shape inference failed at opr={}, input shapes={}, dtypes={}: {}'.format(
+                str(self), shapes, dtypes, e)) from e
+        for o, shape, dtype in zip(self.outputs, oshapes, odtypes):
+            o.set_static_info(shape, dtype)
+
+    def get_static_value(self):
+        """The value of the (single) output if it is known at compile time, else None."""
+        return None
+
+    def get_attrs(self):
+        """The arguments of the constructor besides the inputs and the name, for serialization."""
+        return {}
+
+    def _do_infer(self, shapes, dtypes):
+        # unknown by default
+        nr_outputs = len(self.outputs)
+        return [None] * nr_outputs, [None] * nr_outputs
 
     def _init_outputs(self):
         raise NotImplementedError()
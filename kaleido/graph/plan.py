@@ -0,0 +1,118 @@
+# -*- coding:utf8 -*-
+# File   : plan.py
+# Author : Jiayuan Mao
+# Email  : maojiayuan@gmail.com
+# Date   : 10/18/26 20:05
+#
+# This file is part of Kaleido
+# (c) 2016 vccy.xyz
+
+from collections import namedtuple
+from functools import partial
+
+import numpy as np
+
+from .memory import plan_liveness
+from .policy import apply_cast
+
+
+# Per-loss backward sweep: `oprs` is a sequence of (opr, input indices needing grad) in bprop order and
+# `zero_vars` are all the vars whose grad gets written during the sweep.
+BackwardSchedule = namedtuple('BackwardSchedule', ['loss', 'oprs', 'grad_oprs', 'zero_vars'])
+
+# One entry of the flat schedule: `fn(env)` runs it; `values` and `grads` are the vars it writes and
+# `frees` the release callbacks of the memory planner to run after it.
+# `phase` is one of 'forward', 'label_wrts', 'backward' or 'post_grad'.
+Step = namedtuple('Step', ['phase', 'opr', 'fn', 'values', 'grads', 'frees'])
+
+
+def _label_wrts(sched, env):
+    for v in sched.zero_vars:
+        v.clear_grad()
+    sched.loss.set_or_accumulate_grad(np.ones_like(sched.loss.get_value()))
+
+
+def _fprop_step(phase, opr):
+    # the steps are ordered so that every input is computed or fed before it is read: the checks of
+    # `OprNodeBase.fprop` are left to the calls outside of a plan
+    return Step(phase, opr, opr._do_fprop, tuple(opr.outputs), (), ())
+
+
+def _run_and_cast(fn, casts, env):
+    fn(env)
+    for var, cast in casts:
+        var.set_value(apply_cast(var.get_value(), cast))
+
+
+def _add_casts(step, casts):
+    # the casts of the dtype policy are applied to the values a step writes, after it
+    step_casts = tuple((v, casts[v]) for v in step.values if v in casts)
+    if len(step_casts) == 0:
+        return step
+    return step._replace(fn=partial(_run_and_cast, step.fn, step_casts))
+
+
+class ExecutionPlan(namedtuple('_ExecutionPlan', [
+        'varnodes', 'placeholders', 'pre_grad', 'grad_steps', 'post_grad', 'steps', 'outputs', 'constants',
+        'post_grad_begin'])):
+    """Flat schedule of a compiled graph, built once by `CompGraph.compile`.
+
+    A call runs `steps` in order; each step is bound at build time to the opr method it runs (forward
+    steps skip the input checks of `fprop`). `varnodes` lists every `VarNode` touched by the graph and
+    `outputs` are the indices of the outputs in it. `steps[:post_grad_begin]` are the forward and backward
+    phases, the rest the post-grad one.
+
+    In inference mode the folded constants are not steps: `constants` holds (var, value) pairs set before
+    each call and never released. The casts of the dtype policy (`CompGraph.casts`) are part of the steps
+    writing the cast vars.
+    """
+
+    __slots__ = ()
+
+    @classmethod
+    def build(cls, cg, release_intermediates=True):
+        from ..opr.netsrc import PlaceHolder, FoldedConstant
+
+        varnodes = []
+        slots = {}
+
+        def get_slot(var):
+            if var not in slots:
+                slots[var] = len(varnodes)
+                varnodes.append(var)
+            return slots[var]
+
+        for opr in cg.all_oprs:
+            for v in opr.inputs + opr.outputs:
+                get_slot(v)
+
+        placeholders = tuple((opr.name, opr) for opr in cg.all_oprs if isinstance(opr, PlaceHolder))
+        grad_steps = tuple(cg.backward_schedules[loss] for loss in cg.grad_wrts)
+
+        steps = [_fprop_step('forward', opr) for opr in cg.oprs_pre_grad]
+        for sched in grad_steps:
+            loss_opr = cg.get_owner_opr(sched.loss)
+            steps.append(Step('label_wrts', loss_opr, partial(_label_wrts, sched), (), (sched.loss, ), ()))
+            for opr, idxes in sched.oprs:
+                grads = tuple(dict.fromkeys(opr.inputs[idx] for idx in idxes))
+                steps.append(Step('backward', opr, partial(opr.bprop, idxes=idxes), (), grads, ()))
+            steps.extend(_fprop_step('backward', opr) for opr in sched.grad_oprs)
+        folded = ()
+        if cg.mode == 'inference':
+            folded = tuple(opr for opr in cg.oprs_post_grad if isinstance(opr, FoldedConstant))
+        constants = tuple((opr.outputs[0], opr.get_static_value()) for opr in folded)
+        post_grad_begin = len(steps)
+        steps.extend(_fprop_step('post_grad', opr) for opr in cg.oprs_post_grad if opr not in folded)
+        if len(cg.casts) != 0:
+            steps = [_add_casts(step, cg.casts) for step in steps]
+
+        if release_intermediates:
+            frees = plan_liveness(steps, set(cg.outputs) | {v for v, _ in constants})
+            steps = [step._replace(frees=f) for step, f in zip(steps, frees)]
+
+        return cls(
+            varnodes=tuple(varnodes), placeholders=placeholders,
+            pre_grad=tuple(cg.oprs_pre_grad), grad_steps=grad_steps, post_grad=tuple(cg.oprs_post_grad),
+            steps=tuple(steps), outputs=tuple(get_slot(o) for o in cg.outputs), constants=constants,
+            post_grad_begin=post_grad_begin
+        )
@@ -0,0 +1,61 @@
+# -*- coding:utf8 -*-
+# File   : policy.py
+# Author : Jiayuan Mao
+# Email  : maojiayuan@gmail.com
+# Date   : 10/21/26 14:30
+#
+# This file is part of Kaleido
+# (c) 2016 vccy.xyz
+
+import numpy as np
+
+
+class DTypePolicy(object):
+    """Graph-wide dtype policy, set on `CompGraph`.
+
+    Compiling a training graph converts the values of its parameters to `dtype` once, so the updates keep
+    them in it (but for parameters pinned in shared memory, which are cast at every call). The compiled
+    function casts the constants and fed inputs to `dtype`: floating ones always, integral ones when they
+    are only read by elementwise oprs (indices stay integral). These casts belong to the compiled function:
+    the nodes keep their values, and other graphs over them are not affected.
+
+    With `storage_dtype` (e.g. float16), the outputs of elementwise oprs are stored in that dtype and cast
+    back to `dtype` when read, so kernels still compute and accumulate in `dtype`. Grads, losses, reductions
+    and parameters are kept in `dtype`, and so are the outputs the function returns.
+    """
+
+    def __init__(self, dtype='float32', storage_dtype=None):
+        self._dtype = np.dtype(dtype)
+        self._storage_dtype = None if storage_dtype is None else np.dtype(storage_dtype)
+        assert self._dtype.kind == 'f', 'compute dtype must be floating: {}'.format(self._dtype)
+        assert self._storage_dtype is None or self._storage_dtype.kind == 'f'
+
+    @property
+    def dtype(self):
+        return self._dtype
+
+    @property
+    def storage_dtype(self):
+        return self._storage_dtype
+
+    def get_storage_dtype(self, dtype):
+        if self._storage_dtype is not None and dtype == self._dtype:
+            return self._storage_dtype
+        return dtype
+
+    def __repr__(self):
+        return 'DTypePolicy(dtype={}, storage_dtype={})'.format(self._dtype, self._storage_dtype)
+
+
+def apply_cast(value, cast):
+    """Cast `value` to the dtype of a (dtype, kinds) cast of the policy if its dtype kind is in kinds."""
+    dtype, kinds = cast
+    if value.dtype.kind in kinds and value.dtype != dtype:
+        return value.astype(dtype)
+    return value
+
+
+def as_dtype_policy(policy):
+    if policy is None or isinstance(policy, DTypePolicy):
+        return policy
+    return DTypePolicy(policy)
@@ -0,0 +1,114 @@
+# -*- coding:utf8 -*-
+# File   : profile.py
+# Author : Jiayuan Mao
+# Email  : maojiayuan@gmail.com
+# Date   : 10/18/26 21:10
+#
+# This file is part of Kaleido
+# (c) 2016 vccy.xyz
+
+import collections
+import json
+import os
+import threading
+import time
+
+from .hook import FunctionHook
+
+
+class ProfileRecord(object):
+    def __init__(self, phase, opr_name, opr_type):
+        self.phase = phase
+        self.opr_name = opr_name
+        self.opr_type = opr_type
+        self.count = 0
+        self.time = 0.
+        self.nbytes = 0
+
+    @property
+    def avg_time(self):
+        return self.time / max(self.count, 1)
+
+
+class Profiler(FunctionHook):
+    """Per-opr, per-phase wall time, call count and output bytes, usable as a `Function` hook.
+
+    >>> prof = func.add_hook(Profiler())
+    >>> func(x=...)
+    >>> print(prof.table())
+    >>> prof.dump_chrome_trace('trace.json')
+    """
+
+    def __init__(self, trace=True):
+        self._trace = trace
+        self._records = collections.OrderedDict()
+        self._events = []
+        self._start = None
+        self._epoch = time.perf_counter()
+
+    @property
+    def records(self):
+        return list(self._records.values())
+
+    def reset(self):
+        self._records.clear()
+        del self._events[:]
+
+    def on_call_begin(self, func):
+        if self._trace:
+            self._events.append(self._make_event('call', 'function', 'B', time.perf_counter()))
+
+    def on_call_end(self, func):
+        if self._trace:
+            self._events.append(self._make_event('call', 'function', 'E', time.perf_counter()))
+
+    def on_opr_begin(self, phase, opr):
+        self._start = time.perf_counter()
+
+    def on_opr_end(self, phase, opr, nbytes):
+        end = time.perf_counter()
+        key = (phase, opr)
+        rec = self._records.get(key)
+        if rec is None:
+            rec = self._records[key] = ProfileRecord(phase, opr.name, type(opr).__name__)
+        rec.count += 1
+        rec.time += end - self._start
+        rec.nbytes += nbytes
+
+        if self._trace:
+            event = self._make_event(str(opr), phase, 'X', self._start)
+            event['dur'] = (end - self._start) * 1e6
+            event['args'] = {'type': rec.opr_type, 'nbytes': nbytes}
+            self._events.append(event)
+
+    def _make_event(self, name, cat, ph, t):
+        return {'name': name, 'cat': cat, 'ph': ph, 'ts': (t - self._epoch) * 1e6,
+                'pid': os.getpid(), 'tid': threading.get_ident()}
+
+    def table(self, sort_by='time', limit=None):
+        records = sorted(self._records.values(), key=lambda r: getattr(r, sort_by), reverse=True)
+        if limit is not None:
+            records = records[:limit]
+        total = sum(r.time for r in self._records.values()) or 1.
+
+        lines = ['{:<10s} {:<40s} {:<16s} {:>8s} {:>12s} {:>12s} {:>7s} {:>14s}'.format(
+            'phase', 'opr', 'type', 'count', 'total(ms)', 'avg(us)', '%', 'bytes')]
+        for r in records:
+            lines.append('{:<10s} {:<40s} {:<16s} {:>8d} {:>12.3f} {:>12.1f} {:>7.2f} {:>14d}'.format(
+                r.phase, r.opr_name[:40], r.opr_type[:16], r.count, r.time * 1e3, r.avg_time * 1e6,
+                r.time / total * 100, r.nbytes))
+
+        phases = collections.OrderedDict()
+        for r in self._records.values():
+            phases[r.phase] = phases.get(r.phase, 0.) + r.time
+        lines.append('')
+        for phase, t in phases.items():
+            lines.append('{:<10s} {:>12.3f} ms'.format(phase, t * 1e3))
+        return '\n'.join(lines)
+
+    def chrome_trace(self):
+        return {'traceEvents': list(self._events), 'displayTimeUnit': 'ms'}
+
+    def dump_chrome_trace(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.chrome_trace(), f)
@@ -0,0 +1,205 @@
+# -*- coding:utf8 -*-
+# File   : serialize.py
+# Author : Jiayuan Mao
+# Email  : maojiayuan@gmail.com
+# Date   : 10/21/26 09:40
+#
+# This file is part of Kaleido
+# (c) 2016 vccy.xyz
+
+import os
+import sys
+import json
+import struct
+
+import numpy as np
+
+from .node import OprNodeBase, as_numpy_array
+
+# Container layout: magic, little-endian uint64 length of a JSON header, the header, then the tensors, each
+# starting at a multiple of ALIGNMENT from the beginning of the file. The header lists the tensors as
+# {dtype, shape, offset} and holds the graph and/or the parameters, tensors being referred to by index.
+MAGIC = b'KALEIDO\x01'
+ALIGNMENT = 64
+_TENSOR_KEY = '__tensor__'
+
+
+def _align(n):
+    return (n + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def _get_parameters(oprs):
+    from ..opr.netsrc import Parameter
+    return [opr for opr in oprs if isinstance(opr, Parameter)]
+
+
+def _sort_oprs(outputs):
+    from .fprop import TopoSorter
+    oprs, _ = TopoSorter(outputs).sort()
+    return oprs
+
+
+def _get_outputs(graph):
+    from .fprop import CompGraph
+    if isinstance(graph, CompGraph):
+        assert graph.compiled, 'the comp graph is not compiled'
+        return list(graph.outputs)
+    return list(graph)
+
+
+class _Writer(object):
+    def __init__(self):
+        self.tensors = []
+        self.arrays = []
+        self.nbytes = 0
+
+    def add_tensor(self, value):
+        value = np.ascontiguousarray(value)
+        assert value.dtype.kind in 'biufc', 'can not save array of dtype {}'.format(value.dtype)
+        self.tensors.append({'dtype': value.dtype.str, 'shape': list(value.shape), 'offset': self.nbytes})
+        self.arrays.append(value)
+        self.nbytes = _align(self.nbytes + value.nbytes)
+        return {_TENSOR_KEY: len(self.tensors) - 1}
+
+    def encode(self, value):
+        if isinstance(value, np.ndarray):
+            return self.add_tensor(value)
+        if isinstance(value, np.dtype):
+            return value.str
+        if isinstance(value, (tuple, list)):
+            return [self.encode(v) for v in value]
+        return value
+
+    def write(self, path, header):
+        header = dict(header, tensors=self.tensors)
+        raw = json.dumps(header).encode('utf8')
+        data_begin = _align(len(MAGIC) + 8 + len(raw))
+        # write then rename: the file may still be mapped by an earlier load (e.g. the parameters being
+        # saved), and truncating it in place would kill the process on the next access to the mapping
+        tmp = '{}.{}.tmp'.format(path, os.getpid())
+        try:
+            with open(tmp, 'wb') as f:
+                f.write(MAGIC)
+                f.write(struct.pack('<Q', len(raw)))
+                f.write(raw)
+                for t, value in zip(self.tensors, self.arrays):
+                    f.write(b'\0' * (data_begin + t['offset'] - f.tell()))
+                    f.write(value.data)
+                f.write(b'\0' * (data_begin + self.nbytes - f.tell()))
+            os.replace(tmp, path)
+        except BaseException:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+
+
+def _read(path, mmap_mode):
+    with open(path, 'rb') as f:
+        assert f.read(len(MAGIC)) == MAGIC, 'not a kaleido file: {}'.format(path)
+        header_len, = struct.unpack('<Q', f.read(8))
+        header = json.loads(f.read(header_len).decode('utf8'))
+
+    data_begin = _align(len(MAGIC) + 8 + header_len)
+    tensors = []
+    if len(header['tensors']) != 0:
+        # a single mapping of the file; every tensor is a view of it
+        buf = np.memmap(path, dtype=np.uint8, mode=mmap_mode)
+        for t in header['tensors']:
+            dtype, shape = np.dtype(t['dtype']), tuple(t['shape'])
+            begin = data_begin + t['offset']
+            end = begin + dtype.itemsize * int(np.prod(shape))
+            tensors.append(buf[begin:end].view(dtype).reshape(shape))
+    return header, tensors
+
+
+def _decode(value, tensors):
+    if isinstance(value, dict) and _TENSOR_KEY in value:
+        return tensors[value[_TENSOR_KEY]]
+    if isinstance(value, list):
+        return [_decode(v, tensors) for v in value]
+    return value
+
+
+def _find_class(path):
+    # only classes of already imported modules, so loading a file never imports code
+    module, _, qualname = path.rpartition('.')
+    assert module in sys.modules, 'unknown opr class {}: import its module first'.format(path)
+    cls = sys.modules[module]
+    for part in qualname.split('.'):
+        cls = getattr(cls, part)
+    assert isinstance(cls, type) and issubclass(cls, OprNodeBase), 'not an opr class: {}'.format(path)
+    return cls
+
+
+def save_graph(path, graph):
+    """Save the graph computing `graph` (a compiled `CompGraph` or a list of output vars), with the values of
+    its parameters and constants."""
+    outputs = _get_outputs(graph)
+    oprs = _sort_oprs(outputs)
+    opr_idx = {opr: idx for idx, opr in enumerate(oprs)}
+
+    def var_ref(var):
+        return [opr_idx[var.owner_opr], var.owner_opr_idx]
+
+    w = _Writer()
+    records = []
+    for opr in oprs:
+        cls = type(opr)
+        records.append({
+            'type': '{}.{}'.format(cls.__module__, cls.__qualname__),
+            'name': opr.name if opr.has_custom_name else None,
+            'inputs': [var_ref(i) for i in opr.inputs],
+            'attrs': {k: w.encode(v) for k, v in opr.get_attrs().items()},
+        })
+    w.write(path, {'graph': {'oprs': records, 'outputs': [var_ref(o) for o in outputs]}})
+
+
+def load_graph(path, mmap_mode='c'):
+    """Rebuild a graph saved by `save_graph` and return its output vars. Tensors are views of a memory
+    mapping of the file (copy-on-write by default), so loading does not read them."""
+    header, tensors = _read(path, mmap_mode)
+    assert 'graph' in header, 'no graph in {}'.format(path)
+
+    oprs = []
+    for rec in header['graph']['oprs']:
+        cls = _find_class(rec['type'])
+        inputs = [oprs[i].outputs[j] for i, j in rec['inputs']]
+        kwargs = {k: _decode(v, tensors) for k, v in rec['attrs'].items()}
+        if rec['name'] is not None:
+            kwargs['name'] = rec['name']
+        oprs.append(cls(*inputs, **kwargs))
+    return [oprs[i].outputs[j] for i, j in header['graph']['outputs']]
+
+
+def save_params(path, graph):
+    """Save the values of the parameters of `graph` (a compiled `CompGraph` or a list of output vars)."""
+    w = _Writer()
+    records = []
+    for p in _get_parameters(_sort_oprs(_get_outputs(graph))):
+        records.append({'name': p.name if p.has_custom_name else None, 'value': w.add_tensor(p.get_value())})
+    w.write(path, {'params': records})
+
+
+def load_params(path, graph, mmap_mode='c'):
+    """Set the parameters of `graph` from a file written by `save_params`. Named parameters are matched by
+    name, the others by their order in the graph."""
+    header, tensors = _read(path, mmap_mode)
+    assert 'params' in header, 'no parameters in {}'.format(path)
+
+    params = _get_parameters(_sort_oprs(_get_outputs(graph)))
+    named = {p.name: p for p in params if p.has_custom_name}
+    unnamed = [p for p in params if not p.has_custom_name]
+    records = header['params']
+    assert len(records) == len(params), 'got {} parameters for {}'.format(len(records), len(params))
+
+    for rec in records:
+        if rec['name'] is not None:
+            assert rec['name'] in named, 'no parameter named {}'.format(rec['name'])
+            p = named.pop(rec['name'])
+        else:
+            assert len(unnamed) != 0, 'too many unnamed parameters'
+            p = unnamed.pop(0)
+        value = _decode(rec['value'], tensors)
+        shape = as_numpy_array(p.get_value()).shape
+        assert shape == value.shape, 'shape mismatch for {}: {} vs {}'.format(p.name, value.shape, shape)
+        p.set_value(value)
@@ -0,0 +1,70 @@
+# -*- coding:utf8 -*-
+# File   : sparse.py
+# Author : Jiayuan Mao
+# Email  : maojiayuan@gmail.com
+# Date   : 10/24/26 10:40
+#
+# This file is part of Kaleido
+# (c) 2016 vccy.xyz
+
+import numpy as np
+
+__all__ = ['SparseGrad']
+
+
+class SparseGrad(object):
+    """Grad of an array of `shape` which is zero but at one position along `axis` for each index of the
+    other axes, as the grad of a lookup (e.g. `index_onehot`): `indices` gives the position and `values`
+    the grad there, both of the shape without `axis`.
+
+    Vars may hold it as their grad, and as their value for the output of `grad`; `VarNode.get_grad` and
+    `VarNode.get_value` turn it into a dense array unless asked for the sparse one, so only the oprs
+    knowing it (the optimizers) skip the dense zeros.
+    """
+
+    __slots__ = ('indices', 'values', 'shape', 'axis')
+
+    def __init__(self, indices, values, shape, axis):
+        self.shape = tuple(shape)
+        self.axis = axis % len(self.shape)
+        self.indices = np.asarray(indices)
+        self.values = np.broadcast_to(values, self.indices.shape)
+        assert self.indices.shape == self.shape[:self.axis] + self.shape[self.axis + 1:], \
+            'indices of shape {} for a grad of shape {} along axis {}'.format(self.indices.shape, self.shape, axis)
+
+    @property
+    def dtype(self):
+        return self.values.dtype
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    @property
+    def nbytes(self):
+        return self.indices.nbytes + self.values.nbytes
+
+    def add_to(self, dense, alpha=None):
+        """dense += alpha * self, in place; each entry is written once since there is one index per row."""
+        assert dense.shape == self.shape, 'add a sparse grad of shape {} to {}'.format(self.shape, dense.shape)
+        idx = np.expand_dims(self.indices, self.axis)
+        values = np.expand_dims(self.values, self.axis)
+        if alpha is not None:
+            values = values * alpha
+        cur = np.take_along_axis(dense, idx, self.axis)
+        cur += values
+        np.put_along_axis(dense, idx, cur, self.axis)
+        return dense
+
+    def to_dense(self):
+        res = np.zeros(self.shape, dtype=self.dtype)
+        np.put_along_axis(res, np.expand_dims(self.indices, self.axis), np.expand_dims(self.values, self.axis),
+                          self.axis)
+        return res
+
+    def __array__(self, dtype=None, copy=None):
+        res = self.to_dense()
+        return res if dtype is None else res.astype(dtype, copy=False)
+
+    def __repr__(self):
+        return 'SparseGrad(shape={}, axis={}, nnz={})'.format(self.shape, self.axis, self.indices.size)
@@ -13,5 +13,7 @@ from .arith import shapeof, shapeidx, update
 from .cnn import conv2d, pooling2d
 from .index import index_onehot, flatten2
 from .reduce import reduce_max, reduce_min, reduce_sum
+from .loss import softmax_cross_entropy
 from .netsrc import placeholder, parameter, Parameter
 from .grad import grad
+from .optim import ApplyUpdate
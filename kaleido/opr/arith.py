@@ -7,149 +7,225 @@
 # This file is part of Kaleido
 # (c) 2016 vccy.xyz
 
-from .base import SISOOprNodeBase, SingleOutputOprNodeBase
+from .base import SISOOprNodeBase, SingleOutputOprNodeBase, alloc_output, merge_dim, is_shape_known, dtype_sample
+from .base import alloc_activation, load_input
 from ..graph.node import as_opr_func
 
 import numpy as np
 
 
 class ElemwiseOprNodeBase(object):
-    pass
+    # whether the opr may be merged into a FusedElemwise at compile time. The _do_*_fprop/_do_*_bprop
+    # kernels of fusible oprs must only use their arguments, since the fused opr runs them on chunks.
+    __fusible__ = True
+
+    def _alloc_output(self, env, shape, dtype):
+        if env is not None and self in env.compute_dtype_oprs:
+            return alloc_output(env, shape, dtype)
+        return alloc_activation(env, shape, dtype)
 
 
 def get_not_one_axis(shape):
     return tuple(filter(lambda x: x > 1, shape))
 
 
-class AutoBroadcaster(object):
-    def __init__(self, var, tshape):
-        self._a_axises = []
-        self._b_axises = []
-        self._oshape = var.shape
-        self._value = self.broadcast(var, tshape)
-
-    @property
-    def value(self):
-        return self._value
-
-    def broadcast(self, var, tshape):
-        shape1 = get_not_one_axis(var.shape)
-        shape2 = tshape
-
-        i, j = 0, 0
-        n, m = len(shape1), len(shape2)
+class BroadcastPlan(object):
+    """How a binary opr broadcasts inputs of shapes `ashape` and `bshape`: the input with fewer non-one dims
+    (`idx`) is reshaped, a view, so that NumPy broadcasting matches its dims, in order, to equal dims of the
+    other one. The grad of that input sums the grad of the output over the other dims."""
 
-        dshape = []
-        while i < n and j < m:
-            if shape1[i] == shape2[j]:
-                dshape.append(shape1[i])
-                self._a_axises.append(j)
+    def __init__(self, ashape, bshape):
+        if len(get_not_one_axis(ashape)) > len(get_not_one_axis(bshape)):
+            self.idx, oshape, tshape = 1, bshape, ashape
+        else:
+            self.idx, oshape, tshape = 0, ashape, bshape
+
+        self._oshape = tuple(oshape)
+        self._identity = tuple(ashape) == tuple(bshape)
+        self._dshape, self._axes = self._match(oshape, tshape)
+
+    @staticmethod
+    def _match(oshape, tshape):
+        shape1 = get_not_one_axis(oshape)
+        i, n = 0, len(shape1)
+        dshape, axes = [], []
+        for j, d in enumerate(tshape):
+            if i < n and shape1[i] == d:
+                dshape.append(d)
                 i += 1
-                j += 1
             else:
                 dshape.append(1)
-                self._b_axises.append(j)
-                j += 1
+                axes.append(j)
+        assert i == n, 'can not perform auto broadcast from {} to {}'.format(oshape, tshape)
+        return tuple(dshape), tuple(axes)
 
-        for k in range(j, m):
-            dshape.append(1)
-            self._b_axises.append(k)
+    def broadcast(self, a, b):
+        if self._identity:
+            return a, b
+        if self.idx == 0:
+            return a.reshape(self._dshape), b
+        return a, b.reshape(self._dshape)
 
-        assert i == n, 'can not perform auto broadcast from {} to {}'.format(var.shape, tshape)
-        return var.reshape(dshape)
+    def inv_broadcast(self, var, idx):
+        if self._identity or idx != self.idx:
+            return var
+        if len(self._axes) != 0:
+            var = var.sum(axis=self._axes, keepdims=True)
+        return var.reshape(self._oshape)
 
-    def inv_broadcast(self, var):
-        var = var.transpose(self._a_axises + self._b_axises)
-        var = var.reshape(var.shape[:len(self._a_axises)] + (-1,))
-        var = var.sum(axis=len(var.shape) - 1)
-        var = var.reshape(self._oshape)
-        return var
+
+def get_broadcast_shape(ashape, bshape):
+    """Static counterpart of the auto broadcasting of binary oprs. Unknown (None) dims are taken as non-one dims
+    that only match unknown dims."""
+    def not_one(shape):
+        return tuple(d for d in shape if d is None or d > 1)
+
+    na, nb = not_one(ashape), not_one(bshape)
+    if len(na) > len(nb):
+        src, tshape = nb, ashape
+    else:
+        src, tshape = na, bshape
+
+    i = 0
+    for d in tshape:
+        if i < len(src) and src[i] == d:
+            i += 1
+    assert i == len(src), 'can not perform auto broadcast between {} and {}'.format(ashape, bshape)
+    return tuple(tshape)
+
+
+def get_float_dtype(*xs):
+    return np.result_type(*xs, 1.0)
 
 
 class UnaryElemwiseOprNodeBase(ElemwiseOprNodeBase, SISOOprNodeBase):
     def _do_fprop(self, env):
-        x = self.inputs[0].get_value()
-        y = self._do_unary_fprop(env, x)
+        x = load_input(env, self.inputs[0].get_value())
+        out = self._alloc_output(env, self._get_out_shape(x), self._get_out_dtype(x))
+        y = self._do_unary_fprop(env, x, out)
         self.outputs[0].set_value(y)
 
-    def _do_unary_fprop(self, env, x):
+    def _get_out_shape(self, x):
+        return x.shape
+
+    def _get_out_dtype(self, x):
+        return x.dtype
+
+    def _do_infer(self, shapes, dtypes):
+        dtype = None if dtypes[0] is None else self._get_out_dtype(dtype_sample(dtypes[0]))
+        return [shapes[0]], [dtype]
+
+    def _do_unary_fprop(self, env, x, out):
         raise NotImplementedError()
 
     def _do_bprop(self, env, idx):
         assert idx == 0
+        x = load_input(env, self.inputs[0].get_value())
+        y = load_input(env, self.outputs[0].get_value())
         gy = self.outputs[0].get_grad()
-        gx = self._do_unary_bprop(env, gy)
+        gx = self._do_unary_bprop(env, x, y, gy)
         return gx
 
-    def _do_unary_bprop(self, env, g):
+    def _do_unary_bprop(self, env, x, y, g):
         raise NotImplementedError()
 
 
+def get_const_dtypes(consts, da, db):
+    """The dtypes the inputs of a binary elementwise opr are computed in: a constant (see
+    `BinaryElemwiseOprNodeBase.const_inputs`) takes the floating dtype of the other operand."""
+    ca, cb = consts
+    if cb and not ca and da.kind == 'f' and db.kind in 'biuf':
+        return da, da
+    if ca and not cb and db.kind == 'f' and da.kind in 'biuf':
+        return db, db
+    return da, db
+
+
 class BinaryElemwiseOprNodeBase(ElemwiseOprNodeBase, SingleOutputOprNodeBase):
     __nr_inputs__ = 2
-    _broadcaster = None
-    _broadcaster_idx = -1
-    _var_a = None
-    _var_b = None
+    # broadcast plans by input shapes
+    _plans = None
+    _const_inputs = None
 
-    def _clear_broadcast_state(self):
-        self._broadcaster = None
-        self._broadcaster_idx = -1
-        self._var_a = self._var_b = None
+    @property
+    def const_inputs(self):
+        """Whether each input is a constant (an `immutable`, such as a Python number, or a shape). Constants
+        are cast to the floating dtype of the other operand, so `x * 0.5`, `x ** 2` or `x / x.shapeidx(0)`
+        keep the dtype of a float32 `x`."""
+        if self._const_inputs is None:
+            from .netsrc import Immutable
+            self._const_inputs = tuple(isinstance(i.owner_opr, (Immutable, ShapeOprMixin)) for i in self.inputs)
+        return self._const_inputs
+
+    def _cast_consts(self, a, b):
+        da, db = get_const_dtypes(self.const_inputs, a.dtype, b.dtype)
+        return a.astype(da, copy=False), b.astype(db, copy=False)
+
+    def _get_plan(self, ashape, bshape):
+        if self._plans is None:
+            self._plans = {}
+        key = (ashape, bshape)
+        plan = self._plans.get(key)
+        if plan is None:
+            plan = self._plans[key] = BroadcastPlan(ashape, bshape)
+        return plan
 
     def _broadcast(self, a, b):
-        n, m = len(get_not_one_axis(a.shape)), len(get_not_one_axis(b.shape))
-        if n > m:
-            self._broadcaster_idx = 1
-            self._broadcaster = AutoBroadcaster(b, a.shape)
-            b = self._broadcaster.value
-        else:
-            self._broadcaster_idx = 0
-            self._broadcaster = AutoBroadcaster(a, b.shape)
-            a = self._broadcaster.value
-        return a, b
-
-    def _inv_broadcast(self, var, axis):
-        assert self._broadcaster_idx in (0, 1)
-        if self._broadcaster_idx == axis:
-            var = self._broadcaster.inv_broadcast(var)
-        return var
+        return self._get_plan(a.shape, b.shape).broadcast(a, b)
 
     def _do_fprop(self, env):
         a = self.inputs[0].get_value()
         b = self.inputs[1].get_value()
-        self._clear_broadcast_state()
         a, b = self._broadcast(a, b)
-        self._var_a, self._var_b = a, b
-        c = self._do_binary_fprop(env, a, b)
+        a, b = self._cast_consts(load_input(env, a), load_input(env, b))
+        out = self._alloc_output(env, np.broadcast_shapes(a.shape, b.shape), self._get_out_dtype(a, b))
+        c = self._do_binary_fprop(env, a, b, out)
         self.outputs[0].set_value(c)
 
-    def _do_binary_fprop(self, env, a, b):
+    def _get_out_dtype(self, a, b):
+        return np.result_type(a, b)
+
+    def _do_infer(self, shapes, dtypes):
+        a, b = shapes
+        shape = None if a is None or b is None else get_broadcast_shape(a, b)
+        dtype = None
+        if dtypes[0] is not None and dtypes[1] is not None:
+            da, db = get_const_dtypes(self.const_inputs, *dtypes)
+            dtype = self._get_out_dtype(dtype_sample(da), dtype_sample(db))
+        return [shape], [dtype]
+
+    def _do_binary_fprop(self, env, a, b, out):
         raise NotImplementedError()
 
     def _do_bprop(self, env, idx):
+        y = load_input(env, self.outputs[0].get_value())
         g = self.outputs[0].get_grad()
-        g = self._do_binary_bprop(env, idx, self._var_a, self._var_b, g)
-        g = self._inv_broadcast(g, idx)
-        return g
-
-    def _do_binary_bprop(self, env, idx, a, b, g):
+        a = self.inputs[0].get_value()
+        b = self.inputs[1].get_value()
+        # the broadcast views are made again rather than kept from the fprop
+        plan = self._get_plan(a.shape, b.shape)
+        a, b = plan.broadcast(a, b)
+        a, b = self._cast_consts(load_input(env, a), load_input(env, b))
+        g = self._do_binary_bprop(env, idx, a, b, y, g)
+        return plan.inv_broadcast(g, idx)
+
+    def _do_binary_bprop(self, env, idx, a, b, y, g):
         raise NotImplementedError()
 
 
 class Add(BinaryElemwiseOprNodeBase):
-    def _do_binary_fprop(self, env, a, b):
-        return a + b
+    def _do_binary_fprop(self, env, a, b, out):
+        return np.add(a, b, out=out)
 
-    def _do_binary_bprop(self, env, idx, a, b, g):
+    def _do_binary_bprop(self, env, idx, a, b, y, g):
         return g
 
 
 class Sub(BinaryElemwiseOprNodeBase):
-    def _do_binary_fprop(self, env, a, b):
-        return a - b
+    def _do_binary_fprop(self, env, a, b, out):
+        return np.subtract(a, b, out=out)
 
-    def _do_binary_bprop(self, env, idx, a, b, g):
+    def _do_binary_bprop(self, env, idx, a, b, y, g):
         if idx == 0:
             return g
         else:
@@ -157,18 +233,18 @@ class Sub(BinaryElemwiseOprNodeBase):
 
 
 class Neg(UnaryElemwiseOprNodeBase):
-    def _do_unary_fprop(self, env, x):
-        return -x
+    def _do_unary_fprop(self, env, x, out):
+        return np.negative(x, out=out)
 
-    def _do_unary_bprop(self, env, g):
+    def _do_unary_bprop(self, env, x, y, g):
         return -g
 
 
 class Mul(BinaryElemwiseOprNodeBase):
-    def _do_binary_fprop(self, env, a, b):
-        return a * b
+    def _do_binary_fprop(self, env, a, b, out):
+        return np.multiply(a, b, out=out)
 
-    def _do_binary_bprop(self, env, idx, a, b, g):
+    def _do_binary_bprop(self, env, idx, a, b, y, g):
         if idx == 0:
             return g * b
         else:
@@ -176,132 +252,188 @@ class Mul(BinaryElemwiseOprNodeBase):
 
 
 class Div(BinaryElemwiseOprNodeBase):
-    def _do_binary_fprop(self, env, a, b):
-        return a / b
+    def _get_out_dtype(self, a, b):
+        return get_float_dtype(a, b)
+
+    def _do_binary_fprop(self, env, a, b, out):
+        return np.true_divide(a, b, out=out)
 
-    def _do_binary_bprop(self, env, idx, a, b, g):
+    def _do_binary_bprop(self, env, idx, a, b, y, g):
         if idx == 0:
-            return g / self.inputs[1].get_value()
+            return g / b
         else:
-            return -g * a / (b ** 2)
+            return -g * y / b
 
 
 class Pow(BinaryElemwiseOprNodeBase):
-    def _do_binary_fprop(self, env, a, b):
-        return a ** b
+    def _do_binary_fprop(self, env, a, b, out):
+        return np.power(a, b, out=out)
 
-    def _do_binary_bprop(self, env, idx, a, b, g):
+    def _do_binary_bprop(self, env, idx, a, b, y, g):
         if idx == 0:
-            return b * (a ** b - 1)
+            return g * b * a ** (b - 1)
         else:
-            return a ** b * np.log(a)
+            return g * y * np.log(a)
 
 
 class Exp(UnaryElemwiseOprNodeBase):
-    def _do_unary_fprop(self, env, x):
-        return np.exp(x)
+    def _get_out_dtype(self, x):
+        return get_float_dtype(x)
+
+    def _do_unary_fprop(self, env, x, out):
+        return np.exp(x, out=out)
 
-    def _do_unary_bprop(self, env, g):
-        return g * self.outputs[0].get_value()
+    def _do_unary_bprop(self, env, x, y, g):
+        return g * y
 
 
 class Log(UnaryElemwiseOprNodeBase):
-    def _do_unary_fprop(self, env, x):
-        return np.log(x)
+    def _get_out_dtype(self, x):
+        return get_float_dtype(x)
 
-    def _do_unary_bprop(self, env, g):
-        return g / self.inputs[0].get_value()
+    def _do_unary_fprop(self, env, x, out):
+        return np.log(x, out=out)
+
+    def _do_unary_bprop(self, env, x, y, g):
+        return g / x
 
 
 class Tanh(UnaryElemwiseOprNodeBase):
-    def _do_unary_fprop(self, env, x):
-        return np.tanh(x)
+    def _get_out_dtype(self, x):
+        return get_float_dtype(x)
+
+    def _do_unary_fprop(self, env, x, out):
+        return np.tanh(x, out=out)
 
-    def _do_unary_bprop(self, env, g):
-        y = self.outputs[0].get_value()
+    def _do_unary_bprop(self, env, x, y, g):
         return g * (1 - y ** 2)
 
 
 class Sum(UnaryElemwiseOprNodeBase):
-    def _do_unary_fprop(self, env, x):
-        return x.sum()
+    __fusible__ = False
 
-    def _do_unary_bprop(self, env, g):
-        return np.ones_like(self.inputs[0].get_value()) * g
+    def _get_out_shape(self, x):
+        return (1, )
 
+    def _do_infer(self, shapes, dtypes):
+        _, dtypes = super()._do_infer(shapes, dtypes)
+        return [(1, )], dtypes
 
-class Max(BinaryElemwiseOprNodeBase):
-    _res_mask = -1
+    def _alloc_output(self, env, shape, dtype):
+        return alloc_output(env, shape, dtype)
 
-    def _do_binary_fprop(self, env, a, b):
-        self._res_mask = m = b > a
-        return m * b + (1 - m) * a
+    def _do_unary_fprop(self, env, x, out):
+        out[0] = x.sum()
+        return out
 
-    def _do_binary_bprop(self, env, idx, a, b, g):
+    def _do_unary_bprop(self, env, x, y, g):
+        return np.broadcast_to(g.astype(x.dtype, copy=False) if x.dtype.kind == 'f' else g, x.shape)
+
+
+class Max(BinaryElemwiseOprNodeBase):
+    def _do_binary_fprop(self, env, a, b, out):
+        return np.maximum(a, b, out=out)
+
+    def _do_binary_bprop(self, env, idx, a, b, y, g):
         if idx == 1:
-            return self._res_mask * g
+            return np.where(b > a, g, 0)
         else:
-            return (1 - self._res_mask) * g
+            return np.where(b > a, 0, g)
 
 
 class Min(BinaryElemwiseOprNodeBase):
-    _res_mask = -1
-
-    def _do_binary_fprop(self, env, a, b):
-        self._res_mask = m = b < a
-        return m * b + (1 - m) * a
+    def _do_binary_fprop(self, env, a, b, out):
+        return np.minimum(a, b, out=out)
 
-    def _do_binary_bprop(self, env, idx, a, b, g):
+    def _do_binary_bprop(self, env, idx, a, b, y, g):
         if idx == 1:
-            return self._res_mask * g
+            return np.where(b < a, g, 0)
         else:
-            return (1 - self._res_mask) * g
+            return np.where(b < a, 0, g)
 
 
 class GreaterEqual(BinaryElemwiseOprNodeBase):
-    def _do_binary_fprop(self, env, a, b):
-        self._res_idx = a >= b
-        return self._res_idx.astype(np.int32)
+    def _get_out_dtype(self, a, b):
+        return np.int32
+
+    def _do_binary_fprop(self, env, a, b, out):
+        return np.greater_equal(a, b, out=out)
 
-    def _do_binary_bprop(self, env, idx, a, b, g):
+    def _do_binary_bprop(self, env, idx, a, b, y, g):
         # print('warning: zero grad opr {}'.format(self.name))
         return 0
 
 
 class GreaterThan(BinaryElemwiseOprNodeBase):
-    def _do_binary_fprop(self, env, a, b):
-        self._res_idx = a > b
-        return self._res_idx.astype(np.int32)
+    def _get_out_dtype(self, a, b):
+        return np.int32
 
-    def _do_binary_bprop(self, env, idx, a, b, g):
+    def _do_binary_fprop(self, env, a, b, out):
+        return np.greater(a, b, out=out)
+
+    def _do_binary_bprop(self, env, idx, a, b, y, g):
         # print('warning: zero grad opr {}'.format(self.name))
         return 0
 
 
 class Equal(BinaryElemwiseOprNodeBase):
-    def _do_binary_fprop(self, env, a, b):
-        self._res_idx = a == b
-        return self._res_idx.astype(np.int32)
+    def _get_out_dtype(self, a, b):
+        return np.int32
+
+    def _do_binary_fprop(self, env, a, b, out):
+        return np.equal(a, b, out=out)
 
-    def _do_binary_bprop(self, env, idx, a, b, g):
+    def _do_binary_bprop(self, env, idx, a, b, y, g):
         # print('warning: zero grad opr {}'.format(self.name))
         return 0
 
 
-class ShapeOf(SISOOprNodeBase):
+class ShapeOprMixin(object):
+    def _get_shape_dtype(self):
+        return np.dtype(np.int_)
+
+
+class ShapeOf(ShapeOprMixin, SISOOprNodeBase):
+    def _do_infer(self, shapes, dtypes):
+        shape = shapes[0]
+        return [None if shape is None else (len(shape), )], [self._get_shape_dtype()]
+
+    def get_static_value(self):
+        shape = self.inputs[0].static_shape
+        if is_shape_known(shape):
+            return np.array(shape, dtype=self._get_shape_dtype())
+        return None
+
     def _do_fprop(self, env):
-        self.outputs[0].set_value(self.inputs[0].get_value().shape)
+        self.outputs[0].set_value(np.array(self.inputs[0].get_value().shape, dtype=self._get_shape_dtype()))
 
     def _do_bprop(self, env, idx):
         return 0
 
 
-class ShapeIdx(SingleOutputOprNodeBase):
+class ShapeIdx(ShapeOprMixin, SingleOutputOprNodeBase):
     __nr_inputs__ = 2
 
+    def _get_static_idx(self):
+        idx = self.inputs[1].owner_opr.get_static_value()
+        return None if idx is None else int(idx[0])
+
+    def _do_infer(self, shapes, dtypes):
+        shape, idx = shapes[0], self._get_static_idx()
+        if shape is not None and idx is not None:
+            assert -len(shape) <= idx < len(shape), 'shape index {} out of range'.format(idx)
+        return [(1, )], [self._get_shape_dtype()]
+
+    def get_static_value(self):
+        shape, idx = self.inputs[0].static_shape, self._get_static_idx()
+        if shape is None or idx is None or shape[idx] is None:
+            return None
+        return np.array((shape[idx], ), dtype=self._get_shape_dtype())
+
     def _do_fprop(self, env):
         idx = self.inputs[1].get_value()
-        self.outputs[0].set_value(self.inputs[0].get_value().shape[idx[0]])
+        shape = self.inputs[0].get_value().shape
+        self.outputs[0].set_value(np.array((shape[int(idx[0])], ), dtype=self._get_shape_dtype()))
 
     def _do_bprop(self, env, idx):
         # print('warning: zero grad opr {}'.format(self.name))
@@ -311,13 +443,26 @@ class ShapeIdx(SingleOutputOprNodeBase):
 class MatrixMul(SingleOutputOprNodeBase):
     __nr_inputs__ = 2
 
+    def _do_infer(self, shapes, dtypes):
+        a, b = shapes
+        assert a is None or len(a) == 2, 'matmul input is not a matrix'
+        assert b is None or len(b) == 2, 'matmul input is not a matrix'
+        shape = None
+        if a is not None and b is not None:
+            merge_dim(a[1], b[0])
+            shape = (a[0], b[1])
+        dtype = None
+        if dtypes[0] is not None and dtypes[1] is not None:
+            dtype = np.result_type(dtypes[0], dtypes[1])
+        return [shape], [dtype]
+
     def _do_fprop(self, env):
-        a, b = map(lambda x: x.get_value(), self.inputs)
+        a, b = map(lambda x: load_input(env, x.get_value()), self.inputs)
         assert len(a.shape) == 2 and len(b.shape) == 2 and a.shape[1] == b.shape[0]
         self.outputs[0].set_value(np.matmul(a, b))
 
     def _do_bprop(self, env, idx):
-        a, b = map(lambda x: x.get_value(), self.inputs)
+        a, b = map(lambda x: load_input(env, x.get_value()), self.inputs)
         g = self.outputs[0].get_grad()
         if idx == 0:
             return np.matmul(g, b.T)
@@ -326,16 +471,36 @@ class MatrixMul(SingleOutputOprNodeBase):
 
 
 class Update(BinaryElemwiseOprNodeBase):
+    __fusible__ = False
+
     def _init_outputs(self):
         from .netsrc import Parameter
         assert isinstance(self.inputs[0].owner_opr, Parameter), self.inputs[0].owner_opr
         super()._init_outputs()
 
-    def _do_binary_fprop(self, env, a, b):
-        self.inputs[0].owner_opr.set_value(a * 0 + b)
-        return b
-
-    def _do_binary_bprop(self, env, idx, a, b, g):
+    def _alloc_output(self, env, shape, dtype):
+        # the new value of a parameter
+        return alloc_output(env, shape, dtype)
+
+    def _get_out_dtype(self, a, b):
+        # a floating parameter keeps its dtype
+        return a.dtype if a.dtype.kind == 'f' else np.result_type(a, b)
+
+    def _do_infer(self, shapes, dtypes):
+        oshapes, odtypes = super()._do_infer(shapes, dtypes)
+        if oshapes[0] is not None:
+            # the new value replaces the one of the parameter
+            assert len(oshapes[0]) == len(shapes[0]), 'update changes the rank of the parameter'
+            for a, b in zip(oshapes[0], shapes[0]):
+                merge_dim(a, b)
+        return oshapes, odtypes
+
+    def _do_binary_fprop(self, env, a, b, out):
+        np.copyto(out, b)
+        self.inputs[0].owner_opr.set_value(out)
+        return out
+
+    def _do_binary_bprop(self, env, idx, a, b, y, g):
         if idx == 0:
             return 0
         else:
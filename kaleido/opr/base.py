@@ -7,6 +7,8 @@
 # This file is part of Kaleido
 # (c) 2016 vccy.xyz
 
+import numpy as np
+
 from ..graph.node import OprNodeBase, VarNode
 
 
@@ -36,3 +38,53 @@ def get_2dshape(x):
         return x, x
     assert type(x) in (tuple, list) and len(x) == 2, x
     return x
+
+
+def alloc_output(env, shape, dtype):
+    if env is None:
+        return np.empty(shape, dtype=dtype)
+    return env.alloc(shape, dtype)
+
+
+def _get_storage_policy(env):
+    policy = None if env is None else env.dtype_policy
+    if policy is None or policy.storage_dtype is None:
+        return None
+    return policy
+
+
+def alloc_activation(env, shape, dtype):
+    """Allocate the output of an opr that may be stored in the storage dtype of the dtype policy."""
+    policy = _get_storage_policy(env)
+    if policy is not None:
+        dtype = policy.get_storage_dtype(np.dtype(dtype))
+    return alloc_output(env, shape, dtype)
+
+
+def load_input(env, x, out=None):
+    """The value of an input as kernels should compute on it: a value stored in the storage dtype of the
+    dtype policy is cast back to the compute dtype (into `out` if given)."""
+    policy = _get_storage_policy(env)
+    if policy is None or x.dtype != policy.storage_dtype:
+        return x
+    if out is None:
+        out = alloc_output(env, x.shape, policy.dtype)
+    np.copyto(out, x)
+    return out
+
+
+def merge_dim(a, b):
+    """Merge two static dims, None being unknown."""
+    if a is None:
+        return b
+    assert b is None or a == b, 'dim mismatch {} vs {}'.format(a, b)
+    return a
+
+
+def is_shape_known(shape):
+    return shape is not None and all(d is not None for d in shape)
+
+
+def dtype_sample(dtype):
+    # an empty array standing for a value of the dtype, for the dtype rules written against arrays
+    return np.empty((0, ), dtype=dtype)
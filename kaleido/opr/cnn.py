@@ -8,32 +8,82 @@
 # (c) 2016 vccy.xyz
 
 
-from .base import SISOOprNodeBase, SingleOutputOprNodeBase, get_2dshape
+import numpy as np
+
+from .base import SISOOprNodeBase, SingleOutputOprNodeBase, get_2dshape, merge_dim, load_input
 from ..graph.node import as_opr_func
 from ..opr_kernel import cnn as cnn_kernel
+from . import conv_algo
+
+
+def get_conv_out_dim(i, k, p, s):
+    if i is None or k is None:
+        return None
+    assert i + 2 * p >= k, 'input size {} (padding {}) smaller than the window {}'.format(i, p, k)
+    return (i + 2 * p - k) // s + 1
+
+
+def check_kernel_dtype(dtype):
+    # the kernels are compiled for float32 only
+    assert dtype is None or dtype == np.float32, 'unsupported dtype {}'.format(dtype)
+    return np.float32
 
 
 class Conv2D(SingleOutputOprNodeBase):
     __nr_inputs__ = 2
 
-    def __init__(self, src, kernel, padding=0, stride=1, name=None):
+    def __init__(self, src, kernel, padding=0, stride=1, algo=None, name=None):
         super().__init__(src, kernel, name=name)
 
+        assert algo is None or algo in conv_algo.get_conv_algos(), 'unknown conv algorithm {}'.format(algo)
         self._padding = get_2dshape(padding)
         self._stride = get_2dshape(stride)
+        self._algo = algo
+        # the autotuner key of the last shapes seen, written only when they change so concurrent calls on
+        # the same shapes share the opr without writing to it
+        self._algo_key = None
+
+    @property
+    def algo(self):
+        """The forward algorithm: the one given at construction, or the one the autotuner chose for the last
+        shapes seen; None before the first call."""
+        if self._algo is not None or self._algo_key is None:
+            return self._algo
+        record = conv_algo.get_conv_autotuner().cache.get(self._algo_key)
+        return None if record is None else record['algo']
+
+    def get_attrs(self):
+        return dict(padding=self._padding, stride=self._stride, algo=self._algo)
+
+    def _do_infer(self, shapes, dtypes):
+        x, k = shapes
+        assert x is None or len(x) == 4, 'conv2d input must be 4D'
+        assert k is None or len(k) == 4, 'conv2d kernel must be 4D'
+        for d in dtypes:
+            check_kernel_dtype(d)
+        shape = None
+        if x is not None and k is not None:
+            merge_dim(x[1], k[1])
+            (ph, pw), (sh, sw) = self._padding, self._stride
+            shape = (x[0], k[0], get_conv_out_dim(x[2], k[2], ph, sh), get_conv_out_dim(x[3], k[3], pw, sw))
+        return [shape], [np.float32]
 
     def _do_fprop(self, env):
-        x = self.inputs[0].get_value()
+        x = load_input(env, self.inputs[0].get_value())
         k = self.inputs[1].get_value()
 
-        ph, pw = self._padding
-        sh, sw = self._stride
-        y = cnn_kernel.conv2d_forward(x, k, ph, pw, sh, sw)
+        algo = self._algo
+        if algo is None:
+            algo = conv_algo.get_conv_autotuner().choose(x, k, self._padding, self._stride)
+            key = conv_algo.get_conv_key(x, k, self._padding, self._stride)
+            if key != self._algo_key:
+                self._algo_key = key
+        y = conv_algo.conv2d_forward(algo, x, k, self._padding, self._stride)
 
         self.outputs[0].set_value(y)
 
     def _do_bprop(self, env, idx):
-        x = self.inputs[0].get_value()
+        x = load_input(env, self.inputs[0].get_value())
         k = self.inputs[1].get_value()
 
         ph, pw = self._padding
@@ -62,19 +112,37 @@ class Pooling2D(SISOOprNodeBase):
         self._stride = get_2dshape(stride)
         self._method = method
 
+    def get_attrs(self):
+        return dict(kernel=self._kernel, padding=self._padding, stride=self._stride, method=self._method)
+
+    def _do_infer(self, shapes, dtypes):
+        x = shapes[0]
+        assert x is None or len(x) == 4, 'pooling2d input must be 4D'
+        check_kernel_dtype(dtypes[0])
+        shape = None
+        if x is not None:
+            (kh, kw), (ph, pw), (sh, sw) = self._kernel, self._padding, self._stride
+            shape = (x[0], x[1], get_conv_out_dim(x[2], kh, ph, sh), get_conv_out_dim(x[3], kw, pw, sw))
+        return [shape], [np.float32]
+
     def _do_fprop(self, env):
-        x = self.inputs[0].get_value()
+        x = load_input(env, self.inputs[0].get_value())
 
         kh, kw = self._kernel
         ph, pw = self._padding
         sh, sw = self._stride
         method = self._method
-        y = cnn_kernel.pooling2d_forward(x, kh, kw, ph, pw, sh, sw, method)
+        if method == 'MAX' and (env is None or env.training):
+            # positions of the maxima, for the backward
+            y, mask = cnn_kernel.pooling2d_forward(x, kh, kw, ph, pw, sh, sw, method, return_mask=True)
+            self._set_call_state('mask', mask)
+        else:
+            y = cnn_kernel.pooling2d_forward(x, kh, kw, ph, pw, sh, sw, method)
 
         self.outputs[0].set_value(y)
 
     def _do_bprop(self, env, idx):
-        x = self.inputs[0].get_value()
+        x = load_input(env, self.inputs[0].get_value())
 
         kh, kw = self._kernel
         ph, pw = self._padding
@@ -83,7 +151,7 @@ class Pooling2D(SISOOprNodeBase):
 
         g = self.outputs[0].get_grad()
 
-        return cnn_kernel.pooling2d_backward(g, x, kh, kw, ph, pw, sh, sw, method)
+        return cnn_kernel.pooling2d_backward(g, x, kh, kw, ph, pw, sh, sw, method, mask=self._get_call_state('mask'))
 
 
 conv2d = as_opr_func(Conv2D)
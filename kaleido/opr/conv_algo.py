@@ -0,0 +1,203 @@
+# -*- coding:utf8 -*-
+# File   : conv_algo.py
+# Author : Jiayuan Mao
+# Email  : maojiayuan@gmail.com
+# Date   : 10/22/26 15:30
+#
+# This file is part of Kaleido
+# (c) 2016 vccy.xyz
+
+import collections
+import json
+import os
+import threading
+import time
+
+import numpy as np
+
+from ..opr_kernel import cnn as cnn_kernel
+
+__all__ = ['get_conv_algos', 'conv2d_forward', 'ConvAutotuner', 'get_conv_autotuner', 'set_conv_autotuner']
+
+
+def _get_out_shape(x, k, padding, stride):
+    (ph, pw), (sh, sw) = padding, stride
+    return (x.shape[0], k.shape[0], (x.shape[2] + 2 * ph - k.shape[2]) // sh + 1,
+            (x.shape[3] + 2 * pw - k.shape[3]) // sw + 1)
+
+
+def _pad(x, padding, h=None, w=None):
+    """Zero-pad `x` by `padding` on each side, then at the bottom/right up to (h, w)."""
+    ph, pw = padding
+    eh = 0 if h is None else max(h - x.shape[2] - 2 * ph, 0)
+    ew = 0 if w is None else max(w - x.shape[3] - 2 * pw, 0)
+    if ph == 0 and pw == 0 and eh == 0 and ew == 0:
+        return x
+    return np.pad(x, ((0, 0), (0, 0), (ph, ph + eh), (pw, pw + ew)), mode='constant')
+
+
+def conv_gemm(x, k, padding, stride):
+    (ph, pw), (sh, sw) = padding, stride
+    return cnn_kernel.conv2d_forward(x, k, ph, pw, sh, sw)
+
+
+def conv_direct(x, k, padding, stride):
+    """One small GEMM per kernel offset over a strided view of the input; no column buffer."""
+    n, oc, oh, ow = _get_out_shape(x, k, padding, stride)
+    sh, sw = stride
+    xp = _pad(x, padding)
+    out = np.zeros([n, oh, ow, oc], dtype=np.float32)
+    for ky in range(k.shape[2]):
+        for kx in range(k.shape[3]):
+            v = xp[:, :, ky:ky + oh * sh:sh, kx:kx + ow * sw:sw]
+            out += np.tensordot(v, k[:, :, ky, kx], axes=([1], [1]))
+    return np.ascontiguousarray(out.transpose(0, 3, 1, 2))
+
+
+def conv_fft(x, k, padding, stride):
+    """Correlation as a product in the frequency domain, summed over the input channels."""
+    n, oc, oh, ow = _get_out_shape(x, k, padding, stride)
+    sh, sw = stride
+    xp = _pad(x, padding)
+    h, w = xp.shape[2], xp.shape[3]
+    fx = np.fft.rfft2(xp, s=(h, w)).astype(np.complex64)
+    fk = np.conj(np.fft.rfft2(k, s=(h, w))).astype(np.complex64)
+    # (h, w', n, c) x (h, w', c, oc) for every frequency
+    fy = np.matmul(fx.transpose(2, 3, 0, 1), fk.transpose(2, 3, 1, 0)).transpose(2, 3, 0, 1)
+    y = np.fft.irfft2(fy, s=(h, w))
+    return np.ascontiguousarray(y[:, :, :(oh - 1) * sh + 1:sh, :(ow - 1) * sw + 1:sw], dtype=np.float32)
+
+
+_WINO_BT = np.array([[1, 0, -1, 0], [0, 1, 1, 0], [0, -1, 1, 0], [0, 1, 0, -1]], dtype=np.float32)
+_WINO_G = np.array([[1, 0, 0], [.5, .5, .5], [.5, -.5, .5], [0, 0, 1]], dtype=np.float32)
+_WINO_AT = np.array([[1, 1, 1, 0], [0, 1, -1, -1]], dtype=np.float32)
+
+
+def conv_winograd(x, k, padding, stride):
+    """Winograd F(2x2, 3x3): 16 GEMMs over 4x4 input tiles, for 3x3 kernels with stride 1."""
+    n, oc, oh, ow = _get_out_shape(x, k, padding, stride)
+    c = x.shape[1]
+    th, tw = (oh + 1) // 2, (ow + 1) // 2
+    xp = np.ascontiguousarray(_pad(x, padding, 2 * th + 2, 2 * tw + 2))
+    s = xp.strides
+    tiles = np.lib.stride_tricks.as_strided(
+        xp, shape=(n, c, th, tw, 4, 4), strides=(s[0], s[1], 2 * s[2], 2 * s[3], s[2], s[3]), writeable=False)
+
+    v = np.matmul(np.matmul(_WINO_BT, tiles), _WINO_BT.T)               # (n, c, th, tw, 4, 4)
+    u = np.matmul(np.matmul(_WINO_G, k), _WINO_G.T)                     # (oc, c, 4, 4)
+    v = v.transpose(4, 5, 1, 0, 2, 3).reshape(16, c, n * th * tw)
+    u = u.transpose(2, 3, 0, 1).reshape(16, oc, c)
+    m = np.matmul(u, v).reshape(4, 4, oc, n, th, tw).transpose(3, 2, 4, 5, 0, 1)
+    y = np.matmul(np.matmul(_WINO_AT, m), _WINO_AT.T)                   # (n, oc, th, tw, 2, 2)
+    y = y.transpose(0, 1, 2, 4, 3, 5).reshape(n, oc, 2 * th, 2 * tw)
+    return np.ascontiguousarray(y[:, :, :oh, :ow], dtype=np.float32)
+
+
+def _winograd_applicable(x, k, padding, stride):
+    return k.shape[2] == 3 and k.shape[3] == 3 and tuple(stride) == (1, 1)
+
+
+# name -> (function, applicability test)
+_CONV_ALGOS = collections.OrderedDict([
+    ('gemm', (conv_gemm, None)),
+    ('direct', (conv_direct, None)),
+    ('fft', (conv_fft, None)),
+    ('winograd', (conv_winograd, _winograd_applicable)),
+])
+
+
+def get_conv_algos(x=None, k=None, padding=(0, 0), stride=(1, 1)):
+    """Names of the conv2d forward algorithms, only the ones applicable to the inputs if given."""
+    if x is None:
+        return list(_CONV_ALGOS.keys())
+    return [name for name, (_, ok) in _CONV_ALGOS.items() if ok is None or ok(x, k, padding, stride)]
+
+
+def conv2d_forward(algo, x, k, padding, stride):
+    return _CONV_ALGOS[algo][0](x, k, padding, stride)
+
+
+def get_conv_key(x, k, padding, stride):
+    return 'x{}_k{}_p{}_s{}_{}'.format(
+        'x'.join(map(str, x.shape)), 'x'.join(map(str, k.shape)),
+        'x'.join(map(str, padding)), 'x'.join(map(str, stride)), np.dtype(x.dtype).name)
+
+
+class ConvAutotuner(object):
+    """Picks the fastest conv2d forward algorithm for each (input shape, kernel shape, padding, stride,
+    dtype), timing every applicable algorithm on the first call with that key.
+
+    The choices (with the timings that led to them) are kept in `cache`, and in the JSON file `cache_file`
+    if given, which is read when the tuner is created and rewritten after every new choice, so later runs
+    skip the tuning.
+    """
+
+    def __init__(self, cache_file=None, nr_runs=3):
+        self._cache_file = cache_file
+        self._nr_runs = nr_runs
+        self._cache = {}
+        self._lock = threading.Lock()
+        if cache_file is not None and os.path.exists(cache_file):
+            with open(cache_file) as f:
+                self._cache.update(json.load(f))
+
+    @property
+    def cache(self):
+        return self._cache
+
+    @property
+    def cache_file(self):
+        return self._cache_file
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+
+    def _benchmark(self, algo, x, k, padding, stride):
+        best = None
+        for _ in range(self._nr_runs):
+            t = time.perf_counter()
+            conv2d_forward(algo, x, k, padding, stride)
+            t = time.perf_counter() - t
+            best = t if best is None else min(best, t)
+        return best
+
+    def choose(self, x, k, padding, stride):
+        key = get_conv_key(x, k, padding, stride)
+        record = self._cache.get(key)
+        if record is not None:
+            return record['algo']
+
+        with self._lock:
+            record = self._cache.get(key)
+            if record is not None:
+                return record['algo']
+            times = {a: self._benchmark(a, x, k, padding, stride) for a in get_conv_algos(x, k, padding, stride)}
+            record = {'algo': min(times, key=times.get), 'times': times}
+            self._cache[key] = record
+            if self._cache_file is not None:
+                self._save()
+        return record['algo']
+
+    def _save(self):
+        # write then rename, so a concurrent reader never sees a partial file
+        tmp = '{}.{}.tmp'.format(self._cache_file, os.getpid())
+        with open(tmp, 'w') as f:
+            json.dump(self._cache, f, indent=2, sort_keys=True)
+        os.replace(tmp, self._cache_file)
+
+
+_default_autotuner = None
+
+
+def get_conv_autotuner():
+    """The tuner used by `Conv2D`; its cache file is $KALEIDO_CONV_CACHE, if set."""
+    global _default_autotuner
+    if _default_autotuner is None:
+        _default_autotuner = ConvAutotuner(os.environ.get('KALEIDO_CONV_CACHE'))
+    return _default_autotuner
+
+
+def set_conv_autotuner(tuner):
+    global _default_autotuner
+    _default_autotuner = tuner
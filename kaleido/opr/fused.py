@@ -0,0 +1,324 @@
+# -*- coding:utf8 -*-
+# File   : fused.py
+# Author : Jiayuan Mao
+# Email  : maojiayuan@gmail.com
+# Date   : 10/19/26 14:15
+#
+# This file is part of Kaleido
+# (c) 2016 vccy.xyz
+
+import math
+
+import numpy as np
+
+from .base import alloc_output, load_input
+from ..graph.node import OprNodeBase
+
+
+class FusedElemwise(OprNodeBase):
+    """A group of elementwise oprs with a single output, created by the fusion pass of `CompGraph.compile`.
+
+    `members` are the original oprs in topological order, the last one being the root whose output var
+    the fused opr produces. The inputs are the vars the group reads from outside.
+
+    When every input is either of one common shape or a single element, the group is evaluated chunk by
+    chunk over the flattened arrays, so that intermediates live in small cache-resident buffers; otherwise
+    it falls back to running the members on whole arrays with their own broadcasting. The backward pass
+    recomputes the intermediates of each chunk instead of keeping them from the forward pass.
+    """
+
+    chunk_size = 16384
+
+    def __init__(self, members, name=None):
+        self._members = tuple(members)
+        self._root = self._members[-1]
+
+        inputs = []
+        input_idx = {}
+        member_idx = {m.outputs[0]: j for j, m in enumerate(self._members)}
+        program = []
+        for m in self._members:
+            refs = []
+            for i in m.inputs:
+                if i in member_idx:
+                    refs.append((False, member_idx[i]))
+                else:
+                    if i not in input_idx:
+                        input_idx[i] = len(inputs)
+                        inputs.append(i)
+                    refs.append((True, input_idx[i]))
+            program.append((m, tuple(refs)))
+        self._program = tuple(program)
+        self._bprop_plans = {}
+
+        super().__init__(*inputs, name=name)
+
+    def _auto_name(self, *inputs):
+        return 'Fused({})@{}'.format(','.join(type(m).__name__ for m in self._members), hex(id(self)))
+
+    @property
+    def members(self):
+        return self._members
+
+    @property
+    def root(self):
+        return self._root
+
+    def _init_outputs(self):
+        self._set_outputs([self._root.outputs[0]])
+
+    def member_input_ref(self, member, idx):
+        """Return (is_input, index) for the idx-th input of a member: an input of the fused opr, or the
+        output of another member."""
+        for m, refs in self._program:
+            if m is member:
+                return refs[idx]
+        raise ValueError('{} is not a member of {}'.format(member, self))
+
+    def _get_chunk_shape(self, xs):
+        shape = None
+        for x in xs:
+            if x.size != 1:
+                if shape is None:
+                    shape = x.shape
+                elif x.shape != shape:
+                    return None
+        return shape
+
+    def _get_scalar_members(self, xs):
+        scalar = []
+        for m, refs in self._program:
+            scalar.append(all(xs[k].size == 1 if is_input else scalar[k] for is_input, k in refs))
+        return scalar
+
+    @staticmethod
+    def _member_fprop(env, member, args, out, chunked):
+        if len(args) == 1:
+            x, = args
+            if out is None:
+                out = alloc_output(env, member._get_out_shape(x), member._get_out_dtype(x))
+            return member._do_unary_fprop(env, x, out)
+
+        a, b = args
+        if not chunked:
+            a, b = member._broadcast(a, b)
+        a, b = member._cast_consts(a, b)
+        if out is None:
+            out = alloc_output(env, np.broadcast_shapes(a.shape, b.shape), member._get_out_dtype(a, b))
+        return member._do_binary_fprop(env, a, b, out)
+
+    @staticmethod
+    def _member_bprop(env, member, idx, args, y, g, chunked):
+        if len(args) == 1:
+            return member._do_unary_bprop(env, args[0], y, g)
+
+        a, b = args
+        plan = None
+        if not chunked:
+            plan = member._get_plan(a.shape, b.shape)
+            a, b = plan.broadcast(a, b)
+        a, b = member._cast_consts(a, b)
+        c = member._do_binary_bprop(env, idx, a, b, y, g)
+        if type(c) in (int, float):
+            return None
+        if chunked:
+            if args[idx].size == 1 and c.size != 1:
+                c = c.sum(keepdims=True).reshape(1)
+            return c
+        return plan.inv_broadcast(c, idx)
+
+    def _get_args(self, refs, xs, tmps):
+        return [xs[k] if is_input else tmps[k] for is_input, k in refs]
+
+    def _forward_tmps(self, env, xs, tmps, skip, root_out, chunked, lo=None, hi=None):
+        last = len(self._program) - 1
+        for j, (m, refs) in enumerate(self._program):
+            if skip[j]:
+                continue
+            out = None
+            if j == last:
+                out = root_out
+            elif chunked:
+                out = tmps[j][:hi - lo] if tmps[j] is not None else None
+            tmps[j] = self._member_fprop(env, m, self._get_args(refs, xs, tmps), out, chunked)
+        return tmps
+
+    def _load_chunks(self, env, xs, bufs, lo, hi):
+        return [x if x.shape[0] == 1 else load_input(env, x[lo:hi], None if b is None else b[:hi - lo])
+                for x, b in zip(xs, bufs)]
+
+    def _get_load_buffers(self, env, xs, size):
+        """Flatten the inputs, casting the single elements stored in the storage dtype of the dtype policy,
+        and allocate the chunk buffers the other ones of that dtype are cast into."""
+        flat, bufs = [], []
+        for x in xs:
+            x = x.reshape(-1)
+            sample = load_input(env, x[:1])
+            buf = None
+            if sample.dtype != x.dtype:
+                if x.shape[0] == 1:
+                    x = sample
+                else:
+                    buf = alloc_output(env, (min(self.chunk_size, size), ), sample.dtype)
+            flat.append(x)
+            bufs.append(buf)
+        return flat, bufs
+
+    def _do_fprop(self, env):
+        xs = [i.get_value() for i in self.inputs]
+        shape = self._get_chunk_shape(xs)
+
+        # a single chunk gains nothing from the chunk buffers but pays for setting them up
+        if shape is None or math.prod(shape) <= self.chunk_size:
+            xs = [load_input(env, x) for x in xs]
+            tmps = [None] * len(self._program)
+            self._forward_tmps(env, xs, tmps, [False] * len(tmps), None, False)
+            self.outputs[0].set_value(tmps[-1])
+            return
+
+        size, chunk = math.prod(shape), self.chunk_size
+        xs, bufs = self._get_load_buffers(env, xs, size)
+        scalar, tmps, dtypes = self._prepare_chunks(env, xs, size)
+        y = self._root._alloc_output(env, shape, dtypes[-1])
+        y_flat = y.reshape(-1)
+
+        for lo in range(0, size, chunk):
+            hi = min(lo + chunk, size)
+            cxs = self._load_chunks(env, xs, bufs, lo, hi)
+            self._forward_tmps(env, cxs, tmps, scalar, y_flat[lo:hi], True, lo, hi)
+        self.outputs[0].set_value(y)
+
+    def _prepare_chunks(self, env, xs, size):
+        """Evaluate the members that only see single elements once, and allocate the chunk buffers of the
+        other intermediates."""
+        scalar = self._get_scalar_members(xs)
+        tmps = [None] * len(self._program)
+        self._forward_tmps(env, xs, tmps, [not s for s in scalar], None, True)
+
+        dtypes = self._get_dtypes(env, xs, tmps, scalar)
+        for j in range(len(tmps) - 1):
+            if not scalar[j]:
+                tmps[j] = alloc_output(env, (min(self.chunk_size, size), ), dtypes[j])
+        return scalar, tmps, dtypes
+
+    def _get_dtypes(self, env, xs, tmps, scalar):
+        samples = []
+        for j, (m, refs) in enumerate(self._program):
+            if scalar[j]:
+                samples.append(tmps[j])
+                continue
+            args = [load_input(env, xs[k][:1]) if is_input else samples[k] for is_input, k in refs]
+            if len(args) == 1:
+                dtype = m._get_out_dtype(args[0])
+            else:
+                dtype = m._get_out_dtype(*m._cast_consts(*args))
+            samples.append(np.empty(1, dtype=dtype))
+        return [s.dtype for s in samples]
+
+    def _get_bprop_plan(self, idxes):
+        plan = self._bprop_plans.get(idxes)
+        if plan is not None:
+            return plan
+
+        # a member input needs grad if it is a requested input or the output of a member that does
+        need = []
+        for m, refs in self._program:
+            need.append(any(k in idxes if is_input else need[k] for is_input, k in refs))
+        plan = []
+        for j, (m, refs) in enumerate(self._program):
+            plan.append(tuple(idx for idx, (is_input, k) in enumerate(refs) if (k in idxes if is_input else need[k])))
+        plan = self._bprop_plans[idxes] = tuple(plan)
+        return plan
+
+    def _backward_chunk(self, env, plan, xs, tmps, y, g, skip, chunked, in_grads, tmp_grads):
+        tgrads = [None] * len(self._program)
+        tgrads[-1] = g
+        tmps[-1] = y
+        for j in reversed(range(len(self._program))):
+            if skip[j] or tgrads[j] is None:
+                continue
+            m, refs = self._program[j]
+            args = self._get_args(refs, xs, tmps)
+            for idx in plan[j]:
+                c = self._member_bprop(env, m, idx, args, tmps[j], tgrads[j], chunked)
+                if c is None:
+                    continue
+                is_input, k = refs[idx]
+                if is_input:
+                    in_grads[k] = c if in_grads[k] is None else in_grads[k] + c
+                elif skip[k]:
+                    tmp_grads[k] = c if tmp_grads[k] is None else tmp_grads[k] + c
+                else:
+                    tgrads[k] = c if tgrads[k] is None else tgrads[k] + c
+
+    def bprop(self, env, idxes):
+        plan = self._get_bprop_plan(tuple(idxes))
+        xs = [i.get_value() for i in self.inputs]
+        y = self.outputs[0].get_value()
+        g = self.outputs[0].get_grad()
+        shape = self._get_chunk_shape(xs)
+        in_grads = [None] * len(xs)
+
+        if shape is None:
+            xs, y = [load_input(env, x) for x in xs], load_input(env, y)
+            tmps = [None] * len(self._program)
+            nr_members = len(tmps)
+            self._forward_tmps(env, xs, tmps, [False] * (nr_members - 1) + [True], None, False)
+            self._backward_chunk(env, plan, xs, tmps, y, g, [False] * nr_members, False, in_grads, None)
+        else:
+            y_flat, g_flat = y.reshape(-1), g.reshape(-1)
+            size, chunk = y_flat.shape[0], self.chunk_size
+            flat, bufs = self._get_load_buffers(env, xs + [y], size)
+            flat, y_flat, y_buf = flat[:-1], flat[-1], bufs[-1]
+            bufs = bufs[:-1]
+            scalar, tmps, _ = self._prepare_chunks(env, flat, size)
+
+            full_grads = [None] * len(xs)
+            full_written = [False] * len(xs)
+            for k in idxes:
+                if flat[k].shape[0] != 1:
+                    full_grads[k] = alloc_output(env, (size, ), np.result_type(flat[k], g))
+            scalar_grads = [None] * len(xs)
+            tmp_grads = [None] * len(self._program)
+
+            for lo in range(0, size, chunk):
+                hi = min(lo + chunk, size)
+                cxs = self._load_chunks(env, flat, bufs, lo, hi)
+                cy, = self._load_chunks(env, [y_flat], [y_buf], lo, hi)
+                ctmps = list(tmps)
+                self._forward_tmps(env, cxs, ctmps, scalar[:-1] + [True], None, True, lo, hi)
+                cgrads = [None] * len(xs)
+                self._backward_chunk(env, plan, cxs, ctmps, cy, g_flat[lo:hi], scalar, True, cgrads, tmp_grads)
+                for k, c in enumerate(cgrads):
+                    if c is None:
+                        continue
+                    if full_grads[k] is not None:
+                        full_grads[k][lo:hi] = c
+                        full_written[k] = True
+                    else:
+                        scalar_grads[k] = c if scalar_grads[k] is None else scalar_grads[k] + c
+
+            # the members computed once on single elements get their grads summed over all chunks
+            for j in reversed(range(len(self._program))):
+                if not scalar[j] or tmp_grads[j] is None:
+                    continue
+                m, refs = self._program[j]
+                args = self._get_args(refs, flat, tmps)
+                for idx in plan[j]:
+                    c = self._member_bprop(env, m, idx, args, tmps[j], tmp_grads[j], True)
+                    if c is None:
+                        continue
+                    is_input, k = refs[idx]
+                    if is_input:
+                        scalar_grads[k] = c if scalar_grads[k] is None else scalar_grads[k] + c
+                    else:
+                        tmp_grads[k] = c if tmp_grads[k] is None else tmp_grads[k] + c
+
+            for k in idxes:
+                if full_written[k]:
+                    in_grads[k] = full_grads[k].reshape(xs[k].shape)
+                elif scalar_grads[k] is not None:
+                    in_grads[k] = scalar_grads[k].reshape(xs[k].shape)
+
+        for k in idxes:
+            self.inputs[k].set_or_accumulate_grad(in_grads[k] if in_grads[k] is not None else 0)
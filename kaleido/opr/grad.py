@@ -17,8 +17,13 @@ class Gradient(SingleOutputOprNodeBase):
     def _auto_name(self, *inputs):
         return 'grad({}, {})'.format(inputs[0].name, inputs[1].name)
 
+    def _do_infer(self, shapes, dtypes):
+        # the dtype of a grad depends on the whole backward pass
+        return [shapes[1]], [None]
+
     def _do_fprop(self, env):
-        self.outputs[0].set_value(self.inputs[1].get_grad())
+        # a sparse grad is passed on as it is, see `SparseGrad`
+        self.outputs[0].set_value(self.inputs[1].get_grad(allow_sparse=True))
 
     def _do_bprop(self, env, idx):
         return 0
@@ -10,55 +10,80 @@
 
 import numpy as np
 
-from .base import SISOOprNodeBase, SingleOutputOprNodeBase
+from .base import SISOOprNodeBase, SingleOutputOprNodeBase, merge_dim
 from ..graph.node import as_opr_func
+from ..graph.sparse import SparseGrad
 
 
 class IndexOnehot(SingleOutputOprNodeBase):
+    """Picks one element of `src` along `axis` for each index of the other axes, at the position in `index`.
+
+    The grad w.r.t. `src` is zero but at the picked elements; with `sparse_grad` it is given as a
+    `SparseGrad`, which an optimizer applies without building the dense grad (e.g. for a huge vocabulary).
+    """
+
     __nr_inputs__ = 2
 
-    def __init__(self, src, index, axis, name=None):
+    def __init__(self, src, index, axis, sparse_grad=False, name=None):
         super().__init__(src, index, name=name)
         self._axis = int(axis)
+        self._sparse_grad = bool(sparse_grad)
+
+    @property
+    def axis(self):
+        return self._axis
+
+    @property
+    def sparse_grad(self):
+        return self._sparse_grad
+
+    def get_attrs(self):
+        return dict(axis=self._axis, sparse_grad=self._sparse_grad)
+
+    def _do_infer(self, shapes, dtypes):
+        x, i = shapes
+        assert x is None or self._axis < len(x), 'axis {} out of range'.format(self._axis)
+        if x is None:
+            return [i], [dtypes[0]]
+        shape = x[:self._axis] + x[self._axis + 1:]
+        if i is not None:
+            assert len(i) == len(shape), 'index of rank {} for {}'.format(len(i), shape)
+            shape = tuple(merge_dim(a, b) for a, b in zip(shape, i))
+        return [shape], [dtypes[0]]
 
     def _do_fprop(self, env):
         x = self.inputs[0].get_value()
         i = self.inputs[1].get_value()
-        assert len(x.shape) == len(i.shape) + 1 and self._axis <= len(x.shape)
+        assert len(x.shape) == len(i.shape) + 1 and self._axis < len(x.shape)
 
-        xshape = x.shape
-        axis, ndim, alen = self._axis, len(xshape), xshape[self._axis]
-
-        x_hat = np.moveaxis(x, axis, -1).reshape(-1, alen)
-        i_hat = i.reshpae(-1)
-        y_hat = x_hat[np.arange(x_hat.shape[0]), i_hat]
-        y = y_hat.reshape(xshape[:axis] + xshape[axis+1:])
-
-        self.outputs[0].set_value(y)
+        # gathers in the layout of x, without moving the axis to the end
+        y = np.take_along_axis(x, np.expand_dims(i, self._axis), axis=self._axis)
+        self.outputs[0].set_value(y.squeeze(self._axis))
 
     def _do_bprop(self, env, idx):
-        if idx == 0:
-            x = self.inputs[0].get_value()
-            i = self.inputs[1].get_value()
-
-            g = self.outputs[0].get_grad()
-
-            xshape = x.shape
-            axis, ndim, alen = self._axis, len(xshape), xshape[self._axis]
+        if idx != 0:
+            return 0
 
-            i_hat = i.reshpae(-1)
-            g_hat = g.reshape(-1)
-            r_hat = np.zeros((i.shape[0], alen), dtype=x.dtype)
-            r_hat[np.arange(r_hat.shape[0]), i_hat] = g_hat
+        x = self.inputs[0].get_value()
+        i = self.inputs[1].get_value()
+        g = self.outputs[0].get_grad()
+        if self._sparse_grad:
+            return SparseGrad(i, g, x.shape, self._axis)
 
-            r = r_hat.reshape(xshape[:axis] + xshape[axis+1:] + (alen, ))
-            r = np.moveaxis(r, -1, axis)
-            return r
-        else:
-            return 0
+        r = np.zeros(x.shape, dtype=g.dtype)
+        np.put_along_axis(r, np.expand_dims(i, self._axis), np.expand_dims(g, self._axis), axis=self._axis)
+        return r
 
 
 class Flatten2(SISOOprNodeBase):
+    def _do_infer(self, shapes, dtypes):
+        x = shapes[0]
+        if x is None:
+            return [None], dtypes
+        assert len(x) >= 1, 'can not flatten a scalar'
+        rest = x[1:]
+        return [(x[0], None if None in rest else int(np.prod(rest)))], dtypes
+
     def _do_fprop(self, env):
         x = self.inputs[0].get_value()
         y = x.reshape(x.shape[0], -1)
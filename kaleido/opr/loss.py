@@ -0,0 +1,112 @@
+# -*- coding:utf8 -*-
+# File   : loss.py
+# Author : Jiayuan Mao
+# Email  : maojiayuan@gmail.com
+# Date   : 10/23/26 19:20
+#
+# This file is part of Kaleido
+# (c) 2016 vccy.xyz
+
+import numpy as np
+
+from .base import SingleOutputOprNodeBase, alloc_output, load_input, merge_dim
+from ..graph.node import as_opr_func
+
+
+class SoftmaxCrossEntropy(SingleOutputOprNodeBase):
+    """Cross entropy of the softmax of `logits` along `axis` with the classes `labels`, one value per sample:
+    logsumexp(x) - x[label], without overflow for large logits.
+
+    The grad w.r.t. the logits is (softmax(x) - onehot(label)) * g; the softmax is computed again from the
+    log-sum-exp of every sample kept from the fprop, and the one-hot matrix is never built.
+    """
+
+    __nr_inputs__ = 2
+
+    def __init__(self, logits, labels, axis=1, name=None):
+        super().__init__(logits, labels, name=name)
+        self._axis = int(axis)
+
+    @property
+    def axis(self):
+        return self._axis
+
+    def get_attrs(self):
+        return dict(axis=self._axis)
+
+    def _do_infer(self, shapes, dtypes):
+        x, i = shapes
+        dtype = None if dtypes[0] is None else np.result_type(dtypes[0], np.float32)
+        if x is None:
+            return [i], [dtype]
+        assert -len(x) <= self._axis < len(x), 'axis {} out of range for {}'.format(self._axis, x)
+        axis = self._axis % len(x)
+        shape = x[:axis] + x[axis + 1:]
+        if i is not None:
+            assert len(i) == len(shape), 'labels of rank {} for {}'.format(len(i), shape)
+            shape = tuple(merge_dim(a, b) for a, b in zip(shape, i))
+        return [shape], [dtype]
+
+    def _get_rows(self, env):
+        """The logits as a (samples, classes) matrix, the labels as a vector and the axis."""
+        x = load_input(env, self.inputs[0].get_value())
+        i = self.inputs[1].get_value()
+        assert len(x.shape) == len(i.shape) + 1, 'labels of shape {} for logits of shape {}'.format(i.shape, x.shape)
+        assert i.dtype.kind in 'iu', 'labels must be integers, got {}'.format(i.dtype)
+
+        axis = self._axis % len(x.shape)
+        x = x.astype(np.result_type(x.dtype, np.float32), copy=False)
+        x_hat = np.moveaxis(x, axis, -1).reshape(-1, x.shape[axis])
+        return x_hat, i.reshape(-1), axis
+
+    @staticmethod
+    def _logsumexp(env, x_hat):
+        m = x_hat.max(axis=1, keepdims=True)
+        e = alloc_output(env, x_hat.shape, x_hat.dtype)
+        np.subtract(x_hat, m, out=e)
+        np.exp(e, out=e)
+        res = np.log(e.sum(axis=1))
+        res += m[:, 0]
+        return res
+
+    def _do_fprop(self, env):
+        x_hat, i_hat, _ = self._get_rows(env)
+        lse = self._logsumexp(env, x_hat)
+        self._set_call_state('lse', lse)
+        y = lse - x_hat[np.arange(x_hat.shape[0]), i_hat]
+        self.outputs[0].set_value(y.reshape(self.inputs[1].get_value().shape))
+
+    def _do_bprop(self, env, idx):
+        if idx != 0:
+            return 0
+
+        x = self.inputs[0].get_value()
+        x_hat, i_hat, axis = self._get_rows(env)
+        g = self.outputs[0].get_grad()
+        lse = self._get_call_state('lse')
+        if lse is None:
+            lse = self._logsumexp(env, x_hat)
+
+        r_hat = alloc_output(env, x_hat.shape, x_hat.dtype)
+        np.subtract(x_hat, lse[:, np.newaxis], out=r_hat)
+        np.exp(r_hat, out=r_hat)
+        r_hat[np.arange(r_hat.shape[0]), i_hat] -= 1
+        r_hat *= g.reshape(-1, 1)
+
+        r = r_hat.reshape(x.shape[:axis] + x.shape[axis + 1:] + (x.shape[axis], ))
+        return np.moveaxis(r, -1, axis)
+
+
+class FusedSoftmaxCrossEntropy(SoftmaxCrossEntropy):
+    """Stands in the compiled schedule for `index_onehot(-log(softmax(logits)), labels)`, found by the pattern
+    rewrite of `CompGraph.compile`; it produces the output var of the `index_onehot`."""
+
+    def __init__(self, var, logits, labels, axis):
+        self._var = var
+        super().__init__(logits, labels, axis=axis, name='fused({})'.format(var.name))
+
+    def _init_outputs(self):
+        self._set_outputs([self._var])
+
+
+softmax_cross_entropy = as_opr_func(SoftmaxCrossEntropy)
@@ -8,7 +8,9 @@
 # (c) 2016 vccy.xyz
 
 from .base import SingleOutputOprNodeBase
-from ..graph.node import as_opr_func
+from ..graph.node import as_opr_func, as_numpy_array
+
+import numpy as np
 
 
 class NetSrcOprNodeBase(SingleOutputOprNodeBase):
@@ -20,18 +22,41 @@ class NetSrcOprNodeBase(SingleOutputOprNodeBase):
 
 
 class PlaceHolder(NetSrcOprNodeBase):
-    def __init__(self, name, **kwargs):
+    def __init__(self, name, shape=None, dtype=None, **kwargs):
         super().__init__(name=name, **kwargs)
-        self._value = None
+        self._shape = None if shape is None else tuple(shape)
+        self._dtype = None if dtype is None else np.dtype(dtype)
+
+    @property
+    def shape(self):
+        return self._shape
+
+    @property
+    def dtype(self):
+        return self._dtype
+
+    def get_attrs(self):
+        return dict(shape=self._shape, dtype=self._dtype)
 
+    # the fed value belongs to the call, so it is kept in the current frame
     def set_value(self, value):
-        self._value = value
+        self._set_call_state('value', value)
 
     def get_value(self):
-        return self._value
+        return self._get_call_state('value')
+
+    def _do_infer(self, shapes, dtypes):
+        return [self._shape], [self._dtype]
 
     def _do_fprop(self, env):
-        self.outputs[0].set_value(self._value)
+        value = self.get_value()
+        if self._dtype is not None:
+            value = np.asarray(value, dtype=self._dtype)
+        if self._shape is not None:
+            shape = as_numpy_array(value).shape
+            assert len(shape) == len(self._shape) and all(a is None or a == b for a, b in zip(self._shape, shape)), \
+                'input {} of shape {} does not match the declared shape {}'.format(self.name, shape, self._shape)
+        self.outputs[0].set_value(value)
 
     def _do_bprop(self, env, idx):
         return 0
@@ -41,12 +66,39 @@ class Parameter(NetSrcOprNodeBase):
     def __init__(self, value, name=None):
         super().__init__(name=name)
         self._value = value
+        self._pinned = False
 
     def get_value(self):
         return self._value
 
+    def get_attrs(self):
+        return dict(value=as_numpy_array(self._value))
+
+    def _do_infer(self, shapes, dtypes):
+        value = as_numpy_array(self._value)
+        # integer initial values get upcast by the first update
+        return [value.shape], [value.dtype if value.dtype.kind in 'fc' else None]
+
     def set_value(self, value):
-        self._value = value
+        if self._pinned:
+            np.copyto(self._value, value)
+        else:
+            self._value = value
+
+    @property
+    def pinned(self):
+        return self._pinned
+
+    def pin_value(self, buf):
+        """Move the value into `buf` (e.g. an array in shared memory); later `set_value` calls copy into
+        it in place instead of rebinding the value."""
+        np.copyto(buf, self._value)
+        self._value = buf
+        self._pinned = True
+
+    def unpin_value(self):
+        self._value = np.array(self._value)
+        self._pinned = False
 
     def _do_fprop(self, env):
         self.outputs[0].set_value(self._value)
@@ -63,6 +115,16 @@ class Immutable(NetSrcOprNodeBase):
     def get_value(self):
         return self._value
 
+    def get_static_value(self):
+        return as_numpy_array(self._value)
+
+    def get_attrs(self):
+        return dict(value=as_numpy_array(self._value))
+
+    def _do_infer(self, shapes, dtypes):
+        value = as_numpy_array(self._value)
+        return [value.shape], [value.dtype]
+
     def set_value(self, value):
         self._value = value
 
@@ -73,6 +135,30 @@ class Immutable(NetSrcOprNodeBase):
         return 0
 
 
+class FoldedConstant(NetSrcOprNodeBase):
+    """Stands in the compiled schedule for an opr whose output is known at compile time; it produces the
+    output var of that opr without reading its inputs."""
+
+    def __init__(self, var, value):
+        self._var = var
+        super().__init__(name='folded({})'.format(var.name))
+        self._value = as_numpy_array(value)
+
+    def _init_outputs(self):
+        self._set_outputs([self._var])
+
+    def get_static_value(self):
+        return self._value
+
+    def _do_infer(self, shapes, dtypes):
+        return [self._value.shape], [self._value.dtype]
+
+    def _do_fprop(self, env):
+        self.outputs[0].set_value(self._value)
+
+    def _do_bprop(self, env, idx):
+        return 0
+
 
 placeholder = as_opr_func(PlaceHolder)
 parameter = as_opr_func(Parameter)
@@ -0,0 +1,58 @@
+# -*- coding:utf8 -*-
+# File   : optim.py
+# Author : Jiayuan Mao
+# Email  : maojiayuan@gmail.com
+# Date   : 10/21/26 20:15
+#
+# This file is part of Kaleido
+# (c) 2016 vccy.xyz
+
+from .base import SingleOutputOprNodeBase
+
+
+class ApplyUpdate(SingleOutputOprNodeBase):
+    """Applies one step of an optimizer to a parameter in place; inputs are the parameter, its grad and the
+    learning rate. The output is the updated value of the parameter, sharing its buffer.
+
+    The optimizer is saved by `save_graph` as its `get_config`; a loaded opr gets a new optimizer of that
+    type, whose learning rate is the loaded lr parameter and whose state (e.g. momentum) starts empty.
+    """
+
+    __nr_inputs__ = 3
+    __inplace_inputs__ = (0, )
+
+    def __init__(self, param, grad, lr, optimizer, name=None):
+        super().__init__(param, grad, lr, name=name)
+        if isinstance(optimizer, dict):
+            from ..optim.optimizer import Optimizer
+            optimizer = Optimizer.from_config(optimizer, self.inputs[2].owner_opr)
+            optimizer.params.append(self.param)
+        self._optimizer = optimizer
+
+    def _init_outputs(self):
+        from .netsrc import Parameter
+        assert isinstance(self.inputs[0].owner_opr, Parameter), self.inputs[0].owner_opr
+        super()._init_outputs()
+
+    @property
+    def param(self):
+        return self.inputs[0].owner_opr
+
+    @property
+    def optimizer(self):
+        return self._optimizer
+
+    def get_attrs(self):
+        return dict(optimizer=self._optimizer.get_config())
+
+    def _do_infer(self, shapes, dtypes):
+        return [shapes[0]], [dtypes[0]]
+
+    def _do_fprop(self, env):
+        g = self.inputs[1].get_value(allow_sparse=True)
+        lr = float(self.inputs[2].get_value().reshape(-1)[0])
+        value = self._optimizer.apply(self.param, g, lr)
+        self.outputs[0].set_value(value)
+
+    def _do_bprop(self, env, idx):
+        return 0
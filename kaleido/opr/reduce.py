@@ -11,7 +11,7 @@ import numpy as np
 
 from itertools import chain
 
-from .base import SISOOprNodeBase
+from .base import SISOOprNodeBase, dtype_sample, load_input
 from ..graph.node import as_opr_func
 
 
@@ -21,22 +21,50 @@ class ReduceOprNodeBase(SISOOprNodeBase):
         self._axis = int(axis)
         self._keepdims = bool(keepdims)
 
+    @property
+    def axis(self):
+        return self._axis
+
+    @property
+    def keepdims(self):
+        return self._keepdims
+
+    def get_attrs(self):
+        return dict(axis=self._axis, keepdims=self._keepdims)
+
+    def _do_infer(self, shapes, dtypes):
+        x = shapes[0]
+        dtype = None if dtypes[0] is None else self._get_out_dtype(dtypes[0])
+        if x is None:
+            return [None], [dtype]
+        assert -len(x) <= self._axis < len(x), 'axis {} out of range for {}'.format(self._axis, x)
+        axis = self._axis % len(x)
+        if self._keepdims:
+            shape = x[:axis] + (1, ) + x[axis + 1:]
+        else:
+            shape = x[:axis] + x[axis + 1:]
+        return [shape or (1, )], [dtype]
+
+    def _get_out_dtype(self, dtype):
+        return dtype
+
     def _do_fprop(self, env):
-        x = self.inputs[0].get_value()
+        x = load_input(env, self.inputs[0].get_value())
         self.outputs[0].set_value(self._do_reduce_fprop(x, self._axis, self._keepdims, env))
 
     def _do_bprop(self, env, idx):
         g = self.outputs[0].get_grad()
-        x = self.inputs[0].get_value()
+        x = load_input(env, self.inputs[0].get_value())
 
-        assert self._axis < len(x.shape), (x.shape, self._axis)
+        assert -len(x.shape) <= self._axis < len(x.shape), (x.shape, self._axis)
 
         xshape = x.shape
-        axis, ndim, alen = self._axis, len(xshape), xshape[self._axis]
+        axis = self._axis % len(xshape)
+        alen = xshape[axis]
 
         g_hat = g.reshape(-1)
-        r_hat = np.zeros((g_hat.shape[0], alen), dtype=x.dtype)
-        r_hat = self._do_reduce_bprop(g_hat, x, axis, env)
+        r_hat = np.zeros((g_hat.shape[0], alen), dtype=np.result_type(x.dtype, g.dtype))
+        self._do_reduce_bprop(g_hat, x, r_hat, axis, env)
         r = r_hat.reshape(xshape[:axis] + xshape[axis + 1:] + (alen,))
         r = np.moveaxis(r, -1, axis)
         return r
@@ -67,12 +95,14 @@ class ReduceMin(ReduceOprNodeBase):
 
 
 class ReduceSum(ReduceOprNodeBase):
+    def _get_out_dtype(self, dtype):
+        return np.sum(dtype_sample(dtype)).dtype
+
     def _do_reduce_fprop(self, x, axis, keepdims, env):
         return np.sum(x, axis=axis, keepdims=keepdims)
 
     def _do_reduce_bprop(self, g, x, r_hat, axis, env):
-        n = r_hat.shape[0]
-        r_hat[np.arange(n), :] = g
+        r_hat[...] = g[:, np.newaxis]
 
 reduce_max = as_opr_func(ReduceMax)
 reduce_min = as_opr_func(ReduceMin)
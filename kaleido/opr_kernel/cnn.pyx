@@ -3,79 +3,180 @@
 # Author : Jiayuan Mao
 # Email  : maojiayuan@gmail.com
 # Date   : 10/27/16 19:57
-# 
+#
 # This file is part of Kaleido
 # (c) 2016 vccy.xyz
 
+# cython: boundscheck=False, wraparound=False, cdivision=True, initializedcheck=False
+
+import os
 
 import numpy as np
 cimport numpy as np
+from cython.parallel cimport prange
 
 dtype = np.float32
 ctypedef np.float32_t dtype_t
 
+ctypedef fused mask_t:
+    np.uint8_t
+    np.int32_t
 
-def conv2d_forward(np.ndarray[dtype_t, ndim=4] src, np.ndarray[dtype_t, ndim=4] kernel,
-                   int ph, int pw, int sh, int sw):
-    assert src.shape[1] == kernel.shape[1], 'input channel mismatch'
-    assert src.shape[2] >= kernel.shape[2] and src.shape[3] >= kernel.shape[3], 'input size too small'
 
-    cdef int n = src.shape[0]
-    cdef int ih = src.shape[2], iw = src.shape[3], ic = src.shape[1]
-    cdef int kh = kernel.shape[2], kw = kernel.shape[3]
-    cdef int oc = kernel.shape[0]
-    cdef int oh = (ih + 2 * ph - kh) / sh + 1
-    cdef int ow = (iw + 2 * pw - kw) / sw + 1
+# threads of the OpenMP loops; 0 for all the cores
+_nr_threads = 0
+# upper bound of the column buffer of one batch chunk of a convolution, in bytes
+_workspace_limit = 64 * 1024 * 1024
+
+
+def get_nr_threads():
+    return _nr_threads if _nr_threads > 0 else (os.cpu_count() or 1)
+
+
+def set_nr_threads(int nr_threads):
+    global _nr_threads
+    assert nr_threads >= 0
+    _nr_threads = nr_threads
+
+
+def get_workspace_limit():
+    return _workspace_limit
+
+
+def set_workspace_limit(int nbytes):
+    global _workspace_limit
+    assert nbytes > 0
+    _workspace_limit = nbytes
+
 
-    src_padded = np.pad(src, ((0, 0), (0, 0), (ph, ph), (pw, pw)), mode='constant')
-    out = np.zeros([n, oc, oh, ow], dtype=src.dtype)
+def get_batch_chunk(int n, int ic, int kh, int kw, int oh, int ow, int chunk=0):
+    """Number of images lowered at once: `chunk` if given, otherwise as many as fit the workspace limit."""
+    if chunk <= 0:
+        chunk = _workspace_limit // max(ic * kh * kw * oh * ow * np.dtype(dtype).itemsize, 1)
+    return int(max(1, min(chunk, n)))
 
-    for i in range(n):
-        for j in range(oc):
-            tmp = np.zeros([oh, ow], dtype=src.dtype)
-            for k in range(ic):
-                sub_kernel = kernel[j, k, :, :]
-                sub_img = src_padded[j, k, :, :]
+
+def _prefix(buf, shape):
+    """A contiguous array of `shape` at the beginning of `buf`."""
+    return buf.reshape(-1)[:int(np.prod(shape))].reshape(shape)
+
+
+def _contiguous(x):
+    return np.ascontiguousarray(x, dtype=dtype)
+
+
+cdef void _im2col(dtype_t[:, :, :, ::1] src, int lo, int hi, int kh, int kw, int ph, int pw, int sh, int sw,
+                  int oh, int ow, dtype_t[:, ::1] cols, int nr_threads) noexcept nogil:
+    """Lower the windows of images [lo, hi) of `src` into `cols`, of shape (c * kh * kw, b * oh * ow): row
+    (c, ky, kx) holds pixel (oy * sh + ky - ph, ox * sw + kx - pw) of channel c for every (b, oy, ox), zero
+    in the padding."""
+    cdef int c = src.shape[1], ih = src.shape[2], iw = src.shape[3]
+    cdef int t, b, ci, ky, kx, oy, ox, iy, ix, row, col
+    for t in prange((hi - lo) * c, num_threads=nr_threads, schedule='static'):
+        b = t // c
+        ci = t % c
+        for ky in range(kh):
+            for kx in range(kw):
+                row = (ci * kh + ky) * kw + kx
                 for oy in range(oh):
-                    y0 = oy * sh
-                    y1 = y0 + kh
+                    iy = oy * sh + ky - ph
+                    col = (b * oh + oy) * ow
                     for ox in range(ow):
-                        x0 = ox * sw
-                        x1 = x0 + kw
-                        tmp[oy, ox] += np.sum(sub_img[y0:y1, x0:x1] * sub_kernel)
-            out[i, j] = tmp
+                        ix = ox * sw + kx - pw
+                        if 0 <= iy < ih and 0 <= ix < iw:
+                            cols[row, col + ox] = src[lo + b, ci, iy, ix]
+                        else:
+                            cols[row, col + ox] = 0
 
-    return out
+
+cdef void _col2im(dtype_t[:, ::1] cols, int lo, int hi, int kh, int kw, int ph, int pw, int sh, int sw,
+                  int oh, int ow, dtype_t[:, :, :, ::1] out, int nr_threads) noexcept nogil:
+    """Add the column matrix back into images [lo, hi) of `out`, the inverse of `_im2col`. Each (image,
+    channel) plane is owned by one thread."""
+    cdef int c = out.shape[1], ih = out.shape[2], iw = out.shape[3]
+    cdef int t, b, ci, ky, kx, oy, ox, iy, ix, row, col
+    for t in prange((hi - lo) * c, num_threads=nr_threads, schedule='static'):
+        b = t // c
+        ci = t % c
+        for ky in range(kh):
+            for kx in range(kw):
+                row = (ci * kh + ky) * kw + kx
+                for oy in range(oh):
+                    iy = oy * sh + ky - ph
+                    if iy < 0 or iy >= ih:
+                        continue
+                    col = (b * oh + oy) * ow
+                    for ox in range(ow):
+                        ix = ox * sw + kx - pw
+                        if 0 <= ix < iw:
+                            out[lo + b, ci, iy, ix] += cols[row, col + ox]
 
 
-def pooling2d_forward(np.ndarray[dtype_t, ndim=4] src, int kh, int kw, int ph, int pw, int sh, int sw, method):
+cdef void _gather_grad(dtype_t[:, :, :, ::1] grad, int lo, int hi, dtype_t[:, ::1] out,
+                       int nr_threads) noexcept nogil:
+    """Copy the output grad of images [lo, hi) into `out` as a matrix (oc, b * oh * ow)."""
+    cdef int oc = grad.shape[1], oh = grad.shape[2], ow = grad.shape[3]
+    cdef int t, b, o, y, x
+    for t in prange((hi - lo) * oc, num_threads=nr_threads, schedule='static'):
+        b = t // oc
+        o = t % oc
+        for y in range(oh):
+            for x in range(ow):
+                out[o, (b * oh + y) * ow + x] = grad[lo + b, o, y, x]
+
+
+cdef void _scatter_output(dtype_t[:, ::1] res, int lo, int hi, dtype_t[:, :, :, ::1] out,
+                          int nr_threads) noexcept nogil:
+    """Copy the GEMM result (oc, b * oh * ow) of images [lo, hi) into `out` (n, oc, oh, ow)."""
+    cdef int oc = out.shape[1], oh = out.shape[2], ow = out.shape[3]
+    cdef int t, b, o, y, x
+    for t in prange((hi - lo) * oc, num_threads=nr_threads, schedule='static'):
+        b = t // oc
+        o = t % oc
+        for y in range(oh):
+            for x in range(ow):
+                out[lo + b, o, y, x] = res[o, (b * oh + y) * ow + x]
+
+
+def conv2d_forward(np.ndarray[dtype_t, ndim=4] src, np.ndarray[dtype_t, ndim=4] kernel,
+                   int ph, int pw, int sh, int sw, int chunk=0):
+    assert src.shape[1] == kernel.shape[1], 'input channel mismatch'
+    assert src.shape[2] + 2 * ph >= kernel.shape[2] and src.shape[3] + 2 * pw >= kernel.shape[3], \
+        'input size too small'
+
     cdef int n = src.shape[0]
     cdef int ih = src.shape[2], iw = src.shape[3], ic = src.shape[1]
+    cdef int kh = kernel.shape[2], kw = kernel.shape[3]
+    cdef int oc = kernel.shape[0]
     cdef int oh = (ih + 2 * ph - kh) / sh + 1
     cdef int ow = (iw + 2 * pw - kw) / sw + 1
+    cdef int lo, hi, nt = get_nr_threads()
+    cdef dtype_t[:, :, :, ::1] xv, outv
+    cdef dtype_t[:, ::1] colv, resv
 
-    src_padded = np.pad(src, ((0, 0), (0, 0), (ph, ph), (pw, pw)), mode='constant')
-    out = np.zeros([n, ic, oh, ow], dtype=src.dtype)
+    chunk = get_batch_chunk(n, ic, kh, kw, oh, ow, chunk)
+    xv = _contiguous(src)
+    cols = np.empty(ic * kh * kw * chunk * oh * ow, dtype=dtype)
+    res = np.empty(oc * chunk * oh * ow, dtype=dtype)
+    kmat = _contiguous(kernel).reshape(oc, ic * kh * kw)
+    out = outv = np.empty([n, oc, oh, ow], dtype=dtype)
+
+    # one GEMM per batch chunk: (oc, ic * kh * kw) x (ic * kh * kw, b * oh * ow)
+    for lo in range(0, n, chunk):
+        hi = min(lo + chunk, n)
+        col = colv = _prefix(cols, (ic * kh * kw, (hi - lo) * oh * ow))
+        with nogil:
+            _im2col(xv, lo, hi, kh, kw, ph, pw, sh, sw, oh, ow, colv, nt)
+        resv = np.dot(kmat, col, out=_prefix(res, (oc, col.shape[1])))
+        with nogil:
+            _scatter_output(resv, lo, hi, outv, nt)
 
-    for i in range(n):
-        for c in range(ic):
-            for oy in range(oh):
-                y0 = oy * sh
-                y1 = y0 + kh
-                for ox in range(ow):
-                    x0 = ox * sw
-                    x1 = x0 + kw
-                    sub_src = src_padded[i, c, y0:y1, x0:x1]
-                    if method == 'MAX':
-                        out[i, c, oy, ox] = sub_src.max()
-                    else:
-                        out[i, c, oy, ox] = sub_src.mean()
     return out
 
 
 def conv2d_backward_data(np.ndarray[dtype_t, ndim=4] grad,
                          np.ndarray[dtype_t, ndim=4] src, np.ndarray[dtype_t, ndim=4] kernel,
-                         int ph, int pw, int sh, int sw):
+                         int ph, int pw, int sh, int sw, int chunk=0):
 
     cdef int n = src.shape[0]
     cdef int ih = src.shape[2], iw = src.shape[3], ic = src.shape[1]
@@ -83,77 +184,275 @@ def conv2d_backward_data(np.ndarray[dtype_t, ndim=4] grad,
     cdef int oc = kernel.shape[0]
     cdef int oh = (ih + 2 * ph - kh) / sh + 1
     cdef int ow = (iw + 2 * pw - kw) / sw + 1
+    cdef int lo, hi, nt = get_nr_threads()
+    cdef dtype_t[:, :, :, ::1] gv, outv
+    cdef dtype_t[:, ::1] gmatv, colv
 
-    out = np.zeros([n, ic, ih + 2 * ph, iw + 2 * pw])
-
-    for i in range(n):
-        for j in range(ic):
-            for k in range(oc):
-                x_hat = np.dot(grad[i, j, :, :].reshape(-1, 1), kernel[k, j, :, :].reshape(1, -1))
-                x_hat = x_hat.reshape(oh, ow, kh, kw)
+    chunk = get_batch_chunk(n, ic, kh, kw, oh, ow, chunk)
+    gv = _contiguous(grad)
+    gbuf = np.empty(oc * chunk * oh * ow, dtype=dtype)
+    cols = np.empty(ic * kh * kw * chunk * oh * ow, dtype=dtype)
+    kmat_t = _contiguous(kernel).reshape(oc, ic * kh * kw).T
+    out = outv = np.zeros([n, ic, ih, iw], dtype=dtype)
 
-                for oy in range(oh):
-                    y0 = oy * sh
-                    y1 = y0 + kh
-                    for ox in range(ow):
-                        x0 = ox * sw
-                        x1 = x0 + kw
-                        out[i, j, y0:y1, x0:x1] += x_hat[oy, ox, :, :]
-    return out[:, :, ph:-ph, pw:-pw]
+    # (ic * kh * kw, oc) x (oc, b * oh * ow), then col2im
+    for lo in range(0, n, chunk):
+        hi = min(lo + chunk, n)
+        gmat = gmatv = _prefix(gbuf, (oc, (hi - lo) * oh * ow))
+        with nogil:
+            _gather_grad(gv, lo, hi, gmatv, nt)
+        colv = np.dot(kmat_t, gmat, out=_prefix(cols, (ic * kh * kw, gmat.shape[1])))
+        with nogil:
+            _col2im(colv, lo, hi, kh, kw, ph, pw, sh, sw, oh, ow, outv, nt)
+    return out
 
 
 def conv2d_backward_kernel(np.ndarray[dtype_t, ndim=4] grad,
                            np.ndarray[dtype_t, ndim=4] src, np.ndarray[dtype_t, ndim=4] kernel,
-                           int ph, int pw, int sh, int sw):
+                           int ph, int pw, int sh, int sw, int chunk=0):
     cdef int n = src.shape[0]
     cdef int ih = src.shape[2], iw = src.shape[3], ic = src.shape[1]
     cdef int kh = kernel.shape[2], kw = kernel.shape[3]
     cdef int oc = kernel.shape[0]
     cdef int oh = (ih + 2 * ph - kh) / sh + 1
     cdef int ow = (iw + 2 * pw - kw) / sw + 1
+    cdef int lo, hi, nt = get_nr_threads()
+    cdef dtype_t[:, :, :, ::1] xv, gv
+    cdef dtype_t[:, ::1] colv, gmatv
+
+    chunk = get_batch_chunk(n, ic, kh, kw, oh, ow, chunk)
+    xv = _contiguous(src)
+    gv = _contiguous(grad)
+    gbuf = np.empty(oc * chunk * oh * ow, dtype=dtype)
+    cols = np.empty(ic * kh * kw * chunk * oh * ow, dtype=dtype)
+    out = np.zeros([oc, ic * kh * kw], dtype=dtype)
+    tmp = np.empty_like(out)
+
+    # (oc, b * oh * ow) x (b * oh * ow, ic * kh * kw), summed over the chunks
+    for lo in range(0, n, chunk):
+        hi = min(lo + chunk, n)
+        col = colv = _prefix(cols, (ic * kh * kw, (hi - lo) * oh * ow))
+        gmat = gmatv = _prefix(gbuf, (oc, col.shape[1]))
+        with nogil:
+            _im2col(xv, lo, hi, kh, kw, ph, pw, sh, sw, oh, ow, colv, nt)
+            _gather_grad(gv, lo, hi, gmatv, nt)
+        out += np.dot(gmat, col.T, out=tmp)
+    return out.reshape(oc, ic, kh, kw)
+
 
-    src_padded = np.pad(src, ((0, 0), (0, 0), (ph, ph), (pw, pw)), mode='constant')
-    out = np.zeros_like(kernel)
+def get_mask_dtype(int kh, int kw):
+    """The compact dtype of the argmax indices of max pooling: an index into the flattened window."""
+    return np.uint8 if kh * kw <= 256 else np.int32
 
-    for k in range(oc):
-        for j in range(ic):
-            w_hat = np.zeros((kh, kw), dtype=kernel.dtype)
-            for i in range(n):
-                sub_src = src_padded[i, j, :, :]
-                sub_grad = grad[i, k, :, :]
 
+def _is_tiled(int ih, int iw, int kh, int kw, int ph, int pw, int sh, int sw):
+    # non-overlapping windows covering the whole input: every pixel belongs to exactly one window
+    return kh == sh and kw == sw and ph == 0 and pw == 0 and ih % kh == 0 and iw % kw == 0
+
+
+cdef void _max_pool(dtype_t[:, :, :, ::1] src, int kh, int kw, int ph, int pw, int sh, int sw,
+                    dtype_t[:, :, :, ::1] out, mask_t[:, :, :, ::1] mask, bint with_mask,
+                    int nr_threads) noexcept nogil:
+    # the padding counts as zeros; the first maximum of a window wins, like argmax
+    cdef int c = src.shape[1], ih = src.shape[2], iw = src.shape[3]
+    cdef int oh = out.shape[2], ow = out.shape[3]
+    cdef int t, b, ci, oy, ox, ky, kx, iy, ix, best_idx
+    cdef dtype_t v, best
+    for t in prange(src.shape[0] * c, num_threads=nr_threads, schedule='static'):
+        b = t // c
+        ci = t % c
+        for oy in range(oh):
+            for ox in range(ow):
+                best_idx = -1
+                best = 0
                 for ky in range(kh):
+                    iy = oy * sh + ky - ph
                     for kx in range(kw):
-                        ss_src = sub_src[ky:ky+oh*sh:sh, kx:kx+ow*sw:sw]
-                        w_hat[ky, kx] += np.sum(ss_src * sub_grad)
-            out[k, j, :, :] += w_hat
+                        ix = ox * sw + kx - pw
+                        if 0 <= iy < ih and 0 <= ix < iw:
+                            v = src[b, ci, iy, ix]
+                        else:
+                            v = 0
+                        if best_idx < 0 or v > best:
+                            best = v
+                            best_idx = ky * kw + kx
+                out[b, ci, oy, ox] = best
+                if with_mask:
+                    mask[b, ci, oy, ox] = <mask_t>best_idx
 
 
-def pooling2d_backward(np.ndarray[dtype_t, ndim=4] grad, np.ndarray[dtype_t, ndim=4] src,
-                       int kh, int kw, int ph, int pw, int sh, int sw, method):
+cdef void _max_pool_tiled(dtype_t[:, :, :, ::1] src, int kh, int kw, dtype_t[:, :, :, ::1] out,
+                          mask_t[:, :, :, ::1] mask, bint with_mask, int nr_threads) noexcept nogil:
+    # `_max_pool` of windows tiling the input: without bounds and padding checks, each window offset is a
+    # branchless pass over a row of outputs, which the compiler vectorizes; the mask is then the first
+    # offset holding the maximum, picked with integer selects rather than branches
+    cdef int c = src.shape[1], oh = out.shape[2], ow = out.shape[3]
+    cdef int t, b, ci, oy, ox, ky, kx, k, idx
+    cdef dtype_t v, cur
+    for t in prange(src.shape[0] * c, num_threads=nr_threads, schedule='static'):
+        b = t // c
+        ci = t % c
+        for oy in range(oh):
+            for ox in range(ow):
+                out[b, ci, oy, ox] = src[b, ci, oy * kh, ox * kw]
+            for k in range(1, kh * kw):
+                ky = k // kw
+                kx = k % kw
+                for ox in range(ow):
+                    v = src[b, ci, oy * kh + ky, ox * kw + kx]
+                    cur = out[b, ci, oy, ox]
+                    out[b, ci, oy, ox] = v if v > cur else cur
+            if with_mask:
+                for ox in range(ow):
+                    cur = out[b, ci, oy, ox]
+                    idx = 0
+                    for k in range(kh * kw - 1, -1, -1):
+                        idx = k if src[b, ci, oy * kh + k // kw, ox * kw + k % kw] == cur else idx
+                    mask[b, ci, oy, ox] = <mask_t>idx
+
+
+cdef void _max_unpool(dtype_t[:, :, :, ::1] grad, mask_t[:, :, :, ::1] mask, int kh, int kw, int ph, int pw,
+                      int sh, int sw, dtype_t[:, :, :, ::1] out, int nr_threads) noexcept nogil:
+    cdef int c = out.shape[1], ih = out.shape[2], iw = out.shape[3]
+    cdef int oh = grad.shape[2], ow = grad.shape[3]
+    cdef int t, b, ci, oy, ox, iy, ix, idx
+    for t in prange(out.shape[0] * c, num_threads=nr_threads, schedule='static'):
+        b = t // c
+        ci = t % c
+        for oy in range(oh):
+            for ox in range(ow):
+                idx = mask[b, ci, oy, ox]
+                iy = oy * sh + idx // kw - ph
+                ix = ox * sw + idx % kw - pw
+                if 0 <= iy < ih and 0 <= ix < iw:
+                    out[b, ci, iy, ix] += grad[b, ci, oy, ox]
+
+
+cdef void _avg_pool(dtype_t[:, :, :, ::1] src, int kh, int kw, int ph, int pw, int sh, int sw,
+                    dtype_t[:, :, :, ::1] out, int nr_threads) noexcept nogil:
+    # the padding counts as zeros in the mean
+    cdef int c = src.shape[1], ih = src.shape[2], iw = src.shape[3]
+    cdef int oh = out.shape[2], ow = out.shape[3]
+    cdef int t, b, ci, oy, ox, ky, kx, iy, ix
+    cdef dtype_t s
+    for t in prange(src.shape[0] * c, num_threads=nr_threads, schedule='static'):
+        b = t // c
+        ci = t % c
+        for oy in range(oh):
+            for ox in range(ow):
+                s = 0
+                for ky in range(kh):
+                    iy = oy * sh + ky - ph
+                    if iy < 0 or iy >= ih:
+                        continue
+                    for kx in range(kw):
+                        ix = ox * sw + kx - pw
+                        if 0 <= ix < iw:
+                            s = s + src[b, ci, iy, ix]
+                out[b, ci, oy, ox] = s / (kh * kw)
+
 
+cdef void _avg_unpool(dtype_t[:, :, :, ::1] grad, int kh, int kw, int ph, int pw, int sh, int sw,
+                      dtype_t[:, :, :, ::1] out, int nr_threads) noexcept nogil:
+    cdef int c = out.shape[1], ih = out.shape[2], iw = out.shape[3]
+    cdef int oh = grad.shape[2], ow = grad.shape[3]
+    cdef int t, b, ci, oy, ox, ky, kx, iy, ix
+    cdef dtype_t g
+    for t in prange(out.shape[0] * c, num_threads=nr_threads, schedule='static'):
+        b = t // c
+        ci = t % c
+        for oy in range(oh):
+            for ox in range(ow):
+                g = grad[b, ci, oy, ox] / (kh * kw)
+                for ky in range(kh):
+                    iy = oy * sh + ky - ph
+                    if iy < 0 or iy >= ih:
+                        continue
+                    for kx in range(kw):
+                        ix = ox * sw + kx - pw
+                        if 0 <= ix < iw:
+                            out[b, ci, iy, ix] += g
+
+
+def pooling2d_forward(np.ndarray[dtype_t, ndim=4] src, int kh, int kw, int ph, int pw, int sh, int sw, method,
+                      return_mask=False):
+    """Pool `src`. With `return_mask`, max pooling also returns the position of the maximum in each window,
+    as an index into the flattened window, to be passed to `pooling2d_backward`."""
     cdef int n = src.shape[0]
     cdef int ih = src.shape[2], iw = src.shape[3], ic = src.shape[1]
     cdef int oh = (ih + 2 * ph - kh) / sh + 1
     cdef int ow = (iw + 2 * pw - kw) / sw + 1
-    cdef int ks = kw * kh
+    cdef int nt = get_nr_threads()
+    cdef bint with_mask = return_mask
+    cdef bint tiled = _is_tiled(ih, iw, kh, kw, ph, pw, sh, sw)
+    cdef dtype_t[:, :, :, ::1] xv, outv
+    cdef np.uint8_t[:, :, :, ::1] mask8
+    cdef np.int32_t[:, :, :, ::1] mask32
 
-    src_padded = np.pad(src, ((0, 0), (0, 0), (ph, ph), (pw, pw)), mode='constant')
-    out = np.zeros([n, ic, ih + 2 * ph, iw + 2 * pw], dtype=src.dtype)
+    xv = _contiguous(src)
+    out = outv = np.empty([n, ic, oh, ow], dtype=dtype)
+    mask = None
+    if method == 'MAX':
+        # a dummy mask when it is not asked for, only its type matters
+        mask = np.empty([n, ic, oh, ow] if with_mask else [1, 1, 1, 1], dtype=get_mask_dtype(kh, kw))
+        if mask.dtype == np.uint8:
+            mask8 = mask
+            with nogil:
+                if tiled:
+                    _max_pool_tiled(xv, kh, kw, outv, mask8, with_mask, nt)
+                else:
+                    _max_pool(xv, kh, kw, ph, pw, sh, sw, outv, mask8, with_mask, nt)
+        else:
+            mask32 = mask
+            with nogil:
+                if tiled:
+                    _max_pool_tiled(xv, kh, kw, outv, mask32, with_mask, nt)
+                else:
+                    _max_pool(xv, kh, kw, ph, pw, sh, sw, outv, mask32, with_mask, nt)
+        if not with_mask:
+            mask = None
+    else:
+        with nogil:
+            _avg_pool(xv, kh, kw, ph, pw, sh, sw, outv, nt)
 
-    for i in range(n):
-        for c in range(ic):
-            for oy in range(oh):
-                y0 = oy * sh
-                y1 = y0 + kh
-                for ox in range(ow):
-                    x0 = ox * sw
-                    x1 = x0 + kw
-                    sub_src = src_padded[i, c, y0:y1, x0:x1]
-                    if method == 'MAX':
-                        ind = np.unravel_index(sub_src.argmax(), sub_src.shape)
-                        out[i, c, y0+ind[0], x0+ind[1]] += grad[i, c, oy, ox]
-                    else:
-                        out[i, c, y0:y1, x0:x1] += grad[i, c, oy, ox] / float(ks)
-
-    return out[:, :, ph:-ph, pw:-pw]
+    if return_mask:
+        return out, mask
+    return out
+
+
+def pooling2d_backward(np.ndarray[dtype_t, ndim=4] grad, np.ndarray[dtype_t, ndim=4] src,
+                       int kh, int kw, int ph, int pw, int sh, int sw, method, mask=None):
+    """Grad of pooling w.r.t. `src`. Max pooling routes the grad through `mask`, as returned by
+    `pooling2d_forward`, which is recomputed if not given."""
+    cdef int n = src.shape[0]
+    cdef int ih = src.shape[2], iw = src.shape[3], ic = src.shape[1]
+    cdef int nt = get_nr_threads()
+    cdef dtype_t[:, :, :, ::1] gv, outv
+    cdef np.uint8_t[:, :, :, ::1] mask8
+    cdef np.int32_t[:, :, :, ::1] mask32
+
+    if method == 'MAX' and mask is None:
+        _, mask = pooling2d_forward(src, kh, kw, ph, pw, sh, sw, method, return_mask=True)
+
+    g = gv = _contiguous(grad)
+    if _is_tiled(ih, iw, kh, kw, ph, pw, sh, sw) and method != 'MAX':
+        # every pixel gets the grad of its only window
+        out = np.repeat(np.repeat(g / float(kh * kw), kh, axis=2), kw, axis=3)
+        return _contiguous(out)
+
+    out = outv = np.zeros([n, ic, ih, iw], dtype=dtype)
+    if method == 'MAX':
+        # tiled or not, scattering one grad per window into zeros is cheaper than writing every pixel
+        mask = np.ascontiguousarray(mask)
+        if mask.dtype == np.uint8:
+            mask8 = mask
+            with nogil:
+                _max_unpool(gv, mask8, kh, kw, ph, pw, sh, sw, outv, nt)
+        else:
+            mask32 = mask
+            with nogil:
+                _max_unpool(gv, mask32, kh, kw, ph, pw, sh, sw, outv, nt)
+    else:
+        with nogil:
+            _avg_unpool(gv, kh, kw, ph, pw, sh, sw, outv, nt)
+    return out
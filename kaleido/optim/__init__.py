@@ -0,0 +1,10 @@
+# -*- coding:utf8 -*-
+# File   : __init__.py
+# Author : Jiayuan Mao
+# Email  : maojiayuan@gmail.com
+# Date   : 10/21/26 20:15
+#
+# This file is part of Kaleido
+# (c) 2016 vccy.xyz
+
+from .optimizer import Optimizer, SGD, Adam
@@ -0,0 +1,213 @@
+# -*- coding:utf8 -*-
+# File   : optimizer.py
+# Author : Jiayuan Mao
+# Email  : maojiayuan@gmail.com
+# Date   : 10/21/26 20:15
+#
+# This file is part of Kaleido
+# (c) 2016 vccy.xyz
+
+import sys
+
+import numpy as np
+
+from ..graph.node import as_numpy_array
+from ..graph.sparse import SparseGrad
+
+
+class Optimizer(object):
+    """Base of the optimizers. `minimize(loss)` adds, for every parameter under the loss, one opr updating it
+    in place from its grad, and returns the outputs of these oprs to compile along with the loss.
+
+    The learning rate is a parameter of the graph, so it can be changed between calls through `lr`. The
+    update kernels run chunk by chunk over the flattened parameter with a small scratch buffer, and the
+    optimizer state lives in buffers allocated on the first step. A sparse grad (see `SparseGrad`) only
+    updates its entries when the optimizer allows it (`_apply_sparse`), else it is made dense.
+    """
+
+    chunk_size = 16384
+
+    def __init__(self, lr):
+        from ..opr.netsrc import Parameter
+
+        self._lr = Parameter(np.array([lr], dtype=np.float64), name='lr')
+        self._params = []
+        self._states = {}
+
+    @property
+    def lr(self):
+        return float(as_numpy_array(self._lr.get_value())[0])
+
+    @lr.setter
+    def lr(self, lr):
+        self._lr.set_value(np.full_like(as_numpy_array(self._lr.get_value()), lr))
+
+    @property
+    def lr_param(self):
+        return self._lr
+
+    @property
+    def params(self):
+        return self._params
+
+    def minimize(self, loss, params=None):
+        from ..graph.fprop import CompGraph
+        from ..opr.grad import grad
+        from ..opr.netsrc import Parameter
+        from ..opr.optim import ApplyUpdate
+
+        if params is None:
+            params = [o for o in CompGraph().find_all_oprs([loss]) if isinstance(o, Parameter)]
+        else:
+            params = [p.owner_opr if not isinstance(p, Parameter) else p for p in params]
+
+        updates = []
+        for p in params:
+            opr = ApplyUpdate(p.outputs[0], grad(loss, p.outputs[0]), self._lr.outputs[0], self,
+                              name='{}({})'.format(type(self).__name__, p.name))
+            updates.append(opr.outputs[0])
+            self._params.append(p)
+        return updates
+
+    def get_config(self):
+        """The type of the optimizer and its hyperparameters but the learning rate, which is a parameter of the
+        graph, for serialization; see `from_config`."""
+        cls = type(self)
+        return {'type': '{}.{}'.format(cls.__module__, cls.__qualname__), 'args': self._get_args()}
+
+    @staticmethod
+    def from_config(config, lr_param):
+        """Rebuild an optimizer described by `get_config`, with the `Parameter` lr_param as learning rate.
+        Its class must be defined in an already imported module."""
+        from ..opr.netsrc import Parameter
+
+        assert isinstance(lr_param, Parameter), 'the learning rate is not a parameter: {}'.format(lr_param)
+        module, _, qualname = config['type'].rpartition('.')
+        assert module in sys.modules, 'unknown optimizer class {}: import its module first'.format(config['type'])
+        cls = sys.modules[module]
+        for part in qualname.split('.'):
+            cls = getattr(cls, part)
+        assert isinstance(cls, type) and issubclass(cls, Optimizer), 'not an optimizer class: {}'.format(cls)
+
+        optimizer = cls(0., **config['args'])
+        optimizer._lr = lr_param
+        return optimizer
+
+    def _get_args(self):
+        return {}
+
+    def reset(self):
+        """Drop the optimizer state (e.g. momentum)."""
+        self._states = {}
+
+    def _get_state(self, param):
+        """Per-parameter state: the flattened value, updated in place, the scratch buffer and the buffers of
+        the optimizer."""
+        value = param.get_value()
+        state = self._states.get(param)
+        if state is not None and state['value'] is value:
+            return state
+
+        value = as_numpy_array(value)
+        if value.dtype.kind != 'f' or not value.flags.c_contiguous or not value.flags.writeable:
+            value = np.array(value, dtype=value.dtype if value.dtype.kind == 'f' else np.float64)
+            param.set_value(value)
+            value = param.get_value()
+
+        flat = value.reshape(-1)
+        if state is None or state['flat'].shape != flat.shape or state['flat'].dtype != flat.dtype:
+            state = {'step': 0}
+            state.update({k: np.zeros_like(flat) for k in self._get_buffer_names()})
+        state['value'] = value
+        state['flat'] = flat
+        state['tmp'] = np.empty(min(self.chunk_size, flat.shape[0]), dtype=flat.dtype)
+        self._states[param] = state
+        return state
+
+    def apply(self, param, grad, lr):
+        state = self._get_state(param)
+        state['step'] += 1
+        if type(grad) is SparseGrad:
+            if self._apply_sparse(state['value'], grad, lr):
+                return state['value']
+            grad = grad.to_dense()
+
+        flat = state['flat']
+        g = np.broadcast_to(grad, state['value'].shape).reshape(-1)
+        for lo in range(0, flat.shape[0], self.chunk_size):
+            hi = min(lo + self.chunk_size, flat.shape[0])
+            chunks = {k: state[k][lo:hi] for k in self._get_buffer_names()}
+            self._apply_chunk(flat[lo:hi], g[lo:hi], state['tmp'][:hi - lo], lr, state['step'], **chunks)
+        return state['value']
+
+    def _get_buffer_names(self):
+        return ()
+
+    def _apply_sparse(self, p, g, lr):
+        # the update touching the entries of the sparse grad only, if it equals the dense one; False if not
+        return False
+
+    def _apply_chunk(self, p, g, tmp, lr, step, **buffers):
+        raise NotImplementedError()
+
+
+class SGD(Optimizer):
+    """p -= lr * v, with v = momentum * v + g (v = g without momentum)."""
+
+    def __init__(self, lr, momentum=0):
+        super().__init__(lr)
+        self._momentum = float(momentum)
+
+    def _get_args(self):
+        return {'momentum': self._momentum}
+
+    def _get_buffer_names(self):
+        return ('velocity', ) if self._momentum != 0 else ()
+
+    def _apply_sparse(self, p, g, lr):
+        # the velocity decays everywhere
+        if self._momentum != 0:
+            return False
+        g.add_to(p, -lr)
+        return True
+
+    def _apply_chunk(self, p, g, tmp, lr, step, velocity=None):
+        if velocity is not None:
+            velocity *= self._momentum
+            velocity += g
+            g = velocity
+        np.multiply(g, lr, out=tmp)
+        p -= tmp
+
+
+class Adam(Optimizer):
+    """Adam with bias-corrected moments."""
+
+    def __init__(self, lr=1e-3, beta1=0.9, beta2=0.999, eps=1e-8):
+        super().__init__(lr)
+        self._beta1 = float(beta1)
+        self._beta2 = float(beta2)
+        self._eps = float(eps)
+
+    def _get_args(self):
+        return {'beta1': self._beta1, 'beta2': self._beta2, 'eps': self._eps}
+
+    def _get_buffer_names(self):
+        return ('m', 'v')
+
+    def _apply_chunk(self, p, g, tmp, lr, step, m, v):
+        b1, b2 = self._beta1, self._beta2
+        m *= b1
+        np.multiply(g, 1 - b1, out=tmp)
+        m += tmp
+        v *= b2
+        np.multiply(g, g, out=tmp)
+        tmp *= 1 - b2
+        v += tmp
+
+        lr_t = lr * np.sqrt(1 - b2 ** step) / (1 - b1 ** step)
+        np.sqrt(v, out=tmp)
+        tmp += self._eps
+        np.divide(m, tmp, out=tmp)
+        tmp *= lr_t
+        p -= tmp
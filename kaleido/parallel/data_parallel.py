@@ -0,0 +1,277 @@
+# -*- coding:utf8 -*-
+# File   : data_parallel.py
+# Author : Jiayuan Mao
+# Email  : maojiayuan@gmail.com
+# Date   : 10/20/26 10:20
+#
+# This file is part of Kaleido
+# (c) 2016 vccy.xyz
+
+import os
+import math
+import threading
+import traceback
+import multiprocessing as mp
+from multiprocessing.shared_memory import SharedMemory
+
+import numpy as np
+
+from ..graph.node import as_numpy_array
+
+
+def _shared_array(shape, dtype):
+    dtype = np.dtype(dtype)
+    shm = SharedMemory(create=True, size=max(math.prod(shape) * dtype.itemsize, 1))
+    return shm, np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+
+
+class DataParallelTrainer(object):
+    """Runs a compiled training `Function` in `nr_workers` forked processes, each on a shard of the minibatch.
+
+    Array inputs (or only the ones named in `split_inputs`) are split along their first axis; other inputs
+    are passed to every worker as they are. The values of all the `Parameter`s of the graph are moved into
+    shared memory, so workers never exchange weights: each worker runs the forward and backward phases on
+    its shard, the outputs of the `grad` oprs are all-reduced through shared memory, and worker 0 alone
+    runs the post-grad phase, whose `update` oprs write the shared parameters in place. The numeric array
+    inputs of every call are also written once to shared memory, where each worker reads its rows.
+
+    `grad_reduce` is 'sum' or 'mean'. Summing the grads of the shards matches a single-process call when
+    the loss sums over the minibatch; use 'mean' when it is a mean over the minibatch, which each worker
+    takes over its shard (the grads are then scaled by 1 / nr_workers).
+
+    Calling the trainer returns the outputs of the function: outputs computed from the inputs are
+    concatenated over the shards (or reduced like the grads when every shard gives a single element),
+    the others are taken from worker 0. Hooks and `nr_threads` of the function are not used by workers.
+    The parameters go back to private memory on `close`.
+    """
+
+    def __init__(self, func, nr_workers=None, grad_reduce='sum', split_inputs=None):
+        from ..opr.grad import Gradient
+        from ..opr.netsrc import Parameter, PlaceHolder
+
+        assert grad_reduce in ('mean', 'sum'), grad_reduce
+        plan = func.plan
+        assert len(plan.grad_steps) != 0, 'the function computes no grad'
+
+        self._func = func
+        self._nr_workers = nr_workers or os.cpu_count()
+        self._grad_reduce = grad_reduce
+        self._split_inputs = None if split_inputs is None else set(split_inputs)
+
+        self._shms = []
+        # the inputs of the current call, reallocated when too small
+        self._feed_shm = None
+        self._params = [v.owner_opr for v in plan.varnodes if isinstance(v.owner_opr, Parameter)]
+        for p in self._params:
+            value = as_numpy_array(p.get_value())
+            if value.dtype.kind not in 'fc':
+                value = value.astype(np.float64)
+            shm, buf = _shared_array(value.shape, value.dtype)
+            self._shms.append(shm)
+            p.pin_value(buf)
+
+        self._grad_vars = []
+        grad_shapes = []
+        for sched in plan.grad_steps:
+            for opr in sched.grad_oprs:
+                assert isinstance(opr, Gradient)
+                wrt = opr.inputs[1].owner_opr
+                assert isinstance(wrt, Parameter), 'can only all-reduce grads of parameters: {}'.format(opr.name)
+                self._grad_vars.append(opr.outputs[0])
+                grad_shapes.append(wrt.get_value().shape)
+
+        dtype = np.result_type(*[p.get_value() for p in self._params])
+        sizes = [math.prod(s) for s in grad_shapes]
+        offsets = [0]
+        for s in sizes:
+            offsets.append(offsets[-1] + s)
+        total = offsets[-1]
+        shm, self._grad_slots = _shared_array((self._nr_workers, total), dtype)
+        self._shms.append(shm)
+        shm, self._grad_reduced = _shared_array((total, ), dtype)
+        self._shms.append(shm)
+        self._grad_ranges = [(lo, hi, shape) for lo, hi, shape in zip(offsets[:-1], offsets[1:], grad_shapes)]
+
+        # outputs not depending on the inputs are the same on all workers
+        batched = {o for opr in plan.pre_grad if isinstance(opr, PlaceHolder) for o in opr.outputs}
+        for opr in plan.pre_grad:
+            if any(i in batched for i in opr.inputs):
+                batched.update(opr.outputs)
+        self._sharded_outputs = tuple(i for i, slot in enumerate(plan.outputs) if plan.varnodes[slot] in batched)
+
+        ctx = mp.get_context('fork')
+        self._barrier = ctx.Barrier(self._nr_workers)
+        self._conns = []
+        self._workers = []
+        for rank in range(self._nr_workers):
+            parent, child = ctx.Pipe()
+            w = ctx.Process(target=self._worker_main, args=(rank, child), daemon=True)
+            w.start()
+            child.close()
+            self._conns.append(parent)
+            self._workers.append(w)
+        self._lock = threading.Lock()
+
+    @property
+    def nr_workers(self):
+        return self._nr_workers
+
+    @property
+    def function(self):
+        return self._func
+
+    def _write_feeds(self, kwargs):
+        """Copy the numeric array inputs to the shared block and describe the feeds of a call for the workers:
+        ('shm', offset, dtype, shape, split) for the ones in the block, ('value', value) for the others."""
+        feeds, arrays = {}, []
+        nbytes = 0
+        for name, value in kwargs.items():
+            value = np.asarray(value)
+            split = value.ndim != 0 and (self._split_inputs is None or name in self._split_inputs)
+            if split:
+                assert value.shape[0] >= self._nr_workers, \
+                    'input {} has fewer rows than workers: {}'.format(name, value.shape)
+            if value.ndim == 0 or value.dtype.kind not in 'biufc':
+                feeds[name] = ('value', value)
+                continue
+            feeds[name] = ('shm', nbytes, value.dtype.str, value.shape, split)
+            arrays.append((nbytes, value))
+            nbytes += (value.nbytes + 63) // 64 * 64
+
+        if self._feed_shm is None or self._feed_shm.size < nbytes:
+            if self._feed_shm is not None:
+                self._feed_shm.close()
+                self._feed_shm.unlink()
+            self._feed_shm = SharedMemory(create=True, size=max(nbytes, 1))
+        for offset, value in arrays:
+            np.ndarray(value.shape, value.dtype, buffer=self._feed_shm.buf, offset=offset)[...] = value
+        return self._feed_shm.name, feeds
+
+    def _read_feeds(self, rank, shm_name, feeds):
+        # in a worker: read-only views of its rows of the shared inputs
+        if self._feed_shm is None or self._feed_shm.name != shm_name:
+            if self._feed_shm is not None:
+                try:
+                    self._feed_shm.close()
+                except BufferError:
+                    pass  # still viewed by some value; the mapping goes away with the last view
+            self._feed_shm = SharedMemory(name=shm_name)
+        res = {}
+        for name, desc in feeds.items():
+            if desc[0] == 'value':
+                res[name] = desc[1]
+                continue
+            _, offset, dtype, shape, split = desc
+            value = np.ndarray(shape, dtype, buffer=self._feed_shm.buf, offset=offset)
+            if split:
+                # the rows np.array_split gives to `rank`
+                n, k = shape[0], self._nr_workers
+                lo = rank * (n // k) + min(rank, n % k)
+                value = value[lo:lo + n // k + (rank < n % k)]
+            value.flags.writeable = False
+            res[name] = value
+        return res
+
+    def _worker_main(self, rank, conn):
+        while True:
+            msg = conn.recv()
+            if msg is None:
+                break
+            try:
+                conn.send((None, self._worker_step(rank, self._read_feeds(rank, *msg))))
+            except threading.BrokenBarrierError:
+                # another worker failed and reports the error
+                conn.send(('', None))
+            except BaseException:
+                self._barrier.abort()
+                conn.send((traceback.format_exc(), None))
+        conn.close()
+
+    def _worker_step(self, rank, feeds):
+        with self._func.new_frame():
+            return self._run_shard(rank, feeds)
+
+    def _run_shard(self, rank, feeds):
+        func = self._func
+        func.feed(feeds)
+        func.run_grad_phases()
+
+        slots = self._grad_slots[rank]
+        for var, (lo, hi, shape) in zip(self._grad_vars, self._grad_ranges):
+            slots[lo:hi].reshape(shape)[...] = var.get_value().reshape(shape)
+        self._barrier.wait()
+
+        # reduce-scatter: every worker reduces its own range of the flattened grads
+        total = self._grad_reduced.shape[0]
+        lo, hi = total * rank // self._nr_workers, total * (rank + 1) // self._nr_workers
+        out = self._grad_reduced[lo:hi]
+        np.sum(self._grad_slots[:, lo:hi], axis=0, out=out)
+        if self._grad_reduce == 'mean':
+            np.multiply(out, 1 / self._nr_workers, out=out)
+        self._barrier.wait()
+
+        if rank != 0:
+            return func.get_outputs(self._sharded_outputs)
+
+        for var, (lo, hi, shape) in zip(self._grad_vars, self._grad_ranges):
+            var.set_value(self._grad_reduced[lo:hi].reshape(shape))
+        func.run_post_grad()
+        return func.get_outputs()
+
+    def _merge_outputs(self, results):
+        outputs = list(results[0])
+        for k, i in enumerate(self._sharded_outputs):
+            values = [outputs[i]] + [r[k] for r in results[1:]]
+            if all(v.size == 1 for v in values):
+                value = np.sum(values, axis=0)
+                if self._grad_reduce == 'mean':
+                    value = value / len(values)
+            else:
+                value = np.concatenate(values, axis=0)
+            outputs[i] = value
+        return outputs
+
+    def __call__(self, **kwargs):
+        with self._lock:
+            assert self._conns is not None, 'the trainer is closed'
+            msg = self._write_feeds(kwargs)
+            for conn in self._conns:
+                conn.send(msg)
+            replies = [conn.recv() for conn in self._conns]
+
+            errors = [e for e, _ in replies if e is not None]
+            if len(errors) != 0:
+                self._barrier.reset()
+                raise RuntimeError('data parallel worker failed:\n{}'.format(max(errors, key=len)))
+            return self._merge_outputs([r for _, r in replies])
+
+    def close(self):
+        with self._lock:
+            if self._conns is None:
+                return
+            for conn in self._conns:
+                conn.send(None)
+                conn.close()
+            for w in self._workers:
+                w.join()
+            self._conns = self._workers = None
+
+            for p in self._params:
+                p.unpin_value()
+            self._grad_slots = self._grad_reduced = None
+            if self._feed_shm is not None:
+                self._shms.append(self._feed_shm)
+                self._feed_shm = None
+            for shm in self._shms:
+                try:
+                    shm.close()
+                except BufferError:
+                    pass  # still viewed by some value; the mapping goes away with the last view
+                shm.unlink()
+            self._shms = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
@@ -0,0 +1,11 @@
+# -*- coding:utf8 -*-
+# File   : __init__.py
+# Author : Jiayuan Mao
+# Email  : maojiayuan@gmail.com
+# Date   : 10/23/26 14:10
+#
+# This file is part of Kaleido
+# (c) 2016 vccy.xyz
+
+from .batcher import BatchingServer, LocalClient
+from .metrics import ServerMetrics
@@ -0,0 +1,271 @@
+# -*- coding:utf8 -*-
+# File   : batcher.py
+# Author : Jiayuan Mao
+# Email  : maojiayuan@gmail.com
+# Date   : 10/23/26 14:30
+#
+# This file is part of Kaleido
+# (c) 2016 vccy.xyz
+
+import asyncio
+import collections
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from .metrics import ServerMetrics
+
+__all__ = ['BatchingServer', 'LocalClient']
+
+
+class _Request(object):
+    __slots__ = ('feeds', 'nr_rows', 'key', 'future', 'time')
+
+    def __init__(self, feeds, nr_rows, key, future):
+        self.feeds = feeds
+        self.nr_rows = nr_rows
+        self.key = key
+        self.future = future
+        self.time = time.perf_counter()
+
+
+class BatchingServer(object):
+    """Asyncio front end batching the concurrent requests to an inference `Function`.
+
+    A request gives an array for every input of the function, the first axis being the batch one. The
+    queued requests are concatenated along that axis, up to `max_batch_size` rows or until the oldest one
+    waited `max_wait` seconds, the function runs once on the batch (in a worker thread, so the event loop
+    keeps accepting requests) and the outputs computed from the inputs are split back between the
+    requests; the other outputs are returned as they are to every request. Only requests whose inputs
+    agree in dtype and in the shape past the batch axis share a batch; requests are served in order.
+
+        server = BatchingServer(CompGraph().compile([pred], mode='inference'))
+        await server.start()
+        pred, = await server.infer(img=img)
+        await server.stop()
+    """
+
+    def __init__(self, func, max_batch_size=32, max_wait=0.002, metrics_window=10000):
+        assert func.mode == 'inference', 'the served function must be compiled with mode=\'inference\''
+        assert max_batch_size >= 1 and max_wait >= 0
+
+        plan = func.plan
+        self._func = func
+        self._max_batch_size = max_batch_size
+        self._max_wait = max_wait
+        self._metrics = ServerMetrics(metrics_window)
+        self._inputs = tuple(name for name, _ in plan.placeholders)
+
+        batched = {o for _, opr in plan.placeholders for o in opr.outputs}
+        for step in plan.steps:
+            if any(i in batched for i in step.opr.inputs):
+                batched.update(step.opr.outputs)
+        self._outputs = tuple((plan.varnodes[slot].name, plan.varnodes[slot] in batched) for slot in plan.outputs)
+
+        self._pending = collections.deque()
+        self._wakeup = None
+        self._task = None
+        self._executor = None
+        self._stopping = False
+
+    @property
+    def function(self):
+        return self._func
+
+    @property
+    def max_batch_size(self):
+        return self._max_batch_size
+
+    @property
+    def max_wait(self):
+        return self._max_wait
+
+    @property
+    def metrics(self):
+        return self._metrics
+
+    @property
+    def running(self):
+        return self._task is not None
+
+    async def start(self):
+        assert self._task is None, 'the server is already running'
+        self._wakeup = asyncio.Event()
+        self._stopping = False
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='kaleido-serve')
+        self._task = asyncio.get_running_loop().create_task(self._serve())
+
+    async def stop(self):
+        """Serve the queued requests, then stop."""
+        if self._task is None:
+            return
+        self._stopping = True
+        self._wakeup.set()
+        try:
+            await self._task
+        finally:
+            self._task = None
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.stop()
+
+    async def infer(self, **feeds):
+        """Queue a request and return the outputs of the function for its rows."""
+        assert self._task is not None and not self._stopping, 'the server is not running'
+        req = self._make_request(feeds)
+        self._pending.append(req)
+        self._metrics.record_queue_depth(len(self._pending))
+        self._wakeup.set()
+        return await req.future
+
+    def _make_request(self, feeds):
+        values, key, nr_rows = {}, [], set()
+        for name in self._inputs:
+            assert name in feeds, 'missing input value for {}'.format(name)
+            value = np.asarray(feeds[name])
+            assert value.ndim != 0, 'input {} has no batch axis'.format(name)
+            values[name] = value
+            key.append((value.shape[1:], value.dtype))
+            nr_rows.add(value.shape[0])
+        assert len(nr_rows) == 1, 'inputs have different numbers of rows: {}'.format(
+            {name: v.shape[0] for name, v in values.items()})
+        return _Request(values, nr_rows.pop(), tuple(key), asyncio.get_running_loop().create_future())
+
+    def _nr_batchable_rows(self):
+        key = self._pending[0].key
+        total = 0
+        for req in self._pending:
+            if req.key != key or total >= self._max_batch_size:
+                break
+            total += req.nr_rows
+        return total
+
+    def _take_batch(self):
+        batch = [self._pending.popleft()]
+        total = batch[0].nr_rows
+        while len(self._pending) != 0:
+            req = self._pending[0]
+            if req.key != batch[0].key or total + req.nr_rows > self._max_batch_size:
+                break
+            batch.append(self._pending.popleft())
+            total += req.nr_rows
+        return batch, total
+
+    async def _serve(self):
+        while True:
+            if len(self._pending) == 0:
+                if self._stopping:
+                    return
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+
+            # wait for more requests until the batch is full or the oldest request waited long enough
+            head = self._pending[0]
+            while not self._stopping and self._nr_batchable_rows() < self._max_batch_size:
+                timeout = head.time + self._max_wait - time.perf_counter()
+                if timeout <= 0:
+                    break
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    break
+
+            batch, total = self._take_batch()
+            self._metrics.record_queue_depth(len(self._pending))
+            await self._run_batch(batch, total)
+
+    async def _run_batch(self, batch, total):
+        if len(batch) == 1:
+            feeds = batch[0].feeds
+        else:
+            feeds = {name: np.concatenate([req.feeds[name] for req in batch]) for name in self._inputs}
+
+        failed = False
+        try:
+            outputs = await asyncio.get_running_loop().run_in_executor(self._executor, lambda: self._func(**feeds))
+            results = self._split_outputs(outputs, batch, total)
+        except Exception as e:
+            failed = True
+            for req in batch:
+                if not req.future.done():
+                    req.future.set_exception(e)
+        else:
+            for req, res in zip(batch, results):
+                if not req.future.done():
+                    req.future.set_result(res)
+
+        now = time.perf_counter()
+        self._metrics.record_batch(total, [now - req.time for req in batch], failed)
+
+    def _split_outputs(self, outputs, batch, total):
+        offsets = np.cumsum([req.nr_rows for req in batch])[:-1]
+        results = [[] for _ in batch]
+        for value, (name, batched) in zip(outputs, self._outputs):
+            if batched:
+                assert value.ndim != 0 and value.shape[0] == total, \
+                    'output {} of shape {} does not keep the batch axis of {} rows'.format(name, value.shape, total)
+                parts = np.split(value, offsets)
+            else:
+                parts = [value] * len(batch)
+            for res, part in zip(results, parts):
+                res.append(part)
+        return results
+
+
+class LocalClient(object):
+    """Blocking in-process client of a `BatchingServer`, for callers outside of asyncio (e.g. threads).
+
+    The server runs on an event loop in a background thread, started with the client and stopped by
+    `close`. `submit` returns a `concurrent.futures.Future`, so one thread can have many requests in flight.
+    """
+
+    def __init__(self, server):
+        self._server = server
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, name='kaleido-serve-loop', daemon=True)
+        self._thread.start()
+        self._call(server.start())
+
+    @property
+    def server(self):
+        return self._server
+
+    def _call(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self._loop).result()
+
+    def submit(self, **feeds):
+        assert self._loop is not None, 'the client is closed'
+        return asyncio.run_coroutine_threadsafe(self._server.infer(**feeds), self._loop)
+
+    def infer(self, **feeds):
+        return self.submit(**feeds).result()
+
+    def metrics(self):
+        return self._server.metrics.snapshot()
+
+    def close(self):
+        if self._loop is None:
+            return
+        try:
+            self._call(self._server.stop())
+        finally:
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._thread.join()
+            self._loop.close()
+            self._loop = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
@@ -0,0 +1,70 @@
+# -*- coding:utf8 -*-
+# File   : metrics.py
+# Author : Jiayuan Mao
+# Email  : maojiayuan@gmail.com
+# Date   : 10/23/26 14:10
+#
+# This file is part of Kaleido
+# (c) 2016 vccy.xyz
+
+import collections
+import threading
+
+import numpy as np
+
+__all__ = ['ServerMetrics']
+
+
+class ServerMetrics(object):
+    """Counters of a `BatchingServer`: the queue depth (in requests), a histogram of the batch sizes (in rows)
+    and the latencies of the last `window` requests, from their arrival to their result."""
+
+    percentiles = (50, 90, 99)
+
+    def __init__(self, window=10000):
+        self._lock = threading.Lock()
+        self._window = window
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self._queue_depth = 0
+            self._max_queue_depth = 0
+            self._batch_sizes = collections.Counter()
+            self._latencies = collections.deque(maxlen=self._window)
+            self._nr_requests = 0
+            self._nr_errors = 0
+
+    @property
+    def queue_depth(self):
+        return self._queue_depth
+
+    def record_queue_depth(self, depth):
+        with self._lock:
+            self._queue_depth = depth
+            self._max_queue_depth = max(self._max_queue_depth, depth)
+
+    def record_batch(self, nr_rows, latencies, failed=False):
+        with self._lock:
+            self._batch_sizes[nr_rows] += 1
+            self._latencies.extend(latencies)
+            self._nr_requests += len(latencies)
+            if failed:
+                self._nr_errors += len(latencies)
+
+    def snapshot(self):
+        """The metrics as a dict; latencies are in seconds, None before the first request."""
+        with self._lock:
+            latencies = np.array(self._latencies)
+            res = {
+                'queue_depth': self._queue_depth,
+                'max_queue_depth': self._max_queue_depth,
+                'nr_requests': self._nr_requests,
+                'nr_errors': self._nr_errors,
+                'nr_batches': sum(self._batch_sizes.values()),
+                'batch_size_hist': dict(sorted(self._batch_sizes.items())),
+            }
+        for p in self.percentiles:
+            res['latency_p{}'.format(p)] = float(np.percentile(latencies, p)) if len(latencies) else None
+        res['latency_max'] = float(latencies.max()) if len(latencies) else None
+        return res
@@ -0,0 +1,65 @@
+# -*- coding:utf8 -*-
+# File   : threads.py
+# Author : Jiayuan Mao
+# Email  : maojiayuan@gmail.com
+# Date   : 10/22/26 11:05
+#
+# This file is part of Kaleido
+# (c) 2016 vccy.xyz
+
+import os
+
+__all__ = ['get_nr_threads', 'set_nr_threads']
+
+_BLAS_ENV_VARS = ('OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS', 'VECLIB_MAXIMUM_THREADS',
+                  'NUMEXPR_NUM_THREADS')
+
+_nr_threads = 0
+_blas_limits = None
+_saved_environ = None  # the values of _BLAS_ENV_VARS before set_nr_threads, None for the unset ones
+
+
+def get_nr_threads():
+    """Number of threads of the compiled kernels and of BLAS; all the cores unless set."""
+    return _nr_threads if _nr_threads > 0 else (os.cpu_count() or 1)
+
+
+def set_nr_threads(nr_threads):
+    """Use `nr_threads` threads (0 for all the cores) in the OpenMP loops of the kernels, and cap the BLAS
+    thread pools to the same number, so a GEMM called between the loops does not oversubscribe the cores.
+
+    BLAS libraries already loaded are capped through threadpoolctl when it is installed; the environment
+    variables set here only reach the libraries loaded afterwards, and get their original values back when
+    the number is reset to 0.
+    """
+    global _nr_threads, _blas_limits, _saved_environ
+    assert nr_threads >= 0
+    _nr_threads = int(nr_threads)
+
+    try:
+        from .opr_kernel import cnn as cnn_kernel
+    except ImportError:  # the extension is not built
+        pass
+    else:
+        cnn_kernel.set_nr_threads(_nr_threads)
+
+    if _nr_threads > 0:
+        if _saved_environ is None:
+            _saved_environ = {name: os.environ.get(name) for name in _BLAS_ENV_VARS}
+        for name in _BLAS_ENV_VARS:
+            os.environ[name] = str(_nr_threads)
+    elif _saved_environ is not None:
+        for name, value in _saved_environ.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+        _saved_environ = None
+
+    try:
+        from threadpoolctl import threadpool_limits
+    except ImportError:
+        return
+    if _blas_limits is not None:
+        _blas_limits.restore_original_limits()
+    _blas_limits = threadpool_limits(limits=_nr_threads, user_api='blas') if _nr_threads > 0 else None
@@ -6,8 +6,12 @@
 # 
 # This file is part of Kaleido
 
-from setuptools import setup
+import os
+import tempfile
+
+from setuptools import setup, find_packages
 from distutils.extension import Extension
+from distutils.errors import CompileError, LinkError
 from Cython.Distutils import build_ext
 import numpy as np
 
@@ -19,6 +23,38 @@ except AttributeError:
     numpy_include = np.get_numpy_include()
 
 
+def get_openmp_flags(compiler):
+    if compiler.compiler_type == 'msvc':
+        return ['/openmp'], []
+    return ['-fopenmp'], ['-fopenmp']
+
+
+def has_openmp(compiler, compile_flags, link_flags):
+    # build a small OpenMP program; the kernels fall back to serial loops if it fails
+    with tempfile.TemporaryDirectory() as tmp:
+        src = os.path.join(tmp, 'omp_test.c')
+        with open(src, 'w') as f:
+            f.write('#include <omp.h>\nint main(void) { return omp_get_max_threads() > 0 ? 0 : 1; }\n')
+        try:
+            objs = compiler.compile([src], output_dir=tmp, extra_postargs=compile_flags)
+            compiler.link_executable(objs, os.path.join(tmp, 'omp_test'), extra_postargs=link_flags)
+        except (CompileError, LinkError):
+            return False
+    return True
+
+
+class build_ext_openmp(build_ext):
+    def build_extensions(self):
+        compile_flags, link_flags = get_openmp_flags(self.compiler)
+        if os.environ.get('KALEIDO_NO_OPENMP') or not has_openmp(self.compiler, compile_flags, link_flags):
+            print('OpenMP is not available, the kernels are built serial')
+            compile_flags, link_flags = [], []
+        for ext in self.extensions:
+            ext.extra_compile_args = ext.extra_compile_args + compile_flags
+            ext.extra_link_args = ext.extra_link_args + link_flags
+        super().build_extensions()
+
+
 ext_modules = [
     Extension(
         "kaleido.opr_kernel.cnn",
@@ -32,7 +68,7 @@ setup(
     name='Kaleido',
     author='Jiayuan Mao',
     author_email='maojiayuan@gmail.com',
-    packages=['kalendo'],
+    packages=find_packages(include=['kaleido', 'kaleido.*']),
     ext_modules=ext_modules,
-    cmdclass={'build_ext': build_ext}
+    cmdclass={'build_ext': build_ext_openmp}
 )